@@ -60,14 +60,14 @@ object reference system, and a capability-based security model.
     "package_dir": {"": "src"},
     "packages": ["foolscap", "foolscap.slicers", "foolscap.logging",
                  "foolscap.connections",
-                 "foolscap.appserver", "foolscap.test"],
+                 "foolscap.appserver", "foolscap.bench", "foolscap.test"],
     "entry_points": {"console_scripts": [
         "flogtool = foolscap.logging.cli:run_flogtool",
         "flappserver = foolscap.appserver.cli:run_flappserver",
         "flappclient = foolscap.appserver.client:run_flappclient",
         ] },
     "cmdclass": commands,
-    "install_requires": ["six", "twisted[tls] >= 16.0.0", "pyOpenSSL"],
+    "install_requires": ["six", "twisted[tls] >= 21.2.0", "pyOpenSSL"],
     "extras_require": {
         "dev": ["txtorcon >= 19.0.0",
                 "txi2p-tahoe >= 0.3.5; python_version > '3.0'",
@@ -0,0 +1,49 @@
+# -*- test-case-name: foolscap.test.test_aio -*-
+
+"""asyncio versions of the calls that return Deferreds.
+
+An asyncio Task cannot await a Deferred, so code running in one (on the
+asyncio reactor) should use these instead::
+
+ from twisted.internet import asyncioreactor
+ asyncioreactor.install()
+ from foolscap import aio
+
+ async def main(tub, furl):
+     rref = await aio.getReference(tub, furl)
+     total = await aio.callRemote(rref, "add", 1, 2)
+
+Each returns an asyncio Future, which is resolved straight from the
+Deferred's callback. Cancelling the Future cancels the call. A remote
+exception arrives as a CopiedFailure, which is not an Exception instance,
+so the Future raises a RemoteException around it instead: examine its
+.failure to learn more.
+
+Coroutines which are run with Deferred.fromCoroutine (including 'async def'
+remote_ methods) can await the Deferreds directly, and do not need this
+module.
+"""
+
+import asyncio
+from foolscap.tokens import RemoteException
+
+def _wrapCopiedFailure(f):
+    if not isinstance(f.value, BaseException):
+        raise RemoteException(f)
+    return f
+
+def asFuture(d, loop=None):
+    """Return an asyncio Future that follows the Deferred 'd'. 'loop'
+    defaults to the running event loop."""
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    d.addErrback(_wrapCopiedFailure)
+    return d.asFuture(loop)
+
+def callRemote(rref, _name, *args, **kwargs):
+    """Like rref.callRemote(), but return an asyncio Future."""
+    return asFuture(rref.callRemote(_name, *args, **kwargs))
+
+def getReference(tub, sturdyOrURL):
+    """Like tub.getReference(), but return an asyncio Future."""
+    return asFuture(tub.getReference(sturdyOrURL))
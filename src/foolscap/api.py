@@ -16,34 +16,43 @@ del get_versions
 from foolscap.pb import Tub
 
 # names we import so that others can reach them as foolscap.api.foo
-from foolscap.remoteinterface import RemoteInterface
+from foolscap.remoteinterface import RemoteInterface, sendPriority
 from foolscap.referenceable import Referenceable, SturdyRef
 from foolscap.copyable import Copyable, RemoteCopy, registerRemoteCopy
 from foolscap.copyable import registerCopier, registerRemoteCopyFactory
 from foolscap.ipb import DeadReferenceError, IConnectionHintHandler
+from foolscap.ipb import SendQueueFullError
 from foolscap.tokens import BananaError
 from foolscap.schema import StringConstraint, IntegerConstraint, \
-    ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any
+    SpooledStringConstraint, ListOf, TupleOf, SetOf, DictOf, ChoiceOf, \
+    StreamOf, Any
+from foolscap.streaming import ByteSource, ByteStreamConstraint
 from foolscap.storage import serialize, unserialize
+from foolscap.storage import serializeSync, unserializeSync
 from foolscap.tokens import Violation, RemoteException
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
+from foolscap.executors import runInThread, runInProcess, runAsTask
 from foolscap.logging import app_versions
 
 # hush pyflakes
 _unused = [
     __version__,
     Tub,
-    RemoteInterface,
+    RemoteInterface, sendPriority,
     Referenceable, SturdyRef,
     Copyable, RemoteCopy, registerRemoteCopy,
     registerCopier, registerRemoteCopyFactory,
     DeadReferenceError, IConnectionHintHandler,
+    SendQueueFullError,
     BananaError,
-    StringConstraint, IntegerConstraint,
-    ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any,
+    StringConstraint, IntegerConstraint, SpooledStringConstraint,
+    ListOf, TupleOf, SetOf, DictOf, ChoiceOf, StreamOf, Any,
+    ByteSource, ByteStreamConstraint,
     serialize, unserialize,
+    serializeSync, unserializeSync,
     Violation, RemoteException,
     eventually, fireEventually, flushEventualQueue,
+    runInThread, runInProcess, runAsTask,
     app_versions,
     ]
 del _unused
@@ -1,8 +1,11 @@
 import six
 import struct, time
+from collections import OrderedDict
+from zope.interface import implementer
 
 from twisted.internet import protocol, defer, reactor
-from twisted.internet.interfaces import ITCPTransport
+from twisted.internet.interfaces import ITCPTransport, IConsumer, \
+     IPushProducer
 from twisted.python.failure import Failure
 from twisted.python import log
 
@@ -10,8 +13,11 @@ from twisted.python import log
 # need for RootSlicer/etc goes away, do the import here anyway.
 from foolscap.slicers.allslicers import RootSlicer, RootUnslicer
 from foolscap.slicers.allslicers import ReplaceVocabSlicer, AddVocabSlicer
+from foolscap.slicers.root import CONTROL, INTERACTIVE
 
-from . import stringchain
+from . import compression
+from .eventual import eventually
+from . import receivebuffer
 from . import tokens
 from .tokens import SIZE_LIMIT, STRING, LIST, INT, NEG, \
      LONGINT, LONGNEG, VOCAB, FLOAT, OPEN, CLOSE, ABORT, ERROR, \
@@ -20,14 +26,23 @@ from .tokens import SIZE_LIMIT, STRING, LIST, INT, NEG, \
 
 EPSILON = 0.1
 
-def int2b128(integer, stream):
-    if integer == 0:
-        stream(b'\0')
-        return
-    assert integer > 0, "can only encode positive integers"
+# most headers are small, so precompute them
+_SMALL_B128 = [six.int2byte(i) for i in range(128)]
+
+def b128(integer):
+    """Return the little-endian base-128 header for a non-negative integer,
+    as a single bytes object."""
+    if integer < 128:
+        assert integer >= 0, "can only encode positive integers"
+        return _SMALL_B128[integer]
+    out = bytearray()
     while integer:
-        stream(six.int2byte(integer & 0x7f))
+        out.append(integer & 0x7f)
         integer = integer >> 7
+    return bytes(out)
+
+def int2b128(integer, stream):
+    stream(b128(integer))
 
 def b1282int(st):
     # NOTE that this is little-endian
@@ -67,12 +82,34 @@ def bytes_to_long(s):
 
 HIGH_BIT_SET = b"\x80"
 
+# During a produce() pass, token bodies at least this large are handed to
+# the transport as separate elements of a writeSequence() call, instead of
+# being copied into the output buffer along with the headers.
+LARGE_WRITE = 8192
+# ... and once this much has accumulated, it is handed over right away, so
+# that the transport can pause us before we serialize much more
+OUTPUT_FLUSH_SIZE = 65536
+
 SIMPLE_TOKENS = (int, float, bytes)
 
+# container Slicers may hand elements of these types to sendPrimitives() in
+# bulk, instead of yielding them one at a time
+BULK_TYPES = frozenset([int, float, bytes, bool, type(None)])
+_DOUBLE = struct.Struct("!d")
+
+# receivePrimitives() handles these token types, and leaves the rest to the
+# general loop in handleData()
+_PRIMITIVE_TYPEBYTES = dict([(t[0], t) for t in (INT, NEG, STRING, VOCAB,
+                                                 FLOAT)])
+# strings longer than this are left to handleData(), which copies the body
+# out of the receive buffer only once
+MAX_BULK_STRING = 1024
+
 # Banana is a big class. It is split up into three sections: sending,
 # receiving, and connection setup. These used to be separate classes, but
 # the __init__ functions got too weird.
 
+@implementer(IPushProducer)
 class Banana(protocol.Protocol):
 
     def __init__(self, features={}):
@@ -81,6 +118,12 @@ class Banana(protocol.Protocol):
         """
         self.initSend()
         self.initReceive()
+        # if the negotiation picked a stream compression algorithm, all
+        # bytes after the decision block are compressed in both directions
+        self.streamCompression = None
+        algorithm = features.get("compression")
+        if algorithm:
+            self.streamCompression = compression.getCompression(algorithm)
 
     def populateVocabTable(self, vocabStrings):
         """
@@ -107,6 +150,11 @@ class Banana(protocol.Protocol):
             print("Banana.connectionMade")
         if ITCPTransport.providedBy(self.transport):
             self.transport.setTcpNoDelay(True)
+        # the transport will pause us when its write buffer fills up, see
+        # registerProducer()
+        self.canRegisterProducer = IConsumer.providedBy(self.transport)
+        # and we can ask it to stop reading, see pauseReceiving()
+        self.canPauseTransport = IPushProducer.providedBy(self.transport)
         self.initSlicer()
         self.initUnslicer()
         if self.keepaliveTimeout is not None:
@@ -131,6 +179,11 @@ class Banana(protocol.Protocol):
         if self.keepaliveTimer:
             self.keepaliveTimer.cancel()
             self.keepaliveTimer = None
+        self.producerRegistered = False
+        # nothing more will be sent, so don't leave anyone waiting
+        waiters, self.sendQueueWaiters = self.sendQueueWaiters, []
+        for d in waiters:
+            d.callback(None)
         protocol.Protocol.connectionLost(self, why)
 
     ### SendBanana
@@ -138,15 +191,56 @@ class Banana(protocol.Protocol):
     # calls transport.write() and transport.loseConnection()
 
     slicerClass = RootSlicer # this is used in connectionMade()
-    paused = False
+    paused = False # by the transport, see pauseProducing()
+    produceWaiting = None # a Deferred from a Slicer, see produceTokens()
     streamable = True # this is checked at connectionMade() time
     debugSend = False
+    sendPrimitivesInBulk = True # see canSendPrimitives()
+
+    # Adaptive vocabulary: strings that we keep sending in full are promoted
+    # into the outbound VOCAB table. This requires a peer which accepts
+    # (add-vocab) and (set-vocab) sequences at any time, so it is disabled
+    # by default: the Broker turns it on when negotiation allows it.
+    adaptiveVocabulary = False
+    vocabizeThreshold = 3 # promote a string after this many full sends
+    minVocabizeLength = 4 # shorter strings aren't worth the trouble
+    maxVocabizeLength = 100 # the far end's AddVocabUnslicer limit
+    maxVocabCandidates = 1000 # strings being counted, in LRU order
+    maxAdaptiveVocabulary = 1000 # promoted strings, before we evict some
+
+    # Outbound flow control: while the transport has us paused, objects
+    # passed to send() wait in the RootSlicer's sendQueue. Output is handed
+    # to the transport after each top-level object (and every
+    # OUTPUT_FLUSH_SIZE bytes within one), so a pause takes effect before
+    # the next object is serialized. We don't know how large a queued
+    # object is until it has been serialized, so the byte limits use an
+    # estimate: see getSendQueueBytes().
+    sendQueueHighWater = None # isSendQueueFull() above this, None=never
+    sendQueueLowWater = 0 # waitForSendQueue() fires at or below this
+    sendQueueHighWaterBytes = None # the same, for getSendQueueBytes()
+    sendQueueLowWaterBytes = None # None=only count objects
 
     def initSend(self):
         self.openCount = 0
+        self.sendQueueWaiters = []
+        self.outputBuffer = None # bytearray, only during a produce() pass
+        self.outputChunks = None
+        self.outputChunkBytes = 0 # the total size of outputChunks
+        self.bytesDelivered = 0 # given to deliverOutput()
+        self.producing = False # in a produce() pass
+        self.objectBoundary = 0 # bytesDelivered after the last object
+        self.averageObjectSize = None # moving average, in bytes
         self.outgoingVocabulary = {} # bytes->int
         self.nextAvailableOutgoingVocabularyIndex = 0
         self.pendingVocabAdditions = set() # bytes
+        self.vocabCandidates = OrderedDict() # bytes->count, LRU order
+        self.adaptiveVocabUses = {} # promoted bytes->VOCAB tokens sent
+        self.vocabReplacementPending = False
+        # statistics
+        self.vocabTokensSent = 0
+        self.vocabBytesSaved = 0 # compared to sending each string in full
+        self.vocabPromotions = 0
+        self.vocabReplacements = 0
 
     def initSlicer(self):
         self.rootSlicer = self.slicerClass(self)
@@ -158,15 +252,148 @@ class Banana(protocol.Protocol):
         top = (self.rootSlicer, slices, None)
         self.slicerStack = [top]
 
-    def send(self, obj):
+    def send(self, obj, priority=INTERACTIVE, flow=None):
+        """Queue 'obj' for serialization, in the lane for 'priority' (one of
+        CONTROL, INTERACTIVE, or BULK). Objects with the same 'flow' are
+        sent in order, and the flows of a lane take turns, a quantum of
+        bytes at a time. Returns a Deferred that fires once it has been
+        serialized."""
         if self.debugSend: print("Banana.send(%s)" % obj)
-        return self.rootSlicer.send(obj)
+        if self.canRegisterProducer and not self.producerRegistered:
+            self.registerProducer()
+        return self.rootSlicer.send(obj, priority, flow)
+
+    def getSendQueueSize(self):
+        """Return the number of objects which have been passed to send() but
+        which have not yet started to be serialized."""
+        return len(self.rootSlicer.sendQueue)
+
+    def getSendQueueBytes(self):
+        """Return an estimate of the serialized size of the objects waiting
+        in the send queue: the moving average size of the top-level objects
+        sent so far, once per queued object."""
+        if self.averageObjectSize is None:
+            return 0
+        return int(len(self.rootSlicer.sendQueue) * self.averageObjectSize)
+
+    def getSendQueueStats(self):
+        """Return the deficit-round-robin statistics of each lane of the
+        send queue, see SendQueue.getStats()."""
+        return self.rootSlicer.sendQueue.getStats()
+
+    def getBytesProduced(self):
+        """Return the number of bytes serialized so far (before any
+        compression), including those not yet given to the transport."""
+        produced = self.bytesDelivered + self.outputChunkBytes
+        if self.outputBuffer is not None:
+            produced += len(self.outputBuffer)
+        return produced
+
+    def isSendQueueFull(self):
+        if (self.sendQueueHighWater is not None
+            and self.getSendQueueSize() >= self.sendQueueHighWater):
+            return True
+        return (self.sendQueueHighWaterBytes is not None
+                and self.getSendQueueBytes() >= self.sendQueueHighWaterBytes)
+
+    def isSendQueueLow(self):
+        if self.getSendQueueSize() <= self.sendQueueLowWater:
+            return True
+        return (self.sendQueueLowWaterBytes is not None
+                and self.getSendQueueBytes() <= self.sendQueueLowWaterBytes)
+
+    def waitForSendQueue(self):
+        """Return a Deferred that fires (with None) once the send queue has
+        drained to sendQueueLowWater objects or sendQueueLowWaterBytes bytes
+        or below, or the connection is lost. A sender which produces
+        messages faster than the peer can take them should wait for this
+        before sending more."""
+        if self.isSendQueueLow():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.sendQueueWaiters.append(d)
+        return d
+
+    def _checkSendQueue(self):
+        if self.isSendQueueLow():
+            waiters, self.sendQueueWaiters = self.sendQueueWaiters, []
+            for d in waiters:
+                eventually(d.callback, None)
+
+    # IPushProducer, for the transport
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.produceWaiting is None and self.outputBuffer is None:
+            # produceTokens() stopped because we were paused, not because
+            # it is waiting for a Slicer's Deferred to fire
+            self.produce()
+
+    def stopProducing(self):
+        # the transport is going away, and connectionLost() will follow
+        self.paused = True
+
+    # We are only registered with the transport while we have something to
+    # send. A TLS transport will not shut down while a producer is
+    # registered, and other code is allowed to call
+    # broker.transport.loseConnection() directly.
+    canRegisterProducer = False
+    producerRegistered = False
+
+    def registerProducer(self):
+        self.producerRegistered = True
+        self.transport.registerProducer(self, True)
+
+    def unregisterProducer(self):
+        self.producerRegistered = False
+        self.transport.unregisterProducer()
+
+    def _isIdle(self):
+        # the RootSlicer is waiting for the next send()
+        return (len(self.slicerStack) == 1
+                and self.produceWaiting is not None)
+
+    def loseConnection(self):
+        if self.producerRegistered:
+            self.unregisterProducer()
+        self.transport.loseConnection()
 
     def _slice_error(self, f, s):
         log.msg("Error in Deferred returned by slicer %s: %s" % (s, f))
         self.sendFailed(f)
 
     def produce(self, dummy=None):
+        # Everything written during this pass is accumulated by writeOutput()
+        # and handed to the transport in a single write() or writeSequence()
+        # at the end of each top-level object, once OUTPUT_FLUSH_SIZE bytes
+        # have built up, and when the pass ends (because we ran out of things
+        # to send, we're waiting on a Deferred, or we've been paused). The
+        # transport may pause us from inside any of those writes. A Deferred
+        # which has already fired will re-enter produce() from inside the
+        # loop: the outermost pass does the final flushing.
+        self.produceWaiting = None
+        if self.outputBuffer is not None:
+            self.produceTokens()
+            return
+        self.outputBuffer = bytearray()
+        self.outputChunks = []
+        self.producing = True
+        try:
+            self.produceTokens()
+        finally:
+            self.producing = False
+            self.flushOutput()
+            self.outputBuffer = None
+            self.outputChunks = None
+        if self.sendQueueWaiters:
+            self._checkSendQueue()
+        if self.producerRegistered and not self.paused and self._isIdle():
+            self.unregisterProducer()
+
+    def produceTokens(self):
         # optimize: cache 'next' because we get many more tokens than stack
         # pushes/pops
         while self.slicerStack and not self.paused:
@@ -179,6 +406,8 @@ class Banana(protocol.Protocol):
                     for s,_,_ in self.slicerStack:
                         if not s.streamable:
                             raise Violation("parent not streamable")
+                    # if it has already fired, this re-enters produce()
+                    self.produceWaiting = obj
                     obj.addCallback(self.produce)
                     obj.addErrback(self._slice_error, s)
                     # this is the primary exit point
@@ -186,6 +415,9 @@ class Banana(protocol.Protocol):
                 elif type(obj) in SIMPLE_TOKENS:
                     # sendToken raises a BananaError for weird tokens
                     self.sendToken(obj)
+                    if len(self.slicerStack) == 1:
+                        # the RootSlicer sent it as a top-level object
+                        self.finishedObject()
                 else:
                     # newSlicerFor raises a Violation for unsendable types
                     # pushSlicer calls .slice, which can raise Violation
@@ -214,6 +446,8 @@ class Banana(protocol.Protocol):
             except StopIteration:
                 if self.debugSend: print("StopIteration")
                 self.popSlicer()
+                if len(self.slicerStack) == 1:
+                    self.finishedObject()
 
             except Violation as v:
                 # Violations that occur because of Constraints are caught
@@ -224,6 +458,8 @@ class Banana(protocol.Protocol):
 
                 f = BananaFailure()
                 self.handleSendViolation(f, doPop=True, sendAbort=True)
+                if len(self.slicerStack) == 1:
+                    self.finishedObject()
 
             except:
                 print("exception in produce")
@@ -239,6 +475,18 @@ class Banana(protocol.Protocol):
 
         assert self.slicerStack # should never be empty
 
+    def finishedObject(self):
+        # a top-level object has been serialized. Hand it to the transport,
+        # which may pause us, and update the size estimate used by
+        # getSendQueueBytes()
+        self.flushOutput()
+        size = self.bytesDelivered - self.objectBoundary
+        self.objectBoundary = self.bytesDelivered
+        if self.averageObjectSize is None:
+            self.averageObjectSize = float(size)
+        else:
+            self.averageObjectSize += (size - self.averageObjectSize) / 8.0
+
     def handleSendViolation(self, f, doPop, sendAbort):
         f.value.setLocation(self.describeSend())
 
@@ -385,7 +633,7 @@ class Banana(protocol.Protocol):
         # differential compression), but confusing. It accomplishes this by
         # clearing our self.outgoingVocabulary dict when it begins to be
         # serialized.
-        self.send(s)
+        d = self.send(s, CONTROL)
 
         # likewise, when it finishes, the ReplaceVocabSlicer replaces our
         # self.outgoingVocabulary dict when it has finished sending the
@@ -393,6 +641,7 @@ class Banana(protocol.Protocol):
         # or somewhen very close to it, because otherwise there could be a
         # race condition that could result in some strings being vocabized
         # with the wrong keys.
+        return d
 
     def addToOutgoingVocabulary(self, value):
         """Schedule 'value' for addition to the outbound VOCAB table.
@@ -410,7 +659,9 @@ class Banana(protocol.Protocol):
             return
         self.pendingVocabAdditions.add(value)
         s = AddVocabSlicer(value)
-        self.send(s)
+        # vocabulary changes take effect when they are serialized, so they
+        # may overtake the objects ahead of them
+        self.send(s, CONTROL)
 
     def outgoingVocabTableWasReplaced(self, newTable):
         # this is called by the ReplaceVocabSlicer to manipulate our table.
@@ -444,75 +695,240 @@ class Banana(protocol.Protocol):
         value = six.ensure_binary(value)
         self.outgoingVocabulary[value] = index
 
-    # these methods define how we emit low-level tokens
+    # these methods define how we emit low-level tokens. Everything goes
+    # through writeOutput(), which batches the bytes while produce() is
+    # running, and writes them to the transport directly otherwise.
+
+    def writeOutput(self, data):
+        out = self.outputBuffer
+        if out is None:
+            self.deliverOutput([data])
+        elif len(data) < LARGE_WRITE:
+            out += data
+            if len(out) >= OUTPUT_FLUSH_SIZE and self.producing:
+                self.flushOutput()
+        else:
+            # large bodies are not copied: they get their own element of
+            # the writeSequence() vector
+            if out:
+                self.outputChunks.append(bytes(out))
+                self.outputChunkBytes += len(out)
+                del out[:]
+            self.outputChunks.append(data)
+            self.outputChunkBytes += len(data)
+            if self.outputChunkBytes >= OUTPUT_FLUSH_SIZE and self.producing:
+                self.flushOutput()
+
+    def flushOutput(self):
+        """Deliver everything accumulated by writeOutput() during the current
+        produce() pass to the transport, with a single write() or
+        writeSequence() call."""
+        out = self.outputBuffer
+        if out is None:
+            return
+        chunks = self.outputChunks
+        if out:
+            chunks.append(bytes(out))
+            del out[:]
+        if not chunks:
+            return
+        self.outputChunks = []
+        self.outputChunkBytes = 0
+        self.deliverOutput(chunks)
+
+    def deliverOutput(self, chunks):
+        for chunk in chunks:
+            self.bytesDelivered += len(chunk)
+        if self.streamCompression is not None:
+            # this ends with a sync-flush, so the far end can decode
+            # everything we've written so far
+            self.transport.write(self.streamCompression.compress(chunks))
+        elif len(chunks) == 1:
+            self.transport.write(chunks[0])
+        else:
+            self.transport.writeSequence(chunks)
 
     def sendPING(self, number=0):
         if number:
-            int2b128(number, self.transport.write)
-        self.transport.write(PING)
+            self.writeOutput(b128(number) + PING)
+        else:
+            self.writeOutput(PING)
 
     def sendPONG(self, number):
         if number:
-            int2b128(number, self.transport.write)
-        self.transport.write(PONG)
+            self.writeOutput(b128(number) + PONG)
+        else:
+            self.writeOutput(PONG)
 
     def sendOpen(self):
         openID = self.openCount
         self.openCount += 1
-        int2b128(openID, self.transport.write)
-        self.transport.write(OPEN)
+        self.writeOutput(b128(openID) + OPEN)
         return openID
 
     def sendToken(self, obj):
-        write = self.transport.write
+        write = self.writeOutput
         if isinstance(obj, int):
             if obj >= 2**31:
                 s = long_to_bytes(obj)
-                int2b128(len(s), write)
-                write(LONGINT)
+                write(b128(len(s)) + LONGINT)
                 write(s)
             elif obj >= 0:
-                int2b128(obj, write)
-                write(INT)
+                write(b128(obj) + INT)
             elif -obj > 2**31: # NEG is [-2**31, 0)
                 s = long_to_bytes(-obj)
-                int2b128(len(s), write)
-                write(LONGNEG)
+                write(b128(len(s)) + LONGNEG)
                 write(s)
             else:
-                int2b128(-obj, write)
-                write(NEG)
+                write(b128(-obj) + NEG)
         elif isinstance(obj, float):
-            write(FLOAT)
-            write(struct.pack("!d", obj))
+            write(FLOAT + struct.pack("!d", obj))
         elif isinstance(obj, bytes):
             if obj in self.outgoingVocabulary:
                 symbolID = self.outgoingVocabulary[obj]
-                int2b128(symbolID, write)
-                write(VOCAB)
+                header = b128(symbolID)
+                write(header + VOCAB)
+                self.vocabTokensSent += 1
+                self.vocabBytesSaved += (len(b128(len(obj))) + len(obj)
+                                         - len(header))
+                uses = self.adaptiveVocabUses
+                if obj in uses:
+                    uses[obj] += 1
             else:
                 self.maybeVocabizeString(obj)
-                int2b128(len(obj), write)
-                write(STRING)
+                write(b128(len(obj)) + STRING)
                 write(obj)
         else:
             raise BananaError("could not send object: %s" % repr(obj))
 
+    def canSendPrimitives(self, items):
+        """Return True if every element of 'items' can be given to
+        sendPrimitives(): ints, floats, bytes, bools, and None."""
+        if not self.sendPrimitivesInBulk or self.outputBuffer is None:
+            return False
+        if self.debugSend:
+            return False
+        types = BULK_TYPES
+        for item in items:
+            if type(item) not in types:
+                return False
+        return True
+
+    def sendPrimitives(self, items):
+        """Send the elements of 'items', which canSendPrimitives() has
+        approved, exactly as if a Slicer had yielded them one at a time. The
+        common cases (small ints, short strings which are not in the VOCAB
+        table, and floats) are appended straight to the output buffer."""
+        out = self.outputBuffer
+        vocab = self.outgoingVocabulary
+        small = _SMALL_B128
+        pack = _DOUBLE.pack
+        for item in items:
+            t = type(item)
+            if t is int:
+                if 0 <= item < 128:
+                    out += small[item]
+                    out += INT
+                elif 0 <= item < 16384:
+                    # two-byte header, built in place
+                    out.append(item & 0x7f)
+                    out.append(item >> 7)
+                    out += INT
+                elif 0 <= item < 2**31:
+                    out += b128(item)
+                    out += INT
+                else:
+                    self.sendToken(item)
+            elif t is bytes:
+                if item in vocab or len(item) >= LARGE_WRITE:
+                    self.sendToken(item)
+                else:
+                    self.maybeVocabizeString(item)
+                    out += b128(len(item))
+                    out += STRING
+                    out += item
+            elif t is float:
+                out += FLOAT
+                out += pack(item)
+            elif item is None:
+                openID = self.sendOpen()
+                self.sendToken(b"none")
+                self.sendClose(openID)
+            else:
+                openID = self.sendOpen()
+                self.sendToken(b"boolean")
+                out += small[int(item)]
+                out += INT
+                self.sendClose(openID)
+
     def maybeVocabizeString(self, string):
-        # TODO: keep track of the last 30 strings we've send in full. If this
-        # string appears more than 3 times on that list, create a vocab item
-        # for it. Make sure we don't start using the vocab number until the
-        # ADDVOCAB token has been queued.
-        if False:
-            self.addToOutgoingVocabulary(string)
+        # Keep a bounded, LRU-ordered count of the strings we've sent in
+        # full. Once a string has been sent vocabizeThreshold times, schedule
+        # an (add-vocab) for it. addToOutgoingVocabulary() takes care of not
+        # using the vocab number until the (add-vocab) has been serialized.
+        if not self.adaptiveVocabulary:
+            return
+        if (len(string) < self.minVocabizeLength
+            or len(string) > self.maxVocabizeLength):
+            return
+        if self.vocabReplacementPending:
+            return
+        if string in self.pendingVocabAdditions:
+            return
+        candidates = self.vocabCandidates
+        count = candidates.pop(string, 0) + 1
+        if count < self.vocabizeThreshold:
+            candidates[string] = count
+            if len(candidates) > self.maxVocabCandidates:
+                candidates.popitem(last=False)
+            return
+        self.vocabPromotions += 1
+        if len(self.adaptiveVocabUses) >= self.maxAdaptiveVocabulary:
+            self.evictOutgoingVocabulary(string)
+            return
+        self.adaptiveVocabUses[string] = 0
+        self.addToOutgoingVocabulary(string)
+
+    def evictOutgoingVocabulary(self, string):
+        # The adaptive part of the VOCAB table is full. Replace the whole
+        # table with one that holds everything we didn't promote ourselves
+        # (the initial vocab table, and anything added by higher-level
+        # code), the more popular half of the promoted strings, those whose
+        # (add-vocab) has not been sent yet, and the new string. This is
+        # sent as a single (set-vocab) sequence, which also lets us
+        # renumber the survivors compactly.
+        uses = self.adaptiveVocabUses
+        byIndex = sorted(self.outgoingVocabulary.items(),
+                         key=lambda item: item[1])
+        fixed = [s for (s, index) in byIndex if s not in uses]
+        popular = sorted(uses, key=uses.get, reverse=True)
+        keep = [s for s in popular[:self.maxAdaptiveVocabulary // 2]
+                if s != string]
+        # halve the surviving counts, so that strings which used to be
+        # popular eventually make room for the ones that are popular now
+        newUses = dict([(s, uses[s] // 2) for s in keep])
+        newUses[string] = 0
+        # these are still on their way. Their (add-vocab)s are ahead of the
+        # (set-vocab) in the CONTROL lane, so it would wipe them out unless
+        # it holds them too
+        pending = sorted([s for s in self.pendingVocabAdditions
+                          if s not in newUses])
+        for s in pending:
+            if s in uses:
+                newUses[s] = uses[s]
+        self.adaptiveVocabUses = newUses
+        self.vocabReplacements += 1
+        self.vocabReplacementPending = True
+        d = self.setOutgoingVocabulary(fixed + keep + pending + [string])
+        def _done(res):
+            self.vocabReplacementPending = False
+        d.addBoth(_done)
 
     def sendClose(self, openID):
-        int2b128(openID, self.transport.write)
-        self.transport.write(CLOSE)
+        self.writeOutput(b128(openID) + CLOSE)
 
     def sendAbort(self, count=0):
-        int2b128(count, self.transport.write)
-        self.transport.write(ABORT)
+        self.writeOutput(b128(count) + ABORT)
 
     def sendError(self, msg):
         if not self.transport:
@@ -520,11 +936,11 @@ class Banana(protocol.Protocol):
         msg = six.ensure_binary(msg)
         if len(msg) > SIZE_LIMIT:
             msg = msg[:SIZE_LIMIT-10] + "..."
-        int2b128(len(msg), self.transport.write)
-        self.transport.write(ERROR)
-        self.transport.write(msg)
+        self.writeOutput(b128(len(msg)) + ERROR)
+        self.writeOutput(msg)
+        self.flushOutput()
         # now you should drop the connection
-        self.transport.loseConnection()
+        self.loseConnection()
 
     def sendFailed(self, f):
         # call this if an exception is raised in transmission. The Failure
@@ -535,7 +951,8 @@ class Banana(protocol.Protocol):
         log.err(f)
         try:
             if self.transport:
-                self.transport.loseConnection()
+                self.flushOutput()
+                self.loseConnection()
         except:
             print("exception during transport.loseConnection")
             log.err()
@@ -551,6 +968,7 @@ class Banana(protocol.Protocol):
 
     unslicerClass = RootUnslicer
     debugReceive = False
+    maxIncomingVocabulary = 10000 # the far end can't make us hold more
     logViolations = False
     logReceiveErrors = True
     useKeepalives = False
@@ -558,6 +976,7 @@ class Banana(protocol.Protocol):
     keepaliveTimer = None
     disconnectTimeout = None
     disconnectTimer = None
+    referencesResolved = 0 # lets ArgumentUnslicer notice shared references
 
     def initReceive(self):
         self.inOpen = False # set during the Index Phase of an OPEN sequence
@@ -568,16 +987,24 @@ class Banana(protocol.Protocol):
         # self.buffer with the inbound negotiation block.
         self.negotiated = False
         self.connectionAbandoned = False
-        self.buffer = stringchain.StringChain()
+        self.buffer = receivebuffer.ReceiveBuffer()
+        self.bytesWanted = 0 # don't re-parse until this much has arrived
 
         self.incomingVocabulary = {} # bytes->int
         self.skipBytes = 0 # used to discard a single long token
+        self.spool = None # receives the body of a single long token
+        self.spoolBytes = 0 # how much more of it is coming
         self.discardCount = 0 # used to discard non-primitive objects
         self.exploded = None # last-ditch error catcher
 
     def initUnslicer(self):
         self.rootUnslicer = self.unslicerClass(self)
         self.receiveStack = [self.rootUnslicer]
+        # index into receiveStack of the outermost unslicer that holds
+        # references, or None. Every scope on the stack used to store a copy
+        # of each object, but only the outermost one can outlive the others,
+        # so it is the only one we need to ask.
+        self.scopeDepth = 0 if self.rootUnslicer.referenceScope else None
         self.objectCounter = 0
         self.objects = {}
 
@@ -592,13 +1019,14 @@ class Banana(protocol.Protocol):
                 print(" %s" % s)
 
     def setObject(self, count, obj):
-        for i in range(len(self.receiveStack)-1, -1, -1):
-            self.receiveStack[i].setObject(count, obj)
+        if self.scopeDepth is not None:
+            self.receiveStack[self.scopeDepth].setObject(count, obj)
 
     def getObject(self, count):
-        for i in range(len(self.receiveStack)-1, -1, -1):
-            obj = self.receiveStack[i].getObject(count)
+        if self.scopeDepth is not None:
+            obj = self.receiveStack[self.scopeDepth].getObject(count)
             if obj is not None:
+                self.referencesResolved += 1
                 return obj
         raise ValueError("dangling reference '%d'" % count)
 
@@ -609,12 +1037,17 @@ class Banana(protocol.Protocol):
         for k,v in vocabDict.items():
             assert isinstance(k, int)
             assert isinstance(v, bytes)
+        if len(vocabDict) > self.maxIncomingVocabulary:
+            raise BananaError("incoming vocab table is too large")
         self.incomingVocabulary = vocabDict
 
     def addIncomingVocabulary(self, key, value):
         # called in response to an OPEN(add-vocab) sequence
         assert isinstance(key, int)
         assert isinstance(value, bytes)
+        if (key not in self.incomingVocabulary
+            and len(self.incomingVocabulary) >= self.maxIncomingVocabulary):
+            raise BananaError("incoming vocab table is full")
         self.incomingVocabulary[key] = value
 
     def dataReceived(self, chunk):
@@ -623,25 +1056,68 @@ class Banana(protocol.Protocol):
         if self.useKeepalives:
             self.dataLastReceivedAt = time.time()
         try:
-            self.handleData(chunk)
-        except Exception as e:
-            if isinstance(e, BananaError):
-                # only reveal the reason if it is a protocol error
-                e.where = self.describeReceive()
-                msg = str(e) # send them the text of the error
+            if self.streamCompression is None:
+                self.handleData(chunk)
             else:
-                msg = ("exception while processing data, more "
-                       "information in the logfiles")
-                if not self.logReceiveErrors:
-                    msg += ", except that self.logReceiveErrors=False"
-                    msg += ", sucks to be you"
-            self.sendError(msg)
-            self.connectionAbandoned = True
-            self.reportReceiveError(Failure())
+                for data in self.streamCompression.decompress(chunk):
+                    self.handleData(data)
+        except Exception as e:
+            self.receiveFailed(e)
+
+    def receiveFailed(self, e):
+        # this must be called from inside an 'except' clause
+        if isinstance(e, BananaError):
+            # only reveal the reason if it is a protocol error
+            e.where = self.describeReceive()
+            msg = str(e) # send them the text of the error
+        else:
+            msg = ("exception while processing data, more "
+                   "information in the logfiles")
+            if not self.logReceiveErrors:
+                msg += ", except that self.logReceiveErrors=False"
+                msg += ", sucks to be you"
+        self.sendError(msg)
+        self.connectionAbandoned = True
+        self.reportReceiveError(Failure())
+
+    # Inbound flow control: while receiving is paused, inbound data is kept
+    # in self.buffer without being parsed, and (if the transport allows it)
+    # the transport stops reading from the socket, so the peer will
+    # eventually stop sending.
+    receivePaused = False
+    canPauseTransport = False
+    maxReceiveBuffer = None # bytes held while paused, None=unlimited
+
+    def pauseReceiving(self):
+        if self.receivePaused:
+            return
+        self.receivePaused = True
+        if self.canPauseTransport:
+            self.transport.pauseProducing()
+
+    def resumeReceiving(self):
+        if not self.receivePaused:
+            return
+        self.receivePaused = False
+        if self.useKeepalives:
+            # the silence while we were paused was our own doing
+            self.dataLastReceivedAt = time.time()
+        if self.connectionAbandoned:
+            return
+        if self.canPauseTransport:
+            self.transport.resumeProducing()
+        # parse whatever arrived before the transport stopped reading
+        try:
+            self.handleData(b"")
+        except Exception as e:
+            self.receiveFailed(e)
 
     def keepaliveTimerFired(self):
         self.keepaliveTimer = None
         age = time.time() - self.dataLastReceivedAt
+        if self.receivePaused:
+            # we stopped reading, so their silence tells us nothing
+            age = 0
         if age > self.keepaliveTimeout:
             # the connection looks idle, so let's provoke a response
             self.sendPING()
@@ -653,6 +1129,9 @@ class Banana(protocol.Protocol):
     def disconnectTimerFired(self):
         self.disconnectTimer = None
         age = time.time() - self.dataLastReceivedAt
+        if self.receivePaused:
+            # we stopped reading, so their silence tells us nothing
+            age = 0
         if age > self.disconnectTimeout:
             # the connection looks dead, so drop it
             log.msg("disconnectTimeout, no data for %d seconds" % age)
@@ -705,40 +1184,62 @@ class Banana(protocol.Protocol):
             # skip part of the chunk, and stop skipping
             chunk = chunk[self.skipBytes:]
             self.skipBytes = 0
-        self.buffer.append(chunk)
+        buf = self.buffer
+        buf.append(chunk)
+        if self.receivePaused:
+            if (self.maxReceiveBuffer is not None
+                and len(buf) > self.maxReceiveBuffer):
+                raise BananaError("receive buffer overflow: %d bytes held "
+                                  "while paused" % len(buf))
+            return
+        if self.spool is not None and not self.fillSpool():
+            return
+        if len(buf) < self.bytesWanted:
+            # we're still waiting for the body of a token whose header has
+            # already been parsed and checked, so don't bother parsing it
+            # again until the whole thing is here
+            return
+        self.bytesWanted = 0
 
         # Loop through the available input data, extracting one token per
-        # pass.
-
-        while len(self.buffer):
-            first65 = self.buffer.popleft(65)
-            pos = 0
-            for ch in six.iterbytes(first65):
-                if ch >= 0x80:
+        # pass. The header is parsed in place: nothing is copied out of the
+        # buffer until the whole token is available.
+
+        sinkTop = sink = None
+        while len(buf) and not self.receivePaused:
+            # Containers of primitives get a fast path, which handles runs
+            # of simple tokens and leaves everything else to this loop.
+            top = self.receiveStack[-1]
+            if top is not sinkTop:
+                sinkTop = top
+                sink = None
+                if not self.debugReceive:
+                    sink = top.primitiveSink()
+            if sink is not None and not self.inOpen and not self.discardCount:
+                self.receivePrimitives(*sink)
+                if not len(buf):
                     break
-                pos = pos + 1
-                if pos > 64:
+
+            pos = buf.find_high_bit(65)
+            if pos == -1:
+                if len(buf) > 64:
                     # drop the connection. We log more of the buffer, but not
                     # all of it, to make it harder for someone to spam our
                     # logs.
-                    s = first65 + self.buffer.popleft(200)
+                    s = buf.peek(265)
                     raise BananaError("token prefix is limited to 64 bytes: "
                                       "but got %r" % s)
-            else:
                 # we've run out of buffer without seeing the high bit, which
                 # means we're still waiting for header to finish
-                self.buffer.appendleft(first65)
                 return
             assert pos <= 64
 
             # At this point, the header and type byte have been received.
             # The body may or may not be complete.
 
-            typebyte = first65[pos:pos+1] # byte
-            if pos:
-                header = b1282int(first65[:pos])
-            else:
-                header = 0
+            typebyte = buf.byte_at(pos) # byte
+            header = buf.header_value(pos)
+            hlen = pos + 1
 
             # rejected is set as soon as a violation is detected. It
             # indicates that this single token will be rejected.
@@ -806,7 +1307,7 @@ class Banana(protocol.Protocol):
                 # them with extreme prejudice.
                 raise BananaError("oversized ERROR token")
 
-            self.buffer.appendleft(first65[pos+1:])
+            buf.skip(hlen)
 
             # determine what kind of token it is. Each clause finishes in
             # one of four ways:
@@ -884,14 +1385,15 @@ class Banana(protocol.Protocol):
 
             elif typebyte == ERROR:
                 strlen = header
-                if len(self.buffer) >= strlen:
+                if len(buf) >= strlen:
                     # the whole string is available
-                    obj = self.buffer.popleft(strlen)
+                    obj = buf.popleft(strlen)
                     # handleError must drop the connection
                     self.handleError(obj)
                     return
                 else:
-                    self.buffer.appendleft(first65[:pos+1])
+                    buf.rewind(hlen)
+                    self.bytesWanted = hlen + strlen
                     return # there is more to come
 
             elif typebyte == LIST:
@@ -901,9 +1403,20 @@ class Banana(protocol.Protocol):
 
             elif typebyte == STRING:
                 strlen = header
-                if len(self.buffer) >= strlen:
-                    # the whole string is available
-                    obj = self.buffer.popleft(strlen)
+                spool = None
+                if not rejected and not self.inOpen:
+                    spool = self.receiveStack[-1].openStringSpool(strlen)
+                if spool is not None:
+                    # the body goes to the spool as it arrives
+                    self.spool = spool
+                    self.spoolBytes = strlen
+                    if not self.fillSpool():
+                        return # there is more to come
+                    continue
+                if len(buf) >= strlen:
+                    # the whole string is available. This is the only copy
+                    # made of the body.
+                    obj = buf.popleft(strlen)
                     # although it might be rejected
                 else:
                     # there is more to come
@@ -912,10 +1425,11 @@ class Banana(protocol.Protocol):
                         # dropped
                         if self.debugReceive:
                             print("DROPPED some string bits")
-                        self.skipBytes = strlen - len(self.buffer)
-                        self.buffer.clear()
+                        self.skipBytes = strlen - len(buf)
+                        buf.clear()
                     else:
-                        self.buffer.appendleft(first65[:pos+1])
+                        buf.rewind(hlen)
+                        self.bytesWanted = hlen + strlen
                     return
 
             elif typebyte == INT:
@@ -926,9 +1440,9 @@ class Banana(protocol.Protocol):
                 obj = int(-int(header))
             elif typebyte == LONGINT or typebyte == LONGNEG:
                 strlen = header
-                if len(self.buffer) >= strlen:
+                if len(buf) >= strlen:
                     # the whole number is available
-                    obj = bytes_to_long(self.buffer.popleft(strlen))
+                    obj = bytes_to_long(buf.popleft(strlen))
                     if typebyte == LONGNEG:
                         obj = -obj
                     # although it might be rejected
@@ -937,25 +1451,31 @@ class Banana(protocol.Protocol):
                     if rejected:
                         # drop all we have and note how much more should be
                         # dropped
-                        self.skipBytes = strlen - len(self.buffer)
-                        self.buffer.clear()
+                        self.skipBytes = strlen - len(buf)
+                        buf.clear()
                     else:
-                        self.buffer.appendleft(first65[:pos+1])
+                        buf.rewind(hlen)
+                        self.bytesWanted = hlen + strlen
                     return
 
             elif typebyte == VOCAB:
                 obj = self.incomingVocabulary[header] # yieds bytes
+                if not rejected and not self.inOpen:
+                    spool = self.receiveStack[-1].openStringSpool(len(obj))
+                    if spool is not None:
+                        spool.write(obj)
+                        obj = self._closeSpool(spool)
                 # TODO: bail if expanded string is too big
                 # this actually means doing self.checkToken(VOCAB, len(obj))
                 # but we have to make sure we handle the rejection properly
 
             elif typebyte == FLOAT:
-                if len(self.buffer) >= 8:
-                    obj = struct.unpack("!d", self.buffer.popleft(8))[0]
+                if len(buf) >= 8:
+                    obj = struct.unpack("!d", buf.popleft(8))[0]
                 else:
                     # this case is easier than STRING, because it is only 8
                     # bytes. We don't bother skipping anything.
-                    self.buffer.appendleft(first65[:pos+1])
+                    buf.rewind(hlen)
                     return
 
             elif typebyte == PING:
@@ -985,10 +1505,95 @@ class Banana(protocol.Protocol):
 
             # while loop ends here
 
-        # note: this is redundant, as there are no 'break' statements in that
-        # loop, and the loop exit condition is 'while len(self.buffer)'
-        self.buffer.clear()
-
+        # if receiving was paused (by something a token triggered), the
+        # rest of the buffer waits for resumeReceiving(). Otherwise this is
+        # redundant, as the only 'break' statement is taken when the buffer
+        # is empty.
+        if not self.receivePaused:
+            buf.clear()
+
+
+    def fillSpool(self):
+        """Move as much of the buffer as belongs to the token being spooled
+        into its spool. Once the body is complete, deliver the spool in its
+        place and return True."""
+        buf = self.buffer
+        take = min(len(buf), self.spoolBytes)
+        while take:
+            # don't copy more than a piece at a time out of the buffer
+            piece = min(take, 1024*1024)
+            self.spool.write(buf.popleft(piece))
+            self.spoolBytes -= piece
+            take -= piece
+        if self.spoolBytes:
+            return False
+        spool, self.spool = self.spool, None
+        self.handleToken(self._closeSpool(spool))
+        return True
+
+    def _closeSpool(self, spool):
+        if getattr(spool, "seekable", lambda: False)():
+            spool.seek(0)
+        return spool
+
+    def receivePrimitives(self, receive, check):
+        """Decode complete INT, NEG, STRING, VOCAB, and FLOAT tokens from the
+        front of the receive buffer, handing each one to receive(). Stop
+        (leaving the token in the buffer for handleData to deal with) at
+        anything else: other token types, incomplete tokens, long headers or
+        strings, unknown VOCAB indices, or a token which check() rejects."""
+        buf = self.buffer
+        data, pos = buf.raw()
+        end = len(data)
+        vocab = self.incomingVocabulary
+        typebytes = _PRIMITIVE_TYPEBYTES
+        unpack = _DOUBLE.unpack_from
+        i_INT, i_NEG, i_STRING, i_VOCAB = INT[0], NEG[0], STRING[0], VOCAB[0]
+        done = pos
+        try:
+            while pos < end:
+                # headers are little-endian base-128, ending at the first
+                # byte with the high bit set. We only handle up to 4 bytes.
+                value = 0
+                shift = 0
+                b = data[pos]
+                while b < 0x80 and shift < 28:
+                    value |= b << shift
+                    shift += 7
+                    pos += 1
+                    if pos == end:
+                        return
+                    b = data[pos]
+                if b not in typebytes:
+                    return
+                pos += 1
+                if b == i_INT:
+                    obj = value
+                elif b == i_NEG:
+                    obj = -value
+                elif b == i_STRING:
+                    if value > MAX_BULK_STRING or pos + value > end:
+                        return
+                    obj = bytes(data[pos:pos+value])
+                    pos += value
+                elif b == i_VOCAB:
+                    obj = vocab.get(value)
+                    if obj is None:
+                        return
+                else: # FLOAT
+                    if pos + 8 > end:
+                        return
+                    obj = unpack(data, pos)[0]
+                    pos += 8
+                if check is not None:
+                    try:
+                        check(typebytes[b], value)
+                    except Violation:
+                        return
+                receive(obj)
+                done = pos
+        finally:
+            buf.seek(done)
 
     def handleOpen(self, openCount, objectCount, indexToken):
         indexToken = six.ensure_str(indexToken)
@@ -1020,6 +1625,8 @@ class Banana(protocol.Protocol):
         child.openCount = openCount
         child.parent = top
         self.receiveStack.append(child)
+        if self.scopeDepth is None and child.referenceScope:
+            self.scopeDepth = len(self.receiveStack) - 1
         try:
             child.start(objectCount)
         except Violation:
@@ -1085,6 +1692,8 @@ class Banana(protocol.Protocol):
             return
 
         self.receiveStack.pop()
+        if self.scopeDepth == len(self.receiveStack):
+            self.scopeDepth = None
 
         # now deliver the object to the parent
         self.handleToken(obj, ready_deferred)
@@ -1135,6 +1744,8 @@ class Banana(protocol.Protocol):
             inClose = False
 
             old = self.receiveStack.pop()
+            if self.scopeDepth == len(self.receiveStack):
+                self.scopeDepth = None
 
             try:
                 # TODO: if handleClose encountered a Violation in .finish,
@@ -1155,7 +1766,7 @@ class Banana(protocol.Protocol):
 
     def handleError(self, msg):
         log.msg("got banana ERROR from remote side: %s" % msg)
-        self.transport.loseConnection()
+        self.loseConnection()
 
 
     def describeReceive(self):
@@ -0,0 +1,10 @@
+"""
+foolscap.bench: measure how fast Foolscap is
+
+Run 'python -m foolscap.bench' to measure serialization, remote calls,
+connection establishment, and logging on this machine. The results are
+written as JSON, so that runs on different releases of Foolscap can be
+compared mechanically.
+
+Nothing in here is used by the rest of Foolscap.
+"""
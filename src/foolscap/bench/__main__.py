@@ -0,0 +1,10 @@
+import sys
+if "--asyncio" in sys.argv:
+    # this must happen before anything imports the default reactor, so it
+    # cannot wait for cli.Options to see the flag
+    from twisted.internet import asyncioreactor
+    asyncioreactor.install()
+
+from foolscap.bench.cli import run_bench
+
+sys.exit(run_bench())
@@ -0,0 +1,101 @@
+# -*- test-case-name: foolscap.test.test_bench -*-
+
+import sys, json, time, platform
+from twisted.python import usage
+from twisted.internet import defer, task
+
+import foolscap
+from foolscap.bench import serialization, rpc, flog, coroutines
+
+# name, function, arguments for a full run, arguments for --quick
+GROUPS = [
+    ("serialization", serialization.run,
+     {"size": 100000, "hugeSize": 10**7, "mintime": 1.0},
+     {"size": 10000, "hugeSize": 10**6, "mintime": 0.1}),
+    ("rpc", rpc.run,
+     {"calls": 2000, "connections": 20, "payloadSize": 1000},
+     {"calls": 200, "connections": 3, "payloadSize": 100}),
+    ("logging", flog.run,
+     {"events": 10000, "mintime": 1.0},
+     {"events": 1000, "mintime": 0.1}),
+    ("asyncio", coroutines.run,
+     {"calls": 2000},
+     {"calls": 200}),
+    ]
+
+class Options(usage.Options):
+    synopsis = "Usage: python -m foolscap.bench [options]"
+
+    optFlags = [
+        ("quick", "q", "Use small payloads and short runs (less accurate)"),
+        ("asyncio", None, "Run on the asyncio reactor"),
+        ]
+    optParameters = [
+        ("output", "o", None, "Write the JSON results to this file"),
+        ("only", None, None,
+         "Comma-separated list of groups to run: "
+         + ",".join([g[0] for g in GROUPS])),
+        ]
+
+    def postOptions(self):
+        names = [g[0] for g in GROUPS]
+        if self["only"]:
+            groups = self["only"].split(",")
+            for name in groups:
+                if name not in names:
+                    raise usage.UsageError("unknown group '%s'" % name)
+            self.groups = groups
+        else:
+            self.groups = names
+
+    def opt_help(self):
+        print(str(self))
+        sys.exit(0)
+
+def describeEnvironment():
+    from twisted import copyright
+    return {"foolscap_version": foolscap.__version__,
+            "twisted_version": copyright.version,
+            "python_version": platform.python_version(),
+            "python_implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            }
+
+@defer.inlineCallbacks
+def runBenchmarks(groups, quick=False, stderr=sys.stderr):
+    """Run the named groups of benchmarks, and return a Deferred that fires
+    with a JSON-able dict of the results."""
+    report = describeEnvironment()
+    report["quick"] = bool(quick)
+    report["results"] = results = []
+    for (name, run, full, small) in GROUPS:
+        if name not in groups:
+            continue
+        print("running %s benchmarks.." % name, file=stderr)
+        results.extend((yield run(**(small if quick else full))))
+    defer.returnValue(report)
+
+def run_bench(argv=None, stdout=sys.stdout, stderr=sys.stderr):
+    if argv is None:
+        argv = sys.argv
+    config = Options()
+    try:
+        config.parseOptions(argv[1:])
+    except usage.UsageError as e:
+        print(str(config), file=stderr)
+        print("%s: %s" % (argv[0], e), file=stderr)
+        return 1
+
+    def _go(reactor):
+        d = runBenchmarks(config.groups, config["quick"], stderr)
+        d.addCallback(_write)
+        return d
+    def _write(report):
+        data = json.dumps(report, indent=1, sort_keys=True)
+        if config["output"]:
+            with open(config["output"], "w") as f:
+                f.write(data + "\n")
+        else:
+            print(data, file=stdout)
+    task.react(_go)
@@ -0,0 +1,76 @@
+# -*- test-case-name: foolscap.test.test_bench -*-
+
+import time, asyncio
+from twisted.internet import defer
+from foolscap.api import Referenceable, runAsTask
+from foolscap import aio
+from foolscap.bench.rpc import makeTub, timeCalls
+from foolscap.bench.timing import summarizeLatencies
+
+class Target(Referenceable):
+    def remote_echo(self, obj):
+        return obj
+    async def remote_async_echo(self, obj):
+        return obj
+    @runAsTask
+    async def remote_task_echo(self, obj):
+        return obj
+
+async def _awaitCalls(call, count, latencies):
+    for i in range(count):
+        t = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - t)
+
+@defer.inlineCallbacks
+def timeAwaitedCalls(name, call, count, inTask=False):
+    # like timeCalls, but the caller is a coroutine. 'call' returns
+    # something that coroutine can await.
+    latencies = []
+    start = time.perf_counter()
+    coro = _awaitCalls(call, count, latencies)
+    if inTask:
+        yield defer.Deferred.fromFuture(asyncio.ensure_future(coro))
+    else:
+        yield defer.Deferred.fromCoroutine(coro)
+    elapsed = time.perf_counter() - start
+    defer.returnValue(summarizeLatencies(name, latencies, elapsed))
+
+@defer.inlineCallbacks
+def run(calls=2000):
+    """Compare the cost of a remote call made or answered by a coroutine
+    with the plain Deferred path. The asyncio.future and asyncio.task_target
+    measurements need asyncio Tasks, so they are only made when running on
+    the asyncio reactor ('python -m foolscap.bench --asyncio'). Returns a
+    Deferred that fires with a list of results."""
+    results = []
+    server = makeTub()
+    client = makeTub()
+    try:
+        furl = server.registerReference(Target())
+        rref = yield client.getReference(furl)
+        # the asyncio reactor does not start its loop until after the
+        # callWhenRunning calls, so don't look for it any earlier than this
+        try:
+            asyncio.get_running_loop()
+            haveLoop = True
+        except RuntimeError:
+            haveLoop = False
+        results.append((yield timeCalls("asyncio.deferred.echo", rref,
+                                        calls, "echo", 1)))
+        results.append((yield timeCalls("asyncio.coroutine_target.echo",
+                                        rref, calls, "async_echo", 1)))
+        results.append((yield timeAwaitedCalls(
+            "asyncio.await.echo",
+            lambda: rref.callRemote("echo", 1), calls)))
+        if haveLoop:
+            results.append((yield timeAwaitedCalls(
+                "asyncio.future.echo",
+                lambda: aio.callRemote(rref, "echo", 1), calls,
+                inTask=True)))
+            results.append((yield timeCalls("asyncio.task_target.echo",
+                                            rref, calls, "task_echo", 1)))
+    finally:
+        yield defer.gatherResults([server.stopService(),
+                                   client.stopService()])
+    defer.returnValue(results)
@@ -0,0 +1,43 @@
+# -*- test-case-name: foolscap.test.test_bench -*-
+
+from io import BytesIO
+from twisted.internet import defer
+from foolscap.logging.log import FoolscapLogger
+from foolscap.logging import flogfile
+from foolscap.bench.timing import measure, summarize
+
+def run(events=10000, mintime=1.0):
+    """Measure how quickly log events can be recorded, and written to a
+    flogfile."""
+    results = []
+
+    def _record():
+        logger = FoolscapLogger()
+        for i in range(events):
+            logger.msg("event %d of %d", i, events, facility="bench")
+    times = measure(_record, mintime)
+    results.append(summarize("logging.msg", times, ops=events))
+
+    def _parented():
+        logger = FoolscapLogger()
+        parent = logger.msg("starting")
+        for i in range(events):
+            logger.msg(format="step %(step)d", step=i, parent=parent)
+    times = measure(_parented, mintime)
+    results.append(summarize("logging.msg_format", times, ops=events))
+
+    # this is what a log gatherer does with every event it receives
+    logger = FoolscapLogger()
+    for i in range(events):
+        logger.msg("event %d of %d", i, events, facility="bench")
+    # the logger only keeps the most recent ones
+    evs = list(logger.get_buffered_events())
+    evs = (evs * (events // len(evs) + 1))[:events]
+    def _write():
+        f = BytesIO()
+        for ev in evs:
+            flogfile.serialize_wrapper(f, ev, from_="bench", rx_time=0)
+        return f
+    times = measure(_write, mintime)
+    results.append(summarize("logging.flogfile_write", times, ops=len(evs)))
+    return defer.succeed(results)
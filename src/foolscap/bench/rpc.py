@@ -0,0 +1,116 @@
+# -*- test-case-name: foolscap.test.test_bench -*-
+
+import time
+from twisted.internet import defer
+from foolscap.api import Tub, Referenceable
+from foolscap.util import allocate_tcp_port
+from foolscap.bench.timing import summarizeLatencies
+from foolscap.bench.serialization import records
+
+class Target(Referenceable):
+    def remote_echo(self, obj):
+        return obj
+    def remote_fail(self):
+        raise ValueError("this call always fails")
+
+def makeTub():
+    tub = Tub()
+    tub.startService()
+    portnum = allocate_tcp_port()
+    tub.listenOn("tcp:%d:interface=127.0.0.1" % portnum)
+    tub.setLocation("tcp:127.0.0.1:%d" % portnum)
+    return tub
+
+@defer.inlineCallbacks
+def timeCalls(name, rref, count, methname, *args):
+    # one call at a time, so each latency is a full round trip
+    latencies = []
+    failures = []
+    start = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        # CopiedFailures cannot be thrown into a generator, so catch them
+        # before they get that far
+        d = rref.callRemote(methname, *args)
+        d.addErrback(failures.append)
+        yield d
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    defer.returnValue(summarizeLatencies(name, latencies, elapsed,
+                                         failures=len(failures)))
+
+@defer.inlineCallbacks
+def timePipelinedCalls(name, rref, count, window, methname, *args):
+    # keep 'window' calls outstanding at all times
+    latencies = []
+    started = [0]
+    def _startOne():
+        if started[0] >= count:
+            return None
+        started[0] += 1
+        t = time.perf_counter()
+        d = rref.callRemote(methname, *args)
+        def _done(res):
+            latencies.append(time.perf_counter() - t)
+            return _startOne()
+        d.addCallback(_done)
+        return d
+    start = time.perf_counter()
+    yield defer.gatherResults([_startOne()
+                               for i in range(min(window, count))])
+    elapsed = time.perf_counter() - start
+    defer.returnValue(summarizeLatencies(name, latencies, elapsed,
+                                         window=window))
+
+@defer.inlineCallbacks
+def timeConnections(name, furl, count):
+    # the client Tubs are made ahead of time, because most of the cost of a
+    # new Tub is generating its key
+    clients = [makeTub() for i in range(count)]
+    latencies = []
+    start = time.perf_counter()
+    try:
+        for client in clients:
+            t = time.perf_counter()
+            rref = yield client.getReference(furl)
+            yield rref.callRemote("echo", 0)
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+    finally:
+        yield defer.gatherResults([c.stopService() for c in clients])
+    defer.returnValue(summarizeLatencies(name, latencies, elapsed))
+
+@defer.inlineCallbacks
+def run(calls=2000, connections=20, payloadSize=1000):
+    """Measure remote calls over a loopback connection and over localhost
+    TCP, and how quickly new connections can be made. Returns a Deferred
+    that fires with a list of results."""
+    results = []
+    server = makeTub()
+    client = makeTub()
+    try:
+        furl = server.registerReference(Target())
+
+        rref = yield server.getReference(furl) # connects to itself
+        results.append((yield timeCalls("rpc.loopback.echo_small", rref,
+                                        calls, "echo", 1)))
+
+        rref = yield client.getReference(furl)
+        results.append((yield timeCalls("rpc.tcp.echo_small", rref,
+                                        calls, "echo", 1)))
+        payload = records(payloadSize)
+        results.append((yield timeCalls("rpc.tcp.echo_records", rref,
+                                        max(calls // 10, 1), "echo",
+                                        payload)))
+        results.append((yield timePipelinedCalls("rpc.tcp.echo_pipelined",
+                                                 rref, calls, 50, "echo", 1)))
+        # the Failure is serialized and raised again at this end
+        results.append((yield timeCalls("rpc.tcp.failure", rref,
+                                        max(calls // 10, 1), "fail")))
+
+        results.append((yield timeConnections("connect.tcp", furl,
+                                              connections)))
+    finally:
+        yield defer.gatherResults([server.stopService(),
+                                   client.stopService()])
+    defer.returnValue(results)
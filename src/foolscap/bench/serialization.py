@@ -0,0 +1,102 @@
+# -*- test-case-name: foolscap.test.test_bench -*-
+
+from twisted.internet import defer
+from foolscap import storage
+from foolscap.copyable import Copyable, RemoteCopy
+from foolscap.bench.timing import measure, summarize
+
+class Record(Copyable, RemoteCopy):
+    # storage.unserialize() rejects copyable names that are longer than the
+    # longest opentype it knows about, so keep this short
+    typeToCopy = copytype = "bench.record"
+
+    def __init__(self, name=None, number=None):
+        self.name = name
+        self.number = number
+
+# each of these returns a payload. 'size' scales it, and is about the number
+# of leaf objects inside
+
+def ints(size):
+    return list(range(size))
+
+def records(size):
+    return [{b"name": b"user-%d" % i, b"id": i, b"score": i / 7.0,
+             b"tags": [b"alpha", b"beta"], b"active": bool(i % 2)}
+            for i in range(size // 10)]
+
+def deep_dict(size):
+    depth = 50
+    top = node = {}
+    for i in range(depth):
+        child = {}
+        for j in range(size // depth // 2):
+            node[b"key-%d" % j] = j
+        node[b"child"] = child
+        node = child
+    return top
+
+def unicode(size):
+    return [u"naïve café ☃ #%d" % i for i in range(size // 10)]
+
+def copyables(size):
+    return [Record(u"record %d" % i, i) for i in range(size // 10)]
+
+PAYLOADS = [("ints", ints),
+            ("records", records),
+            ("deep_dict", deep_dict),
+            ("unicode", unicode),
+            ("copyables", copyables),
+            ]
+
+def decodeInChunks(data, chunksize):
+    # deliver the bytes the way a socket would, to exercise the receive
+    # buffer
+    b = storage.SynchronousStorageBanana()
+    b.initUnslicer()
+    for i in range(0, len(data), chunksize):
+        b.dataReceived(data[i:i+chunksize])
+    return b.results[0][0]
+
+def serializeWithDeferreds(obj):
+    results = []
+    d = storage.serialize(obj)
+    d.addBoth(results.append)
+    return results[0]
+
+def run(size=100000, hugeSize=10**7, mintime=1.0):
+    """Measure encoding and decoding of each payload, and return a list of
+    results."""
+    results = []
+    for name, make in PAYLOADS:
+        obj = make(size)
+        data = storage.serializeSync(obj)
+        times = measure(lambda: storage.serializeSync(obj), mintime)
+        results.append(summarize("serialization.encode.%s" % name, times,
+                                 bytes=len(data)))
+        times = measure(lambda: storage.unserializeSync(data), mintime)
+        results.append(summarize("serialization.decode.%s" % name, times,
+                                 bytes=len(data)))
+
+    # the Deferred-based API, for comparison with the synchronous one
+    obj = records(size)
+    times = measure(lambda: serializeWithDeferreds(obj), mintime)
+    results.append(summarize("serialization.encode_deferred.records", times))
+
+    # one small record at a time, like a cache would store them
+    obj = records(10)[0]
+    times = measure(lambda: storage.serializeSync(obj), mintime,
+                    maxrounds=100000)
+    results.append(summarize("serialization.encode.one_record", times))
+    data = storage.serializeSync(obj)
+    times = measure(lambda: storage.unserializeSync(data), mintime,
+                    maxrounds=100000)
+    results.append(summarize("serialization.decode.one_record", times))
+
+    # only containers may appear at the top level
+    data = storage.serializeSync([b"a" * hugeSize])
+    times = measure(lambda: decodeInChunks(data, 4096), mintime)
+    results.append(summarize("serialization.decode.huge_string", times,
+                             bytes=len(data),
+                             bytes_per_sec=len(data) / min(times)))
+    return defer.succeed(results)
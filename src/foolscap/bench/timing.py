@@ -0,0 +1,58 @@
+# -*- test-case-name: foolscap.test.test_bench -*-
+
+import time
+
+def measure(func, mintime=1.0, maxrounds=1000):
+    """Call func() repeatedly, for at least 'mintime' seconds (and at least
+    three times) but no more than 'maxrounds' times. Return a list of how
+    long each call took, in seconds."""
+    times = []
+    elapsed = 0.0
+    while (elapsed < mintime or len(times) < 3) and len(times) < maxrounds:
+        start = time.perf_counter()
+        func()
+        t = time.perf_counter() - start
+        times.append(t)
+        elapsed += t
+    return times
+
+def percentile(samples, fraction):
+    """Return the sample below which 'fraction' of the samples lie, picking
+    the nearest one rather than interpolating."""
+    ordered = sorted(samples)
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+def summarize(name, times, ops=1, **extra):
+    """Build the JSON-able result for a benchmark which ran the same
+    operation 'ops' times in each of the given rounds. The best round is
+    the one we report as the rate: the others were disturbed by something
+    else on the machine."""
+    best = min(times)
+    result = {"name": name,
+              "rounds": len(times),
+              "ops_per_round": ops,
+              "best_s": best,
+              "median_s": percentile(times, 0.5),
+              "ops_per_sec": ops / best if best else None,
+              }
+    result.update(extra)
+    return result
+
+def summarizeLatencies(name, latencies, elapsed, **extra):
+    """Build the JSON-able result for a benchmark which timed each of a
+    series of operations (like remote calls) separately."""
+    result = {"name": name,
+              "ops": len(latencies),
+              "elapsed_s": elapsed,
+              "ops_per_sec": len(latencies) / elapsed if elapsed else None,
+              "latency_ms": {
+                  "min": 1e3 * min(latencies),
+                  "p50": 1e3 * percentile(latencies, 0.50),
+                  "p90": 1e3 * percentile(latencies, 0.90),
+                  "p99": 1e3 * percentile(latencies, 0.99),
+                  "max": 1e3 * max(latencies),
+                  },
+              }
+    result.update(extra)
+    return result
@@ -3,7 +3,8 @@
 # This module is responsible for the per-connection Broker object
 
 import six
-import types, time
+import types, time, inspect
+from collections import deque
 from itertools import count
 
 from zope.interface import implementer
@@ -14,11 +15,15 @@ from twisted.internet.protocol import connectionDone
 
 from foolscap import banana, tokens, ipb, vocab
 from foolscap import call, slicer, referenceable, copyable, remoteinterface
+from foolscap import streaming
 from foolscap.constraint import Any
 from foolscap.tokens import Violation, BananaError
 from foolscap.ipb import DeadReferenceError, IBroker
 from foolscap.slicers.root import RootSlicer, RootUnslicer, ScopedRootSlicer
+from foolscap.slicers.root import CONTROL, INTERACTIVE
+from foolscap.slicers.vocab import ReplaceVocabUnslicer, AddVocabUnslicer
 from foolscap.eventual import eventually
+from foolscap.executors import callRemoteMethod
 from foolscap.logging import log
 from functools import reduce
 
@@ -33,6 +38,28 @@ PBTopRegistry = {
     ("call",): call.CallUnslicer,
     ("answer",): call.AnswerUnslicer,
     ("error",): call.ErrorUnslicer,
+    ("cancel",): call.CancelUnslicer,
+    # peers which negotiate version 5 or later may send these
+    ("batch",): call.BatchUnslicer,
+    ("batch-answer",): call.BatchAnswerUnslicer,
+    # and version 6 or later may send these
+    ("retain-answer",): call.RetainAnswerUnslicer,
+    ("release-answer",): call.ReleaseAnswerUnslicer,
+    ("pipelined-call",): call.PipelinedCallUnslicer,
+    # and version 7 or later may send these
+    ("stream-items",): streaming.StreamItemsUnslicer,
+    ("stream-end",): streaming.StreamEndUnslicer,
+    ("stream-credit",): streaming.StreamCreditUnslicer,
+    # and version 8 or later may send these
+    ("byte-stream-data",): streaming.ByteStreamDataUnslicer,
+    ("byte-stream-end",): streaming.ByteStreamEndUnslicer,
+    ("byte-stream-abort",): streaming.ByteStreamAbortUnslicer,
+    ("byte-stream-credit",): streaming.ByteStreamCreditUnslicer,
+    ("byte-stream-cancel",): streaming.ByteStreamCancelUnslicer,
+    # peers which negotiate version 4 or later may send these at any time,
+    # to maintain an adaptive vocabulary
+    ("set-vocab",): ReplaceVocabUnslicer,
+    ("add-vocab",): AddVocabUnslicer,
     }
 
 PBOpenRegistry = {
@@ -40,6 +67,7 @@ PBOpenRegistry = {
     ('my-reference',): referenceable.ReferenceUnslicer,
     ('your-reference',): referenceable.YourReferenceUnslicer,
     ('their-reference',): referenceable.TheirReferenceUnslicer,
+    ('byte-stream',): streaming.ByteStreamUnslicer,
     # ('copyable', classname) is handled inline, through the CopyableRegistry
     }
 
@@ -102,6 +130,8 @@ class PBRootUnslicer(RootUnslicer):
     def receiveChild(self, token, ready_deferred):
         if isinstance(token, call.InboundDelivery):
             self.broker.scheduleCall(token, ready_deferred)
+        elif isinstance(token, call.InboundBatch):
+            self.broker.scheduleBatch(token)
 
 
 
@@ -153,6 +183,19 @@ class Broker(banana.Banana, referenceable.Referenceable):
     startingTLS = False
     startedTLS = False
     use_remote_broker = True
+    maxInboundCalls = None # remote_ methods running at once, None=unlimited
+    sendQueueFailFast = False # callRemote raises SendQueueFullError
+    # stop reading once this many inbound calls are waiting to start, or
+    # are waiting to be answered. None means unlimited.
+    maxQueuedCalls = None
+    maxUnansweredCalls = None
+    acceptsBatches = False # the far end understands (batch) sequences
+    acceptsPipelining = False # and (pipelined-call)
+    acceptsStreams = False # and (stream-items)
+    streamWindow = 100 # see Tub option "stream-window"
+    acceptsByteStreams = False # and (byte-stream) arguments
+    byteStreamWindow = 1024*1024 # see Tub option "byte-stream-window"
+    decrefBatchSize = 1000 # most decref (or decgift) calls in one batch
 
     def __init__(self, remote_tubref, params={},
                  keepaliveTimeout=None, disconnectTimeout=None,
@@ -167,6 +210,26 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if vocab_table_index:
             table = vocab.INITIAL_VOCAB_TABLES[vocab_table_index]
             self.populateVocabTable(table)
+        if (self._banana_decision_version is not None
+            and self._banana_decision_version >= 4):
+            # the far end will accept (add-vocab) at any time
+            self.adaptiveVocabulary = True
+        if (self._banana_decision_version is not None
+            and self._banana_decision_version >= 5):
+            # the far end understands (batch) and (batch-answer)
+            self.acceptsBatches = True
+        if (self._banana_decision_version is not None
+            and self._banana_decision_version >= 6):
+            # and (retain-answer), (pipelined-call), and (release-answer)
+            self.acceptsPipelining = True
+        if (self._banana_decision_version is not None
+            and self._banana_decision_version >= 7):
+            # and streamed answers
+            self.acceptsStreams = True
+        if (self._banana_decision_version is not None
+            and self._banana_decision_version >= 8):
+            # and streamed arguments
+            self.acceptsByteStreams = True
         self.initBroker()
         self.current_slave_IR = params.get('current-slave-IR')
         self.current_seqnum = params.get('current-seqnum')
@@ -183,6 +246,10 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # receiving side uses these
         self.yourReferenceByCLID = {}
         self.yourReferenceByURL = {}
+        # decrefs and decgifts wait here until the end of the turn, so a
+        # pile of them can be sent as one batch
+        self.pendingDecrefs = [] # (tracker, count)
+        self.pendingDecgifts = {} # maps giftID to count
 
         # tracking Gifts
         self.nextGiftID = count(1)
@@ -199,15 +266,41 @@ class Broker(banana.Banana, referenceable.Referenceable):
         self._connectionLostWatchers = []
 
         # receiving side uses these
-        self.inboundDeliveryQueue = []
+        self.inboundDeliveryQueue = deque()
         self._waiting_for_call_to_be_ready = False
+        self._dispatchScheduled = False
+        self.inboundCallsRunning = 0 # started, but not yet answered
         self.activeLocalCalls = {} # the other side wants an answer from us
+        self.retainedAnswers = {} # maps reqID to call.RetainedAnswer
+
+        # streamed arguments, by stream ID
+        self.nextByteStreamID = count(1)
+        self.outboundByteStreams = {} # we are sending these
+        self.inboundByteStreams = {} # and receiving these
+        self.inboundPauses = 0 # how often the backlog made us stop reading
+        self.inboundCancels = 0 # calls abandoned because the caller said so
+        self.inboundPausedTime = 0.0 # seconds spent not reading, in total
+        self._inboundPausedAt = None
 
     def setTub(self, tub):
         assert ipb.ITub.providedBy(tub)
         self.tub = tub
         self.unsafeTracebacks = tub.unsafeTracebacks
         self._expose_remote_exception_types = tub._expose_remote_exception_types
+        self.maxAdaptiveVocabulary = tub.adaptiveVocabularySize
+        self.maxInboundCalls = tub.maxInboundCalls
+        self.sendQueueHighWater = tub.sendQueueHighWater
+        self.sendQueueLowWater = tub.sendQueueLowWater
+        self.sendQueueHighWaterBytes = tub.sendQueueHighWaterBytes
+        self.sendQueueLowWaterBytes = tub.sendQueueLowWaterBytes
+        self.sendQueueFailFast = tub.sendQueueFailFast
+        self.maxQueuedCalls = tub.maxQueuedCalls
+        self.maxUnansweredCalls = tub.maxUnansweredCalls
+        self.maxReceiveBuffer = tub.maxReceiveBuffer
+        self.streamWindow = tub.streamWindow
+        self.byteStreamWindow = tub.byteStreamWindow
+        if not tub.adaptiveVocabularySize:
+            self.adaptiveVocabulary = False
         if tub.debugBanana:
             self.debugSend = True
             self.debugReceive = True
@@ -247,8 +340,9 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if not fireDisconnectWatchers:
             self.disconnectWatchers = []
         self.finish(why)
+        self.flushOutput()
         # loseConnection eventually provokes connectionLost()
-        self.transport.loseConnection()
+        self.loseConnection()
 
     def connectionLost(self, why):
         tubid = "?"
@@ -277,6 +371,8 @@ class Broker(banana.Banana, referenceable.Referenceable):
         self.disconnected = True
         self.remote_broker = None
         self.abandonAllRequests(why)
+        self.abandonAllByteStreams(why)
+        self.stopAllAnswerStreams()
         # TODO: why reset all the tables to something useable? There may be
         # outstanding RemoteReferences that point to us, but I don't see why
         # that requires all these empty dictionaries.
@@ -386,41 +482,59 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if not self.remote_broker: # tests do not set this up
             self.freeYourReferenceTracker(None, tracker)
             return
-        try:
-            rb = self.remote_broker
-            # TODO: do we want callRemoteOnly here? is there a way we can
-            # avoid wanting to know when the decref has completed? Only if we
-            # send the interface list and URL on every occurrence of the
-            # my-reference sequence. Either A) we use callRemote("decref")
-            # and wait until the ack to free the tracker, or B) we use
-            # callRemoteOnly("decref") and free the tracker right away. In
-            # case B, the far end has no way to know that we've just freed
-            # the tracker and will therefore forget about everything they
-            # told us (including the interface list), so they cannot
-            # accurately do anything special on the "first" send of this
-            # reference. Which means that if we do B, we must either send
-            # that extra information on every my-reference sequence, or do
-            # without it, or make it optional, or retrieve it separately, or
-            # something.
-
-            # rb.callRemoteOnly("decref", clid=tracker.clid, count=count)
-            # self.freeYourReferenceTracker('bogus', tracker)
-            # return
-
-            d = rb.callRemote("decref", clid=tracker.clid, count=count)
-            # if the connection was lost before we can get an ack, we're
-            # tearing this down anyway
-            def _ignore_loss(f):
-                f.trap(DeadReferenceError, *LOST_CONNECTION_ERRORS)
-                return None
-            d.addErrback(_ignore_loss)
-            # once the ack comes back, or if we know we'll never get one,
-            # release the tracker
-            d.addCallback(self.freeYourReferenceTracker, tracker)
-        except:
-            f = failure.Failure()
-            log.msg("failure during freeRemoteReference", facility="foolscap",
-                    level=log.UNUSUAL, failure=f)
+        if not self.pendingDecrefs:
+            eventually(self._sendDecrefs)
+        self.pendingDecrefs.append((tracker, count))
+
+    def _sendDecrefs(self):
+        pending, self.pendingDecrefs = self.pendingDecrefs, []
+        rb = self.remote_broker
+        if not rb:
+            # the connection was lost in the meantime
+            for (tracker, refcount) in pending:
+                self.freeYourReferenceTracker(None, tracker)
+            return
+        # if the connection was lost before we can get an ack, we're
+        # tearing this down anyway
+        def _ignore_loss(f):
+            f.trap(DeadReferenceError, *LOST_CONNECTION_ERRORS)
+            return None
+        # TODO: do we want callRemoteOnly here? is there a way we can
+        # avoid wanting to know when the decref has completed? Only if we
+        # send the interface list and URL on every occurrence of the
+        # my-reference sequence. Either A) we use callRemote("decref")
+        # and wait until the ack to free the tracker, or B) we use
+        # callRemoteOnly("decref") and free the tracker right away. In
+        # case B, the far end has no way to know that we've just freed
+        # the tracker and will therefore forget about everything they
+        # told us (including the interface list), so they cannot
+        # accurately do anything special on the "first" send of this
+        # reference. Which means that if we do B, we must either send
+        # that extra information on every my-reference sequence, or do
+        # without it, or make it optional, or retrieve it separately, or
+        # something.
+
+        # rb.callRemoteOnly("decref", clid=tracker.clid, count=count)
+        # self.freeYourReferenceTracker('bogus', tracker)
+        # return
+
+        for i in range(0, len(pending), self.decrefBatchSize):
+            try:
+                # a peer which does not understand batches gets the calls
+                # one at a time
+                batch = rb.startBatch()
+                for (tracker, refcount) in pending[i:i+self.decrefBatchSize]:
+                    d = batch.callRemote("decref", clid=tracker.clid,
+                                         count=refcount)
+                    d.addErrback(_ignore_loss)
+                    # once the ack comes back, or if we know we'll never get
+                    # one, release the tracker
+                    d.addCallback(self.freeYourReferenceTracker, tracker)
+                batch.send(priority=CONTROL)
+            except:
+                f = failure.Failure()
+                log.msg("failure during freeRemoteReference",
+                        facility="foolscap", level=log.UNUSUAL, failure=f)
 
     def freeYourReferenceTracker(self, res, tracker):
         if tracker.received_count != 0:
@@ -477,6 +591,38 @@ class Broker(banana.Banana, referenceable.Referenceable):
             self.myGifts[i] = (rref, giftID, 1)
         return giftID
 
+    def freeGift(self, giftID):
+        # the far end of this connection gave us a gift, which we have now
+        # claimed, so they no longer need to hold it for us
+        if not self.pendingDecgifts:
+            eventually(self._sendDecgifts)
+        self.pendingDecgifts[giftID] = self.pendingDecgifts.get(giftID, 0) + 1
+
+    def _sendDecgifts(self):
+        pending, self.pendingDecgifts = self.pendingDecgifts, {}
+        rb = self.remote_broker
+        if not rb:
+            return # if we lose the connection, they'll decref the gift anyway
+        pending = list(pending.items())
+        if not self.acceptsBatches:
+            # nobody waits for a decgift, so don't make them answer one
+            for (giftID, giftcount) in pending:
+                rb.callRemoteOnly("decgift", giftID=giftID, count=giftcount,
+                                  _priority=CONTROL)
+            return
+        for i in range(0, len(pending), self.decrefBatchSize):
+            try:
+                batch = rb.startBatch()
+                for (giftID, giftcount) in pending[i:i+self.decrefBatchSize]:
+                    d = batch.callRemote("decgift", giftID=giftID,
+                                         count=giftcount)
+                    d.addErrback(lambda f: None) # nobody is waiting for it
+                batch.send(priority=CONTROL)
+            except:
+                f = failure.Failure()
+                log.msg("failure during freeGift", facility="foolscap",
+                        level=log.UNUSUAL, failure=f)
+
     def remote_decgift(self, giftID, count):
         broker, clid = self.myGiftsByGiftID[giftID]
         rref, giftID, gift_count = self.myGifts[(broker, clid)]
@@ -509,10 +655,28 @@ class Broker(banana.Banana, referenceable.Referenceable):
     def addRequest(self, req):
         req.broker = self
         self.waitingForAnswers[req.reqID] = req
+        if self.receivePaused:
+            # the answer would wait behind the calls we are holding back,
+            # and one of those might be the method that is waiting for it
+            eventually(self._maybeResumeReceiving)
 
     def removeRequest(self, req):
         del self.waitingForAnswers[req.reqID]
 
+    def cancelRequest(self, reqID):
+        # the caller has given up on this request. If the call has not
+        # started to be sent, we just drop it, otherwise we ask the far end
+        # to abandon it.
+        queue = self.rootSlicer.sendQueue
+        for entry in queue:
+            obj = entry[0]
+            if (isinstance(obj, (call.CallSlicer, call.BatchSlicer))
+                and obj.reqID == reqID):
+                queue.remove(entry)
+                return
+        if not self.disconnected:
+            self.send(call.CancelSlicer(reqID), CONTROL)
+
     def getRequest(self, reqID):
         # invoked by AnswerUnslicer and ErrorUnslicer
         try:
@@ -534,6 +698,81 @@ class Broker(banana.Banana, referenceable.Referenceable):
                 why = failure.Failure(e)
             eventually(req.fail, why)
 
+    def abandonAllByteStreams(self, why):
+        for stream in list(self.outboundByteStreams.values()):
+            stream.stop()
+        self.outboundByteStreams = {}
+        tubid = None
+        if self.remote_tubref:
+            tubid = self.remote_tubref.getShortTubID()
+        for stream in list(self.inboundByteStreams.values()):
+            f = why
+            if why.check(*LOST_CONNECTION_ERRORS):
+                e = DeadReferenceError("Connection was lost", tubid)
+                f = failure.Failure(e)
+            eventually(stream._fail, f, False)
+
+    def stopAllAnswerStreams(self):
+        # a streamed answer which is waiting for credit would never notice
+        # that the connection has gone, so close its iterator now
+        for delivery in list(self.activeLocalCalls.values()):
+            stream = getattr(delivery, "stream", None)
+            if stream is not None:
+                stream.stop()
+
+    # streamed arguments: the sending side
+
+    def startByteStream(self, source):
+        # called by ByteSourceSlicer, while the call is being serialized.
+        # The data is sent after the rest of the call.
+        streamID = next(self.nextByteStreamID)
+        stream = streaming.OutboundByteStream(self, streamID, source)
+        self.outboundByteStreams[streamID] = stream
+        stream.start()
+        return streamID
+
+    def addByteStreamCredit(self, streamID, count):
+        stream = self.outboundByteStreams.get(streamID)
+        if stream is not None:
+            stream.addCredit(count)
+
+    def stopByteStream(self, streamID):
+        # the receiver has given up on it, or the connection is gone
+        stream = self.outboundByteStreams.pop(streamID, None)
+        if stream is not None:
+            stream.stop()
+
+    def byteStreamSent(self, streamID):
+        self.outboundByteStreams.pop(streamID, None)
+
+    # and the receiving side
+
+    def openByteStream(self, streamID, maxLength):
+        if streamID in self.inboundByteStreams:
+            raise BananaError("duplicate byte-stream ID %d" % streamID)
+        stream = streaming.IncomingByteStream(self, streamID,
+                                              self.byteStreamWindow,
+                                              maxLength)
+        self.inboundByteStreams[streamID] = stream
+        return stream
+
+    def getByteStream(self, streamID):
+        stream = self.inboundByteStreams.get(streamID)
+        if stream is None and not self.disconnected:
+            # we gave up on it, or the call that announced it was rejected:
+            # either way, the sender should stop
+            self.send(streaming.ByteStreamCancelSlicer(streamID), CONTROL)
+        return stream
+
+    def closeByteStream(self, streamID):
+        self.inboundByteStreams.pop(streamID, None)
+
+    def stopReceivingByteStream(self, streamID):
+        if self.inboundByteStreams.pop(streamID, None) is None:
+            return
+        if not self.disconnected:
+            self.send(streaming.ByteStreamCancelSlicer(streamID), CONTROL)
+
     # target-side, invoked by CallUnslicer
 
     def getRemoteInterfaceByName(self, riname):
@@ -550,41 +789,186 @@ class Broker(banana.Banana, referenceable.Referenceable):
                 return m
         return None
 
+    def scheduleBatch(self, batch):
+        # each call is queued and started on its own, but they share a
+        # single answer
+        self.activeLocalCalls[batch.reqID] = batch
+        for (delivery, ready_deferred) in batch.calls:
+            self.scheduleCall(delivery, ready_deferred)
+
     def scheduleCall(self, delivery, ready_deferred):
+        if delivery.reqID != 0 and not delivery.batch:
+            # replaces the CallUnslicer, see cancelInboundCall()
+            self.activeLocalCalls[delivery.reqID] = delivery
+        record = delivery.pipelinedOn
+        if record is not None:
+            if not record.resolved:
+                # _resolveRetained() will bring it back
+                record.waiting.append( (delivery, ready_deferred) )
+            else:
+                self._deliverPipelined(delivery, ready_deferred, record)
+            return
         self.inboundDeliveryQueue.append( (delivery,ready_deferred) )
-        eventually(self.doNextCall)
-
-    def doNextCall(self):
-        if self.disconnected:
+        self._scheduleDispatch()
+        if (not self.receivePaused and not self.waitingForAnswers
+            and self._inboundBacklogIsFull()):
+            # this stops handleData() before it parses the next token
+            self.pauseReceiving()
+
+    def retainAnswer(self, reqID):
+        # the caller is about to send calls to the result of reqID
+        self.retainedAnswers[reqID] = call.RetainedAnswer(reqID)
+
+    def releaseAnswer(self, reqID):
+        # the caller has the answer, so anything pipelined on it has arrived
+        record = self.retainedAnswers.pop(reqID, None)
+        if record is not None and not record.resolved:
+            # only possible if the call never got here
+            f = failure.Failure(Violation("the answer to request %d was "
+                                          "released before it was known"
+                                          % reqID))
+            self._resolveRetained(record, f)
+
+    def _resolveRetained(self, record, result):
+        for (delivery, ready_deferred) in record.resolve(result):
+            self._deliverPipelined(delivery, ready_deferred, record)
+
+    def _deliverPipelined(self, delivery, ready_deferred, record):
+        if delivery.cancelled:
             return
-        if self._waiting_for_call_to_be_ready:
+        if record.failure:
+            # the calls fail the same way
+            self.callFailed(record.failure, delivery.reqID, delivery)
             return
-        if not self.inboundDeliveryQueue:
+        try:
+            delivery.setTarget(record)
+        except Violation:
+            self.callFailed(failure.Failure(), delivery.reqID, delivery)
             return
-        delivery, ready_deferred = self.inboundDeliveryQueue.pop(0)
-        self._waiting_for_call_to_be_ready = True
-        if not ready_deferred:
-            ready_deferred = defer.succeed(None)
-        d = ready_deferred
-
-        def _ready(res):
-            self._waiting_for_call_to_be_ready = False
+        self.scheduleCall(delivery, ready_deferred)
+
+    def _callResolved(self, reqID, result):
+        record = self.retainedAnswers.get(reqID)
+        if record is not None and not record.resolved:
+            self._resolveRetained(record, result)
+
+    def cancelInboundCall(self, reqID):
+        # the caller has given up on this call, and will discard any
+        # answer, so we don't send one. If the remote_ method has not been
+        # started yet, it never will be. If it returned a Deferred, that is
+        # cancelled.
+        delivery = self.activeLocalCalls.pop(reqID, None)
+        if delivery is None:
+            return # already answered, or never seen
+        self.inboundCancels += 1
+        self._callResolved(reqID, failure.Failure(defer.CancelledError()))
+        if isinstance(delivery, call.InboundBatch):
+            for (d, ready_deferred) in delivery.calls:
+                self._cancelDelivery(d)
+        else:
+            self._cancelDelivery(delivery)
+
+    def _cancelDelivery(self, delivery):
+        delivery.cancelled = True
+        delivery.cancelByteStreams()
+        for entry in self.inboundDeliveryQueue:
+            if entry[0] is delivery:
+                self.inboundDeliveryQueue.remove(entry)
+                self._maybeResumeReceiving()
+                return
+        if delivery.running is not None:
+            delivery.running.cancel()
+        if delivery.stream is not None:
+            delivery.stream.stop()
+
+    def _inboundBacklogIsFull(self):
+        return ((self.maxQueuedCalls is not None
+                 and len(self.inboundDeliveryQueue) >= self.maxQueuedCalls)
+                or (self.maxUnansweredCalls is not None
+                    and len(self.activeLocalCalls) >= self.maxUnansweredCalls))
+
+    def _inboundBacklogHasDrained(self):
+        # we resume at half the limits, rather than pausing and resuming
+        # for every call
+        return ((self.maxQueuedCalls is None
+                 or len(self.inboundDeliveryQueue) <= self.maxQueuedCalls // 2)
+                and (self.maxUnansweredCalls is None
+                     or (len(self.activeLocalCalls)
+                         <= self.maxUnansweredCalls // 2)))
+
+    def _maybeResumeReceiving(self):
+        # we keep reading while we wait for answers, see addRequest()
+        if (self.receivePaused and not self.disconnected
+            and (self.waitingForAnswers
+                 or self._inboundBacklogHasDrained())):
+            self.resumeReceiving()
+
+    def pauseReceiving(self):
+        if not self.receivePaused:
+            self.inboundPauses += 1
+            self._inboundPausedAt = time.time()
+        banana.Banana.pauseReceiving(self)
+
+    def resumeReceiving(self):
+        if self.receivePaused:
+            self.inboundPausedTime += time.time() - self._inboundPausedAt
+            self._inboundPausedAt = None
+        banana.Banana.resumeReceiving(self)
+
+    def _scheduleDispatch(self):
+        # one doNextCall() per turn is enough, however many calls arrived
+        if not self._dispatchScheduled:
+            self._dispatchScheduled = True
             eventually(self.doNextCall)
-            return res
-        d.addBoth(_ready)
 
+    def doNextCall(self):
+        # start every delivery that is ready, in the order they arrived. A
+        # delivery whose ready_deferred has not yet fired (because it is
+        # waiting for a gift, say) holds up the ones behind it, as does
+        # reaching maxInboundCalls.
+        self._dispatchScheduled = False
+        queue = self.inboundDeliveryQueue
+        while queue:
+            if self.disconnected:
+                return
+            if self._waiting_for_call_to_be_ready:
+                break
+            if (self.maxInboundCalls is not None
+                and self.inboundCallsRunning >= self.maxInboundCalls):
+                break # _inboundCallDone() will bring us back
+            delivery, ready_deferred = queue.popleft()
+            if ready_deferred:
+                self._waiting_for_call_to_be_ready = True
+                ready_deferred.addBoth(self._callIsReady)
+            else:
+                ready_deferred = defer.succeed(None)
+            self._startCall(delivery, ready_deferred)
+        self._maybeResumeReceiving()
+
+    def _callIsReady(self, res):
+        self._waiting_for_call_to_be_ready = False
+        self._scheduleDispatch()
+        return res
+
+    def _startCall(self, delivery, d):
         # at this point, the Deferred chain for this one delivery runs
         # independently of any other, and methods which take a long time to
-        # complete will not hold up other methods. We must call _doCall and
-        # let the remote_ method get control before we process any other
-        # message, but the eventually() above insures we'll have a chance to
-        # do that before we give up control.
-
+        # complete will not hold up other methods. If 'd' has already fired,
+        # _doCall gives the remote_ method control right now, before
+        # doNextCall() looks at the next delivery. If not, doNextCall() will
+        # not start anything else until it does.
+        self.inboundCallsRunning += 1
         d.addCallback(lambda res: self._doCall(delivery))
         d.addCallback(self._callFinished, delivery)
         d.addErrback(self.callFailed, delivery.reqID, delivery)
         d.addErrback(log.err)
-        return None
+        d.addBoth(self._inboundCallDone)
+
+    def _inboundCallDone(self, res):
+        self.inboundCallsRunning -= 1
+        if self.inboundDeliveryQueue:
+            self._scheduleDispatch()
+        self._maybeResumeReceiving()
 
     def _doCall(self, delivery):
         # our ordering rules require that the order in which each
@@ -592,17 +976,18 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # in which the original caller invoked callRemote(). To insure this,
         # _startCall() is not allowed to insert additional delays before it
         # runs doRemoteCall() on the target object.
+        if delivery.cancelled:
+            return None # nobody is waiting for the answer
         obj = delivery.obj
         args = delivery.allargs.args
         kwargs = delivery.allargs.kwargs
         for i in args + list(kwargs.values()):
             assert not isinstance(i, defer.Deferred)
 
-        if delivery.methodSchema:
-            # we asked about each argument on the way in, but ask again so
-            # they can look for missing arguments. TODO: see if we can remove
-            # the redundant per-argument checks.
-            delivery.methodSchema.checkAllArgs(args, kwargs, True)
+        # we asked about each argument on the way in, but ask again so they
+        # can look for missing arguments, and check anything the tokens
+        # couldn't tell them
+        delivery.allargs.checkArguments()
 
         # interesting case: if the method completes successfully, but
         # our schema prohibits us from sending the result (perhaps the
@@ -612,33 +997,51 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # attached to the object that caused it
         if delivery.methodname is None:
             assert callable(obj)
-            return obj(*args, **kwargs)
+            res = callRemoteMethod(obj, args, kwargs)
         else:
             obj = ipb.IRemotelyCallable(obj)
-            return obj.doRemoteCall(delivery.methodname, args, kwargs)
+            res = obj.doRemoteCall(delivery.methodname, args, kwargs)
+        if inspect.iscoroutine(res):
+            # an 'async def' method. This runs it up to its first await
+            # right away, and it may await Deferreds (but not asyncio
+            # futures: use @runAsTask for those)
+            res = defer.Deferred.fromCoroutine(res)
+        if isinstance(res, defer.Deferred):
+            # so cancelInboundCall() can cancel it
+            delivery.running = res
+        return res
 
 
     def _callFinished(self, res, delivery):
         reqID = delivery.reqID
-        if reqID == 0:
+        if reqID == 0 or delivery.cancelled:
             return
-        methodSchema = delivery.methodSchema
         assert self.activeLocalCalls[reqID]
+        if streaming.isStream(res):
+            if delivery.batch or not self.acceptsStreams:
+                # send it all at once
+                d = streaming.collectStream(res)
+                d.addCallback(self._callFinished, delivery)
+                return d
+            self._callResolved(reqID, res) # not something to call
+            # this may raise Violation, if the schema says it isn't a stream
+            delivery.stream = streaming.OutboundStream(self, delivery, res)
+            delivery.stream.start()
+            return
+        self._checkResults(res, delivery) # may raise Violation
+        if delivery.batch:
+            self._batchCallDone(delivery, True, res)
+            return
+        self._callResolved(reqID, res)
         methodName = None
-        if methodSchema:
-            methodName = methodSchema.name
-            try:
-                methodSchema.checkResults(res, False) # may raise Violation
-            except Violation as v:
-                v.prependLocation("in return value of %s.%s" %
-                                  (delivery.obj, methodSchema.name))
-                raise
+        if delivery.methodSchema:
+            methodName = delivery.methodSchema.name
 
         answer = call.AnswerSlicer(reqID, res, methodName)
         # once the answer has started transmitting, any exceptions must be
         # logged and dropped, and not turned into an Error to be sent.
         try:
-            self.send(answer)
+            self.send(answer, self.getAnswerPriority(delivery))
             # TODO: .send should return a Deferred that fires when the last
             # byte has been queued, and we should delete the local note then
         except:
@@ -647,21 +1050,77 @@ class Broker(banana.Banana, referenceable.Referenceable):
                     facility="foolscap", level=log.UNUSUAL, failure=f)
         del self.activeLocalCalls[reqID]
 
+    def getAnswerPriority(self, delivery):
+        # answers (and streamed items) are sent with the priority that our
+        # RemoteInterface gives the method: the caller's _priority= does
+        # not travel with the call
+        if delivery is None:
+            return INTERACTIVE
+        return getattr(delivery.methodSchema, "priority", None) or INTERACTIVE
+
+    def addStreamCredit(self, reqID, count):
+        # the caller has read some of a streamed answer
+        delivery = self.activeLocalCalls.get(reqID)
+        stream = getattr(delivery, "stream", None)
+        if stream is not None:
+            stream.addCredit(count)
+
+    def streamFinished(self, delivery):
+        del self.activeLocalCalls[delivery.reqID]
+        self._maybeResumeReceiving()
+
+    def _checkResults(self, res, delivery):
+        methodSchema = delivery.methodSchema
+        if methodSchema:
+            try:
+                methodSchema.checkResults(res, False) # may raise Violation
+            except Violation as v:
+                v.prependLocation("in return value of %s.%s" %
+                                  (delivery.obj, methodSchema.name))
+                raise
+
     def callFailed(self, f, reqID, delivery=None):
         # this may be called either when an inbound schema is violated, or
         # when the method is run and raises an exception. If a Violation is
         # raised after we receive the reqID but before we've actually invoked
         # the method, we are called by CallUnslicer.reportViolation and don't
         # get a delivery= argument.
+        if delivery and delivery.cancelled:
+            return # probably a CancelledError, and nobody is listening
         if delivery:
+            delivery.cancelByteStreams()
             if (self.tub and self.tub.logLocalFailures) or not self.tub:
                 # the 'not self.tub' case is for unit tests
                 delivery.logFailure(f)
+        if delivery and delivery.batch:
+            self._batchCallDone(delivery, False, f)
+            return
         if reqID != 0:
             assert self.activeLocalCalls[reqID]
-            self.send(call.ErrorSlicer(reqID, f))
+            self._callResolved(reqID, f)
+            # a streamed answer ends with the error, so it must follow the
+            # items already in the stream's flow
+            stream = getattr(delivery, "stream", None)
+            self.send(call.ErrorSlicer(reqID, f),
+                      self.getAnswerPriority(delivery),
+                      stream.flow if stream else None)
             del self.activeLocalCalls[reqID]
 
+    def _batchCallDone(self, delivery, ok, res):
+        batch = delivery.batch
+        if not batch.addResult(delivery, ok, res):
+            return # still waiting for the others
+        if self.activeLocalCalls.get(batch.reqID) is not batch:
+            return # cancelled
+        answer = call.BatchAnswerSlicer(batch.reqID, batch.results)
+        try:
+            self.send(answer)
+        except:
+            f = failure.Failure()
+            log.msg("Broker._batchCallDone unable to send",
+                    facility="foolscap", level=log.UNUSUAL, failure=f)
+        del self.activeLocalCalls[batch.reqID]
+
 class StorageBrokerRootSlicer(ScopedRootSlicer):
     # each StorageBroker is a single serialization domain, so we inherit from
     # ScopedRootSlicer
@@ -680,6 +1139,7 @@ class StorageBrokerRootUnslicer(PBRootUnslicer):
 
     openRegistries = [slicer.UnslicerRegistry, PBStorageOpenRegistry]
     topRegistries = openRegistries
+    referenceScope = True
 
     def __init__(self, protocol):
         PBRootUnslicer.__init__(self, protocol)
@@ -755,7 +1215,7 @@ class LoopbackTransport(object):
     def write(self, bytes):
         eventually(self.peer.dataReceived, bytes)
     def writeSequence(self, iovec):
-        self.write(''.join(iovec))
+        self.write(b''.join(iovec))
 
     def dataReceived(self, data):
         if self.connected:
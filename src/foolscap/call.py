@@ -2,9 +2,9 @@ import six
 from twisted.python import failure, reflect, log as twlog
 from twisted.internet import defer
 
-from foolscap import copyable, slicer, tokens
+from foolscap import copyable, slicer, tokens, ipb
 from foolscap.copyable import AttributeDictConstraint
-from foolscap.constraint import ByteStringConstraint
+from foolscap.constraint import ByteStringConstraint, SpooledStringConstraint
 from foolscap.slicers.list import ListConstraint
 from .tokens import BananaError, Violation
 from foolscap.util import AsyncAND
@@ -35,12 +35,14 @@ class PendingRequest(object):
     # this object is a local representation of a message we have sent to
     # someone else, that will be executed on their end.
     active = True
+    cancelled = False
+    stream = None # a streaming.AnswerStream, once one has started
 
     def __init__(self, reqID, rref, interface_name, method_name):
         self.reqID = reqID
         self.rref = rref # keep it alive
         self.broker = None # if set, the broker knows about us
-        self.deferred = defer.Deferred()
+        self.deferred = defer.Deferred(self._cancel)
         self.constraint = None # this constrains the results
         self.failure = None
         self.interface_name = interface_name # for error messages
@@ -52,7 +54,33 @@ class PendingRequest(object):
     def getMethodNameInfo(self):
         return (self.interface_name, self.method_name)
 
+    def _cancel(self, d):
+        # the caller has given up (maybe because of a _timeout=), and the
+        # Deferred will errback with CancelledError as soon as we return.
+        # The far end is asked to abandon the call. If its answer was
+        # already on the way, it will be discarded like one for any other
+        # unknown reqID.
+        if not self.active:
+            return
+        self.active = False
+        self.cancelled = True
+        if self.broker:
+            self.broker.removeRequest(self)
+            self.broker.cancelRequest(self.reqID)
+
+    def finishStream(self):
+        if self.broker:
+            self.broker.removeRequest(self)
+        self.active = False
+        self.stream._finish()
+
+    def cancelStream(self):
+        # like _cancel(), for a stream whose Deferred has already fired
+        self._cancel(None)
+
     def complete(self, res):
+        if self.cancelled:
+            return
         if self.broker:
             self.broker.removeRequest(self)
         if self.active:
@@ -62,6 +90,8 @@ class PendingRequest(object):
             log.msg("PendingRequest.complete called on an inactive request")
 
     def fail(self, why):
+        if self.cancelled:
+            return
         if self.active:
             if self.broker:
                 self.broker.removeRequest(self)
@@ -92,7 +122,11 @@ class PendingRequest(object):
                 log.msg(" the REMOTE failure was:", failure=why,
                         level=log.NOISY, parent=lp)
                 #log.msg(stack, level=log.NOISY, parent=lp)
-            self.deferred.errback(why)
+            if self.stream is not None:
+                # our Deferred has already fired with the stream
+                self.stream._finish(why)
+            else:
+                self.deferred.errback(why)
         else:
             log.msg("WEIRD: fail() on an inactive request", traceback=True)
             if self.failure:
@@ -147,6 +181,27 @@ class CallSlicer(slicer.ScopedSlicer):
     def describe(self):
         return "<call-%s-%s-%s>" % (self.reqID, self.clid, self.methodname)
 
+class BatchSlicer(slicer.ScopedSlicer):
+    # several calls to the same object, answered with a single
+    # ('batch-answer'). 'calls' is a list of (methodname, args, kwargs).
+    opentype = ('batch',)
+
+    def __init__(self, reqID, clid, calls):
+        slicer.ScopedSlicer.__init__(self, None)
+        self.reqID = reqID
+        self.clid = clid
+        self.calls = calls
+
+    def sliceBody(self, streamable, banana):
+        yield self.reqID
+        yield self.clid
+        for (methodname, args, kwargs) in self.calls:
+            yield six.ensure_binary(methodname)
+            yield ArgumentSlicer(args, kwargs, methodname)
+
+    def describe(self):
+        return "<batch-%s-%s>" % (self.reqID, self.clid)
+
 class InboundDelivery(object):
     """An inbound message that has not yet been delivered.
 
@@ -186,6 +241,34 @@ class InboundDelivery(object):
         self.methodname = methodname
         self.methodSchema = methodSchema
         self.allargs = allargs
+        self.cancelled = False
+        self.running = None # the Deferred returned by the method, if any
+        self.batch = None # an InboundBatch, if we arrived in one
+        self.batchIndex = None
+        self.pipelinedOn = None # a RetainedAnswer we are waiting for
+        self.stream = None # a streaming.OutboundStream, for streamed answers
+
+    def setTarget(self, record):
+        """Aim a pipelined call at the answer it was waiting for, now that
+        it is known. The arguments could not be checked on the way in, so
+        they are checked now. This raises Violation if the call cannot be
+        delivered."""
+        self.pipelinedOn = None
+        self.obj, self.interface = getCallTarget(record)
+        if self.interface:
+            ms = self.interface.get(self.methodname)
+            if not ms:
+                raise Violation("method '%s' not defined in %s" %
+                                (self.methodname,
+                                 self.interface.__remote_name__))
+            self.methodSchema = ms
+            self.allargs.methodSchema = ms
+            self.allargs.checkedOnReceive = False
+
+    def cancelByteStreams(self):
+        """The call was rejected, cancelled, or failed: stop receiving any
+        byte streams among its arguments, which the method may never read."""
+        self.allargs.cancelByteStreams()
 
     def logFailure(self, f):
         # called if tub.logLocalFailures is True
@@ -238,6 +321,12 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
         self._all_children_are_referenceable_d = None
         self._ready_deferreds = []
         self.closed = False
+        # a shared reference may point at an object which was still being
+        # built when ReferenceUnslicer checked it, so if any appear,
+        # checkArguments() must look at everything
+        self._referencesResolved = self.protocol.referencesResolved
+        self.checkedOnReceive = False
+        self.byteStreams = [] # IncomingByteStreams, see byteStreamOpened()
 
     def checkToken(self, typebyte, size):
         if self.numargs is None:
@@ -260,6 +349,15 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
         if self.argConstraint:
             self.argConstraint.checkToken(typebyte, size)
 
+    def openStringSpool(self, size):
+        if self.numargs is None:
+            return None
+        if len(self.args) >= self.numargs and self.argname is None:
+            return None # a kwarg name
+        if isinstance(self.argConstraint, SpooledStringConstraint):
+            return self.argConstraint.openSpool(size)
+        return None
+
     def doOpen(self, opentype):
         if self.argConstraint:
             self.argConstraint.checkOpentype(opentype)
@@ -322,7 +420,7 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
                 accept, self.argConstraint = \
                         ms.getKeywordArgConstraint(self.argname,
                                                    self.numargs,
-                                                   list(self.kwargs.keys()))
+                                                   self.kwargs)
                 assert accept
             return
 
@@ -339,6 +437,17 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
         self.argname = None
         return
 
+    def byteStreamOpened(self, stream):
+        # a ByteStreamUnslicer somewhere among our arguments has registered
+        # its stream with the Broker. If the call is rejected, cancelled, or
+        # fails, nobody may ever read it, so we must cancel it then.
+        self.byteStreams.append(stream)
+
+    def cancelByteStreams(self):
+        # this does nothing to a stream which has already been read
+        for stream in self.byteStreams:
+            stream.cancel()
+
     def updateChild(self, obj, which):
         # one of our arguments has just now become referenceable. Normal
         # types can't trigger this (since the arguments to a method form a
@@ -371,6 +480,10 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
             self.argname is not None):
             raise BananaError("'arguments' sequence ended too early")
         self.closed = True
+        self.checkedOnReceive = (
+            self.protocol.referencesResolved == self._referencesResolved
+            and not self.num_unreferenceable_children
+            and not self._ready_deferreds)
         dl = []
         if self.num_unreferenceable_children:
             d = self._all_children_are_referenceable_d = defer.Deferred()
@@ -381,6 +494,20 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
             ready_deferred = AsyncAND(dl)
         return self, ready_deferred
 
+    def checkArguments(self):
+        """Apply the method schema to the complete arguments, just before
+        the method is invoked. Each argument was checked as its tokens
+        arrived, so unless shared references or not-yet-referenceable
+        children got involved, this only needs to cover what those checks
+        could not."""
+        ms = self.methodSchema
+        if not ms:
+            return
+        if self.checkedOnReceive and hasattr(ms, "checkReceivedArgs"):
+            ms.checkReceivedArgs(self.args, self.kwargs)
+        else:
+            ms.checkAllArgs(self.args, self.kwargs, True)
+
     def describe(self):
         s = "<arguments"
         if self.numargs is not None:
@@ -411,6 +538,7 @@ class CallUnslicer(slicer.ScopedUnslicer):
         self.interface = None
         self.methodname = None
         self.methodSchema = None # will be a MethodArgumentsConstraint
+        self.arguments = None # our ArgumentUnslicer, once it is opened
         self._ready_deferreds = []
 
     def checkToken(self, typebyte, size):
@@ -435,12 +563,16 @@ class CallUnslicer(slicer.ScopedUnslicer):
         # checkToken insures that this can only happen when we're receiving
         # an arguments object, so we don't have to bother checking self.stage
         assert self.stage == 3
-        unslicer = self.open(opentype)
+        unslicer = self.arguments = self.open(opentype)
         if self.methodSchema:
             unslicer.setConstraint(self.methodSchema)
         return unslicer
 
     def reportViolation(self, f):
+        # the method will never see any byte streams that arrived with us
+        if self.arguments is not None:
+            self.arguments.cancelByteStreams()
+
         # if the Violation is because we received an ABORT, then we know
         # that the sender knows there was a problem, so don't respond.
         if f.value.args[0] == "ABORT received":
@@ -543,6 +675,9 @@ class CallUnslicer(slicer.ScopedUnslicer):
     def receiveClose(self):
         if self.stage != 4:
             raise BananaError("'call' sequence ended too early")
+        return self.makeDelivery()
+
+    def makeDelivery(self):
         # time to create the InboundDelivery object so we can queue it
         delivery = InboundDelivery(self.broker, self.reqID, self.obj,
                                    self.interface, self.methodname,
@@ -551,6 +686,7 @@ class CallUnslicer(slicer.ScopedUnslicer):
         ready_deferred = None
         if self._ready_deferreds:
             ready_deferred = AsyncAND(self._ready_deferreds)
+            self._ready_deferreds = []
         return delivery, ready_deferred
 
     def describe(self):
@@ -571,6 +707,191 @@ class CallUnslicer(slicer.ScopedUnslicer):
         return s
 
 
+class CancelSlicer(slicer.BaseSlicer):
+    opentype = ('cancel',)
+
+    def __init__(self, reqID):
+        self.reqID = reqID
+
+    def sliceBody(self, streamable, banana):
+        yield self.reqID
+
+    def describe(self):
+        return "<%s-%s>" % (self.opentype[0], self.reqID)
+
+class CancelUnslicer(slicer.LeafUnslicer):
+    # peers which don't know about this sequence will reject it as an
+    # unknown top-level OPEN type, which PBRootUnslicer ignores
+    name = "cancel"
+    reqID = None
+
+    def checkToken(self, typebyte, size):
+        if typebyte != tokens.INT or self.reqID is not None:
+            raise BananaError("'%s' takes a single request ID" % self.name)
+
+    def receiveChild(self, token, ready_deferred=None):
+        assert ready_deferred is None
+        self.reqID = token
+
+    def receiveClose(self):
+        if self.reqID is None:
+            raise BananaError("'%s' sequence needs a request ID" % self.name)
+        self.handleRequestID(self.reqID)
+        return None, None
+
+    def handleRequestID(self, reqID):
+        self.broker.cancelInboundCall(reqID)
+
+    def describe(self):
+        return "<%s-%s>" % (self.name, self.reqID)
+
+# Promise pipelining: a (retain-answer) sent just before a call asks the far
+# end to hold on to that call's result, so that (pipelined-call) sequences
+# can be aimed at it before the answer gets back to us. Once it does, we
+# send (release-answer) and talk to the answer directly.
+
+class RetainAnswerSlicer(CancelSlicer):
+    opentype = ('retain-answer',)
+
+class RetainAnswerUnslicer(CancelUnslicer):
+    name = "retain-answer"
+
+    def handleRequestID(self, reqID):
+        self.broker.retainAnswer(reqID)
+
+class ReleaseAnswerSlicer(CancelSlicer):
+    opentype = ('release-answer',)
+
+class ReleaseAnswerUnslicer(CancelUnslicer):
+    name = "release-answer"
+
+    def handleRequestID(self, reqID):
+        self.broker.releaseAnswer(reqID)
+
+class RetainedAnswer(object):
+    """The result of an inbound call that the caller wants to send further
+    calls to, before it has seen the answer. Calls which arrive before the
+    result is known wait here, in order."""
+
+    def __init__(self, reqID):
+        self.reqID = reqID
+        self.resolved = False
+        self.result = None
+        self.failure = None
+        self.waiting = [] # (delivery, ready_deferred)
+
+    def resolve(self, result):
+        # 'result' may be a Failure. Returns the calls that were waiting.
+        self.resolved = True
+        if isinstance(result, failure.Failure):
+            self.failure = result
+        else:
+            self.result = result
+        waiting, self.waiting = self.waiting, []
+        return waiting
+
+class PipelinedCallSlicer(CallSlicer):
+    # the same as a 'call', but aimed at the answer to an earlier request
+    # instead of at a CLID
+    opentype = ('pipelined-call',)
+
+    def describe(self):
+        return "<pipelined-call-%s-%s-%s>" % (self.reqID, self.clid,
+                                              self.methodname)
+
+class PipelinedCallUnslicer(CallUnslicer):
+    pipelinedOn = None # the RetainedAnswer, until it is resolved
+
+    def checkToken(self, typebyte, size):
+        if self.stage == 1 and typebyte != tokens.INT:
+            raise BananaError("answer ID must be an INT")
+        CallUnslicer.checkToken(self, typebyte, size)
+
+    def receiveChild(self, token, ready_deferred=None):
+        if self.stage != 1:
+            return CallUnslicer.receiveChild(self, token, ready_deferred)
+        assert ready_deferred is None
+        self.objID = token
+        record = self.broker.retainedAnswers.get(token)
+        if record is None:
+            raise Violation("the answer to request %d was not retained"
+                            % (token,))
+        if record.resolved and not record.failure:
+            # we can check the arguments as they arrive, like a normal call
+            self.obj, self.interface = getCallTarget(record)
+        else:
+            # InboundDelivery.setTarget() will do it later
+            self.pipelinedOn = record
+        self.stage = 2
+
+    def makeDelivery(self):
+        delivery, ready_deferred = CallUnslicer.makeDelivery(self)
+        delivery.pipelinedOn = self.pipelinedOn
+        return delivery, ready_deferred
+
+    def describe(self):
+        return "<pipelined-call reqID=%s>" % self.reqID
+
+def getCallTarget(record):
+    """Return the (obj, interface) that calls pipelined on a RetainedAnswer
+    should be delivered to, or raise Violation."""
+    obj = record.result
+    if not ipb.IRemotelyCallable.providedBy(obj):
+        raise Violation("the answer to request %d (%r) cannot receive "
+                        "method calls" % (record.reqID, obj))
+    return obj, obj.getInterface()
+
+
+class InboundBatch(object):
+    """The calls from a 'batch' sequence, which share a reqID. Each one
+    becomes an InboundDelivery, queued and started like any other, and the
+    results are collected here until they can all be sent back in one
+    'batch-answer' sequence."""
+
+    def __init__(self, reqID, calls):
+        self.reqID = reqID
+        self.calls = calls # list of (delivery, ready_deferred)
+        self.results = [None] * len(calls)
+        self.remaining = len(calls)
+        for i, (delivery, ready_deferred) in enumerate(calls):
+            delivery.batch = self
+            delivery.batchIndex = i
+
+    def addResult(self, delivery, ok, res):
+        """Record the outcome of one call. Returns True once every call in
+        the batch has finished."""
+        self.results[delivery.batchIndex] = (ok, res)
+        self.remaining -= 1
+        return self.remaining == 0
+
+class BatchUnslicer(CallUnslicer):
+    # this is a CallUnslicer which, after each set of arguments, goes back
+    # to expecting a methodname
+    def start(self, count):
+        CallUnslicer.start(self, count)
+        self.calls = []
+
+    def receiveChild(self, token, ready_deferred=None):
+        if self.stage == 0 and token == 0:
+            raise BananaError("'batch' sequences always need an answer")
+        CallUnslicer.receiveChild(self, token, ready_deferred)
+        if self.stage == 4:
+            self.calls.append(self.makeDelivery())
+            self.stage = 2
+
+    def receiveClose(self):
+        if self.stage != 2:
+            raise BananaError("'batch' sequence ended too early")
+        if not self.calls:
+            # it would never be answered, but would still count against
+            # maxUnansweredCalls
+            raise BananaError("'batch' sequence has no calls")
+        return InboundBatch(self.reqID, self.calls), None
+
+    def describe(self):
+        return "<batch reqID=%s call=%d>" % (self.reqID, len(self.calls))
+
+
 class AnswerSlicer(slicer.ScopedSlicer):
     opentype = ('answer',)
 
@@ -694,6 +1015,122 @@ class AnswerUnslicer(slicer.ScopedUnslicer):
 
 
 
+class BatchAnswerSlicer(slicer.ScopedSlicer):
+    # 'results' is a list of (ok, value) pairs, one per call in the batch.
+    # Each becomes INT(0) value or INT(1) failure.
+    opentype = ('batch-answer',)
+
+    def __init__(self, reqID, results):
+        assert reqID != 0
+        slicer.ScopedSlicer.__init__(self, None)
+        self.reqID = reqID
+        self.results = results
+
+    def sliceBody(self, streamable, banana):
+        yield self.reqID
+        for (ok, res) in self.results:
+            yield 0 if ok else 1
+            yield res
+
+    def describe(self):
+        return "<batch-answer-%s>" % self.reqID
+
+class BatchAnswerUnslicer(slicer.ScopedUnslicer):
+    # the PendingRequest for a batch has a list of result constraints, one
+    # per call, instead of a single one
+    request = None
+    ok = None # set by the flag that precedes each result
+    fConstraint = FailureConstraint()
+
+    def start(self, count):
+        slicer.ScopedUnslicer.start(self, count)
+        self.results = [] # (True, Deferred) or (False, Failure)
+        self._ready_deferreds = []
+
+    def _resultConstraint(self):
+        if not self.ok:
+            return self.fConstraint
+        return self.request.constraint[len(self.results)]
+
+    def checkToken(self, typebyte, size):
+        if self.request is None or self.ok is None:
+            if typebyte != tokens.INT:
+                raise BananaError("request ID and result flags must be INTs")
+        else:
+            constraint = self._resultConstraint()
+            if constraint:
+                constraint.checkToken(typebyte, size)
+
+    def doOpen(self, opentype):
+        constraint = self._resultConstraint()
+        if constraint:
+            constraint.checkOpentype(opentype)
+        unslicer = self.open(opentype)
+        if unslicer and constraint:
+            unslicer.setConstraint(constraint)
+        return unslicer
+
+    def receiveChild(self, token, ready_deferred=None):
+        if self.request is None:
+            assert ready_deferred is None
+            # may raise Violation for bad reqIDs
+            self.request = self.broker.getRequest(token)
+        elif self.ok is None:
+            assert ready_deferred is None
+            if token not in (0, 1):
+                raise BananaError("batch result flag must be 0 or 1")
+            if len(self.results) >= len(self.request.constraint):
+                raise BananaError("too many results in batch answer")
+            self.ok = (token == 0)
+        else:
+            if ready_deferred:
+                self._ready_deferreds.append(ready_deferred)
+            if self.ok:
+                if not isinstance(token, defer.Deferred):
+                    token = defer.succeed(token)
+            elif not self.broker._expose_remote_exception_types:
+                token = wrap_remote_failure(token)
+            self.results.append((self.ok, token))
+            self.ok = None
+
+    def reportViolation(self, f):
+        if self.request != None:
+            self.request.fail(f) # fails every call in the batch
+        return f # give up our sequence
+
+    def receiveClose(self):
+        if (self.request is None or self.ok is not None
+            or len(self.results) != len(self.request.constraint)):
+            raise BananaError("batch answer has the wrong number of results")
+
+        if self._ready_deferreds:
+            d = AsyncAND(self._ready_deferreds)
+        else:
+            d = defer.succeed(None)
+
+        def _ready(res):
+            return defer.gatherResults([v for (ok, v) in self.results if ok],
+                                       consumeErrors=True)
+        d.addCallback(_ready)
+
+        def _done(values):
+            values = iter(values)
+            self.request.complete([(ok, next(values) if ok else v)
+                                   for (ok, v) in self.results])
+        def _fail(f):
+            if f.check(defer.FirstError):
+                f = f.value.subFailure
+            self.request.fail(f)
+        d.addCallbacks(_done, _fail)
+
+        return None, None
+
+    def describe(self):
+        if self.request:
+            return "BatchAnswer(req=%s)" % self.request.reqID
+        return "BatchAnswer(req=?)"
+
+
 class ErrorSlicer(slicer.ScopedSlicer):
     opentype = ('error',)
 
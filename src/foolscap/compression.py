@@ -0,0 +1,55 @@
+import zlib
+
+from foolscap.tokens import BananaError
+
+# the decompressor never hands more than this many bytes to Banana at once,
+# so a small compressed chunk cannot balloon into a huge receive buffer
+MAX_DECOMPRESSED_CHUNK = 64*1024
+
+class ZlibCompression(object):
+    """I compress one direction of a connection, and decompress the other.
+
+    Both directions are a single deflate stream that lasts as long as the
+    connection. Each batch of outbound data is finished with a sync-flush,
+    so the far end can decode everything we have written so far without
+    waiting for more, while the compression dictionary is kept from one
+    batch to the next.
+    """
+
+    name = "zlib"
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self._compressor = zlib.compressobj(level)
+        self._decompressor = zlib.decompressobj()
+
+    def compress(self, chunks):
+        """Compress a list of bytes, and return bytes which can be written
+        to the transport right away."""
+        c = self._compressor
+        out = [c.compress(chunk) for chunk in chunks]
+        out.append(c.flush(zlib.Z_SYNC_FLUSH))
+        return b"".join(out)
+
+    def decompress(self, data):
+        """Yield the plaintext for some bytes that arrived from the far end,
+        in pieces of at most MAX_DECOMPRESSED_CHUNK. Raises BananaError if
+        the stream is corrupt."""
+        d = self._decompressor
+        try:
+            while True:
+                out = d.decompress(data, MAX_DECOMPRESSED_CHUNK)
+                if out:
+                    yield out
+                data = d.unconsumed_tail
+                if not data and len(out) < MAX_DECOMPRESSED_CHUNK:
+                    return
+        except zlib.error as e:
+            raise BananaError("corrupt compressed stream: %s" % e)
+
+# these are the algorithms that Tub.setOption("compression") will accept.
+# lzma and bz2 are not here: their stdlib compressors cannot flush without
+# ending the stream, which would throw away the dictionary after every write.
+ALGORITHMS = {"zlib": ZlibCompression}
+
+def getCompression(name):
+    return ALGORITHMS[name]()
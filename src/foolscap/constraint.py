@@ -5,6 +5,7 @@
 
 # This imports foolscap.tokens, but no other Foolscap modules.
 
+import io, tempfile
 from zope.interface import implementer, Interface
 
 from foolscap.util import ensure_tuple_str
@@ -51,6 +52,15 @@ class IRemoteMethodConstraint(IConstraint):
 
         This should either raise Violation or return None."""
         pass
+    def checkReceivedArgs(args, kwargs):
+        """Like checkAllArgs(args, kwargs, True), but only called when every
+        argument was accepted by getPositionalArgConstraint() or
+        getKeywordArgConstraint() and then checked token-by-token as it
+        arrived, without any shared references. Implementations may skip
+        whatever those checks have already covered. This is optional: the
+        ArgumentUnslicer uses checkAllArgs() when it is missing.
+
+        This should either raise Violation or return None."""
     def getResponseConstraint():
         """Return an IConstraint-providing object to enforce the response
         constraint. This is called on outbound method calls so that when the
@@ -174,6 +184,17 @@ class Constraint(object):
         # this default form passes everything
         return
 
+    def enforcedOnReceive(self):
+        """Return True if the Unslicers enforce everything that checkObject()
+        would, as the tokens arrive. When every argument of an inbound method
+        call was received this way (and none of them were shared
+        references), the final checkObject() pass can be skipped.
+
+        This default is conservative: a Constraint which doesn't know better
+        must be checked again once the object is complete.
+        """
+        return False
+
     COUNTERBYTES = 64 # max size of opencount
 
     def OPENBYTES(self, dummy):
@@ -195,7 +216,9 @@ class OpenerConstraint(Constraint):
     taster = openTaster
 
 class Any(Constraint):
-    pass # accept everything
+    # accept everything
+    def enforcedOnReceive(self):
+        return True
 
 # constraints which describe individual banana tokens
 
@@ -219,6 +242,42 @@ class ByteStringConstraint(Constraint):
             raise Violation("string too short (%d < %d)" %
                             (len(obj), self.minLength))
 
+    def enforcedOnReceive(self):
+        # the taster only limits STRING tokens, so VOCAB strings (and short
+        # ones) get past it
+        return self.maxLength is None and self.minLength == 0
+
+class SpooledStringConstraint(ByteStringConstraint):
+    """A bytestring argument which is written to a file as it arrives,
+    rather than being held in memory. The method receives the file, rewound
+    to the start. spoolFactory(size) is asked for the file: by default it is
+    a BytesIO for bodies of up to 'threshold' bytes, and an anonymous
+    tempfile.TemporaryFile for larger ones. A spoolFactory may return any
+    object with a write() method, such as a consumer that hashes the data
+    or writes it to its final destination.
+
+    Only arguments are spooled: elsewhere this behaves like a
+    ByteStringConstraint.
+    """
+    name = "SpooledStringConstraint"
+
+    def __init__(self, maxLength=None, threshold=64*1024, spoolFactory=None):
+        ByteStringConstraint.__init__(self, maxLength)
+        self.threshold = threshold
+        self.spoolFactory = spoolFactory
+
+    def openSpool(self, size):
+        if self.spoolFactory:
+            return self.spoolFactory(size)
+        if size <= self.threshold:
+            return io.BytesIO()
+        return tempfile.TemporaryFile()
+
+    def checkObject(self, obj, inbound):
+        if inbound and not isinstance(obj, bytes):
+            return # a spool, which the taster has already limited
+        ByteStringConstraint.checkObject(self, obj, inbound)
+
 class IntegerConstraint(Constraint):
     opentypes = [] # redundant
     # taster set in __init__
@@ -233,17 +292,33 @@ class IntegerConstraint(Constraint):
         if maxBytes != -1:
             self.taster[LONGINT] = maxBytes
             self.taster[LONGNEG] = maxBytes
+        # the header of an INT or NEG token is the value itself, and can be
+        # up to 64 bytes long, so it must be range-checked too
+        self.maxINT = self.maxNEG = None
+        if maxBytes == -1:
+            self.maxINT = 2**31 - 1
+            self.maxNEG = 2**31
+        elif maxBytes != None:
+            self.maxINT = self.maxNEG = 2**(8*maxBytes) - 1
+
+    def checkToken(self, typebyte, size):
+        Constraint.checkToken(self, typebyte, size)
+        if ((typebyte == INT and self.maxINT is not None
+             and size > self.maxINT) or
+            (typebyte == NEG and self.maxNEG is not None
+             and size > self.maxNEG)):
+            raise Violation("number too large")
 
     def checkObject(self, obj, inbound):
         if not isinstance(obj, int):
             raise Violation("'%r' is not a number" % (obj,))
-        if self.maxBytes == -1:
-            if obj >= 2**31 or obj < -2**31:
-                raise Violation("number too large")
-        elif self.maxBytes != None:
-            if abs(obj) >= 2**(8*self.maxBytes):
+        if self.maxINT is not None:
+            if obj > self.maxINT or -obj > self.maxNEG:
                 raise Violation("number too large")
 
+    def enforcedOnReceive(self):
+        return True
+
 class NumberConstraint(IntegerConstraint):
     """I accept floats, ints, and longs."""
     name = "NumberConstraint"
@@ -0,0 +1,148 @@
+# -*- test-case-name: foolscap.test.test_executors -*-
+
+"""Run blocking or CPU-heavy remote_ methods off the reactor thread.
+
+Decorate the method to choose where it runs::
+
+ class Hasher(Referenceable):
+     @runInThread(maxConcurrent=4)
+     def remote_hash(self, data):
+         return hashlib.sha256(data).digest()
+
+     @staticmethod
+     @runInProcess
+     def remote_compress(data):
+         return zlib.compress(data, 9)
+
+The caller sees no difference. Arguments are checked against the
+RemoteInterface before the method is started, and the result is checked
+once it is available, exactly as if the method had returned a Deferred.
+Methods are started in the order the calls arrived.
+
+A method run in a process pool is pickled, along with its arguments and its
+result, so it should be a staticmethod (or a plain function): a bound method
+would take its Referenceable along with it.
+
+An 'async def' remote_ method needs no decorator: it is run with
+Deferred.fromCoroutine, so it may await Deferreds (such as the results of
+callRemote). One that awaits asyncio futures instead must be run as an
+asyncio Task, which needs the asyncio reactor::
+
+ class Sleeper(Referenceable):
+     @runAsTask
+     async def remote_sleep(self, seconds):
+         await asyncio.sleep(seconds)
+         return seconds
+"""
+
+import asyncio
+import concurrent.futures
+from twisted.internet import defer, threads
+from twisted.python import failure
+
+class _Runner(object):
+    def __init__(self, maxConcurrent=None):
+        self.semaphore = None
+        if maxConcurrent is not None:
+            # shared by every instance, on every connection
+            self.semaphore = defer.DeferredSemaphore(maxConcurrent)
+
+    def __call__(self, func):
+        func.foolscapRunner = self
+        return func
+
+    def run(self, meth, args, kwargs):
+        if self.semaphore:
+            return self.semaphore.run(self.start, meth, args, kwargs)
+        return self.start(meth, args, kwargs)
+
+    def start(self, meth, args, kwargs):
+        raise NotImplementedError
+
+class ThreadRunner(_Runner):
+    """I run methods in the reactor's thread pool."""
+    def start(self, meth, args, kwargs):
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, reactor.getThreadPool(),
+                                         meth, *args, **kwargs)
+
+class ProcessRunner(_Runner):
+    """I run methods in the shared process pool (see setProcessPool)."""
+    def start(self, meth, args, kwargs):
+        from twisted.internet import reactor
+        d = defer.Deferred()
+        def _done(future):
+            # this runs in one of the executor's threads
+            try:
+                res = future.result()
+            except BaseException as e:
+                res = failure.Failure(e)
+            reactor.callFromThread(d.callback, res)
+        future = getProcessPool().submit(meth, *args, **kwargs)
+        future.add_done_callback(_done)
+        return d
+
+class TaskRunner(_Runner):
+    """I run 'async def' methods as Tasks on the running asyncio loop."""
+    def start(self, meth, args, kwargs):
+        # this raises RuntimeError unless we're on the asyncio reactor
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(meth(*args, **kwargs))
+        return defer.Deferred.fromFuture(task)
+
+def _decorate(runnerClass, func, maxConcurrent):
+    if func is None:
+        # used as @runInThread(maxConcurrent=N)
+        return runnerClass(maxConcurrent)
+    return runnerClass(maxConcurrent)(func)
+
+def runInThread(func=None, maxConcurrent=None):
+    """Mark a remote_ method to be run in the reactor's thread pool. Use
+    either @runInThread or @runInThread(maxConcurrent=N), where N limits how
+    many calls to this method may run at once."""
+    return _decorate(ThreadRunner, func, maxConcurrent)
+
+def runInProcess(func=None, maxConcurrent=None):
+    """Mark a remote_ method to be run in a separate process. Use either
+    @runInProcess or @runInProcess(maxConcurrent=N). The method, its
+    arguments, and its result must all be picklable."""
+    return _decorate(ProcessRunner, func, maxConcurrent)
+
+def runAsTask(func=None, maxConcurrent=None):
+    """Mark an 'async def' remote_ method to be run as an asyncio Task, so
+    it can await asyncio futures. Use either @runAsTask or
+    @runAsTask(maxConcurrent=N). This needs the asyncio reactor. Cancelling
+    the call cancels the Task."""
+    return _decorate(TaskRunner, func, maxConcurrent)
+
+def callRemoteMethod(meth, args, kwargs):
+    """Invoke meth(*args, **kwargs), wherever it was marked to run. Returns
+    the result, or a Deferred that fires with it."""
+    runner = getattr(meth, "foolscapRunner", None)
+    if runner is None:
+        return meth(*args, **kwargs)
+    return runner.run(meth, args, kwargs)
+
+_processPool = None
+
+def setProcessPool(executor):
+    """Use this concurrent.futures.Executor for @runInProcess methods,
+    instead of a default ProcessPoolExecutor (with one worker per CPU). The
+    caller is responsible for shutting it down."""
+    global _processPool
+    _processPool = executor
+
+def getProcessPool():
+    global _processPool
+    if _processPool is None:
+        from twisted.internet import reactor
+        _processPool = concurrent.futures.ProcessPoolExecutor()
+        reactor.addSystemEventTrigger("during", "shutdown",
+                                      _shutdownProcessPool, _processPool)
+    return _processPool
+
+def _shutdownProcessPool(executor):
+    global _processPool
+    executor.shutdown(wait=True)
+    if _processPool is executor:
+        _processPool = None
@@ -50,6 +50,11 @@ class DeadReferenceError(Exception):
             args.append("(during method=%s:%s)" % (iname, mname))
         return " ".join([str(a) for a in args])
 
+class SendQueueFullError(Exception):
+    """The connection has too many messages waiting to be sent, and the Tub
+    was configured (with the 'send-queue-fail-fast' option) to reject new
+    calls instead of queueing them. Use rref.waitForSendQueue() to find out
+    when it is worth trying again."""
 
 class IReferenceable(Interface):
     """This object is remotely referenceable. This means it is represented to
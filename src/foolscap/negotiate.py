@@ -43,6 +43,8 @@ PLAINTEXT, ENCRYPTED, DECIDING, BANANA, ABANDONED = list(range(5))
 #  2 (0.1.1): no changes to offer or decision
 #             reqID=0 was commandeered for use by callRemoteOnly()
 #  3 (0.1.3): added PING and PONG tokens
+#  4: PB peers accept (set-vocab) and (add-vocab) sequences at the top
+#     level, so the sender may grow its VOCAB table adaptively
 
 class Negotiation(protocol.Protocol):
     """This is the first protocol to speak over the wire. It is responsible
@@ -146,7 +148,7 @@ class Negotiation(protocol.Protocol):
     forceNegotiation = None
 
     minVersion = 3
-    maxVersion = 3
+    maxVersion = 8
 
     brokerClass = broker.Broker
 
@@ -580,6 +582,8 @@ class Negotiation(protocol.Protocol):
         if self.tub:
             IR = self.tub.getIncarnationString()
             hello['my-incarnation'] = IR
+            if self.tub.compressionAlgorithms:
+                hello['compression'] = ",".join(self.tub.compressionAlgorithms)
 
         self.log("Negotiate.sendHello (isClient=%s): %s" %
                  (self.isClient, hello))
@@ -789,6 +793,16 @@ class Negotiation(protocol.Protocol):
             params['banana-decision-version'] = self.decision_version
             params['initial-vocab-table-index'] = vocab_index
 
+            # stream compression is only used if both sides offered it. We
+            # pick the first of our algorithms that they also offered.
+            # Peers which did not offer it never see this key.
+            theirCompression = offer.get("compression", "").split(",")
+            for algorithm in self.tub.compressionAlgorithms:
+                if algorithm in theirCompression:
+                    decision['compression'] = algorithm
+                    params['compression'] = algorithm
+                    break
+
         else:
             # otherwise, the other side gets to decide. The next thing they
             # expect to hear from us is banana.
@@ -819,6 +833,36 @@ class Negotiation(protocol.Protocol):
         # changes were made to the offer or decision blocks.
         return self.evaluateNegotiationVersion1(offer)
 
+    def evaluateNegotiationVersion4(self, offer):
+        # version 4 allows (set-vocab) and (add-vocab) sequences at the top
+        # level of a PB connection. No changes were made to the offer or
+        # decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
+    def evaluateNegotiationVersion5(self, offer):
+        # version 5 adds (batch) and (batch-answer) sequences at the top
+        # level. No changes were made to the offer or decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
+    def evaluateNegotiationVersion6(self, offer):
+        # version 6 adds (retain-answer), (pipelined-call), and
+        # (release-answer), for promise pipelining. No changes were made to
+        # the offer or decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
+    def evaluateNegotiationVersion7(self, offer):
+        # version 7 adds (stream-items), (stream-end), and (stream-credit),
+        # for streamed answers. No changes were made to the offer or
+        # decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
+    def evaluateNegotiationVersion8(self, offer):
+        # version 8 adds (byte-stream) arguments, and the (byte-stream-data),
+        # (byte-stream-end), (byte-stream-abort), (byte-stream-credit), and
+        # (byte-stream-cancel) sequences which carry them. No changes were
+        # made to the offer or decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
     def compareOfferAndExisting(self, offer, existing, lp):
         """Compare the new offer against the existing connection, and
         decide which to keep.
@@ -1052,6 +1096,12 @@ class Negotiation(protocol.Protocol):
         params = { 'banana-decision-version': ver,
                    'initial-vocab-table-index': vocab_index,
                    }
+        algorithm = decision.get('compression')
+        if algorithm:
+            if algorithm not in self.tub.compressionAlgorithms:
+                raise NegotiationError("I did not offer compression=%s"
+                                       % algorithm)
+            params['compression'] = algorithm
         return params
 
     def acceptDecisionVersion2(self, decision):
@@ -1064,6 +1114,31 @@ class Negotiation(protocol.Protocol):
         # function
         return self.acceptDecisionVersion1(decision)
 
+    def acceptDecisionVersion4(self, decision):
+        # this adds top-level vocab sequences, so we can use the same accept
+        # function
+        return self.acceptDecisionVersion1(decision)
+
+    def acceptDecisionVersion5(self, decision):
+        # this adds top-level batch sequences, so we can use the same accept
+        # function
+        return self.acceptDecisionVersion1(decision)
+
+    def acceptDecisionVersion6(self, decision):
+        # this adds top-level pipelining sequences, so we can use the same
+        # accept function
+        return self.acceptDecisionVersion1(decision)
+
+    def acceptDecisionVersion7(self, decision):
+        # this adds top-level streaming sequences, so we can use the same
+        # accept function
+        return self.acceptDecisionVersion1(decision)
+
+    def acceptDecisionVersion8(self, decision):
+        # this adds streamed-argument sequences, so we can use the same accept
+        # function
+        return self.acceptDecisionVersion1(decision)
+
     def loopbackDecision(self):
         # if we were talking to ourselves, what negotiation decision would we
         # reach? This is used for loopback connections
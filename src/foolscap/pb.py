@@ -12,7 +12,7 @@ from twisted.python.deprecate import deprecated
 from twisted.python.versions import Version
 
 from foolscap import ipb, base32, negotiate, broker, eventual, storage
-from foolscap import connection, util, info
+from foolscap import connection, util, info, compression
 from foolscap.connections import tcp
 from foolscap.referenceable import SturdyRef
 from .furl import BadFURLError
@@ -183,6 +183,19 @@ class Tub(service.MultiService):
     brokerClass = broker.Broker
     keepaliveTimeout = 4*60 # ping when connection has been idle this long
     disconnectTimeout = None # disconnect after this much idle time
+    adaptiveVocabularySize = 1000 # strings promoted to VOCAB per connection
+    maxInboundCalls = None # per connection, None means no limit
+    sendQueueHighWater = None # messages waiting per connection, None=no limit
+    sendQueueLowWater = 0
+    sendQueueHighWaterBytes = None # estimated bytes waiting, None=no limit
+    sendQueueLowWaterBytes = None
+    sendQueueFailFast = False
+    maxQueuedCalls = None # inbound, per connection, None means no limit
+    maxUnansweredCalls = None
+    maxReceiveBuffer = None # bytes
+    streamWindow = 100 # streamed answer items we let the far end send ahead
+    byteStreamWindow = 1024*1024 # and streamed argument bytes
+    compressionAlgorithms = () # stream compression to offer, best first
     tubID = None
 
     def __init__(self, certData=None, certFile=None, _test_options={}):
@@ -322,6 +335,74 @@ class Tub(service.MultiService):
             self._expose_remote_exception_types = bool(value)
         elif name == "accept-gifts":
             self.accept_gifts = bool(value)
+        elif name == "adaptive-vocabulary-size":
+            # frequently-sent strings (method names, dict keys, copyable
+            # names) are automatically added to the VOCAB table of each
+            # connection, up to this many of them. 0 disables this.
+            self.adaptiveVocabularySize = int(value)
+        elif name == "max-inbound-calls":
+            # each connection will run at most this many inbound calls at a
+            # time (counting from when the remote_ method is invoked until
+            # its result has been sent). Later calls wait, in order. None
+            # (or 0) means no limit.
+            self.maxInboundCalls = int(value) if value else None
+        elif name == "send-queue-high-water":
+            # when a connection has this many messages waiting to be sent
+            # (because the other side is not reading them fast enough), its
+            # send queue is considered full. None (or 0) means never.
+            self.sendQueueHighWater = int(value) if value else None
+        elif name == "send-queue-low-water":
+            # rref.waitForSendQueue() fires when the connection has this many
+            # messages (or fewer) waiting to be sent
+            self.sendQueueLowWater = int(value)
+        elif name == "send-queue-high-water-bytes":
+            # like send-queue-high-water, but measured in (estimated) bytes
+            # rather than messages. Either one can fill the queue.
+            self.sendQueueHighWaterBytes = int(value) if value else None
+        elif name == "send-queue-low-water-bytes":
+            # rref.waitForSendQueue() also fires when the connection has
+            # about this many bytes (or fewer) waiting. None means that only
+            # send-queue-low-water counts.
+            self.sendQueueLowWaterBytes = (int(value) if value is not None
+                                           else None)
+        elif name == "send-queue-fail-fast":
+            # if True, callRemote() on a connection whose send queue is full
+            # fails with SendQueueFullError instead of queueing the call
+            self.sendQueueFailFast = bool(value)
+        elif name == "max-queued-calls":
+            # each connection stops reading from the socket while this many
+            # inbound calls are waiting to be started, and resumes when half
+            # of them have been. None (or 0) means no limit.
+            self.maxQueuedCalls = int(value) if value else None
+        elif name == "max-unanswered-calls":
+            # likewise, for inbound calls which have not yet been answered
+            # (whether started or not)
+            self.maxUnansweredCalls = int(value) if value else None
+        elif name == "max-receive-buffer":
+            # while a connection has stopped reading, data which was already
+            # on its way is held without being parsed. If more than this
+            # many bytes pile up, the connection is dropped. None (or 0)
+            # means no limit.
+            self.maxReceiveBuffer = int(value) if value else None
+        elif name == "stream-window":
+            # when a remote method streams its answer, the far end may send
+            # this many items beyond what we have read so far
+            self.streamWindow = int(value)
+        elif name == "byte-stream-window":
+            # when a caller streams an argument to one of our methods, it may
+            # send this many bytes beyond what the method has read so far
+            self.byteStreamWindow = int(value)
+        elif name == "compression":
+            # offer to compress each connection with one of these algorithms
+            # (a list, or a comma-separated string, best first). It is only
+            # used when the other Tub offers the same one.
+            if isinstance(value, str):
+                value = [v.strip() for v in value.split(",") if v.strip()]
+            for algorithm in value:
+                if algorithm not in compression.ALGORITHMS:
+                    raise ValueError("unknown compression algorithm '%s'"
+                                     % algorithm)
+            self.compressionAlgorithms = tuple(value)
         else:
             raise KeyError("unknown option name '%s'" % name)
 
@@ -1004,7 +1085,7 @@ class Tub(service.MultiService):
         output = []
         all_brokers = list(self.brokers.items())
         for tubref,_broker in all_brokers:
-            inbound = _broker.inboundDeliveryQueue[:]
+            inbound = list(_broker.inboundDeliveryQueue)
             outbound = [pr
                         for (reqID, pr) in
                         sorted(_broker.waitingForAnswers.items()) ]
@@ -0,0 +1,114 @@
+import re
+
+# Banana token headers end with the first byte that has its high bit set
+# (the type byte). Searching with a compiled regexp lets us find it inside
+# the bytearray without copying anything out first.
+_HIGH_BIT = re.compile(b"[\x80-\xff]")
+
+# single-byte bytes objects, indexed by value, so that looking at one byte
+# of the buffer does not allocate
+_BYTES = [bytes([i]) for i in range(256)]
+
+# we only slide the unread data down to the front of the bytearray once this
+# much has been consumed (and it makes up at least half of the bytearray).
+# Until then the read cursor just moves forward.
+COMPACT_THRESHOLD = 64*1024
+
+class ReceiveBuffer(object):
+    """I hold bytes which have arrived but not yet been parsed.
+
+    Incoming chunks are appended to a single growable bytearray, and a read
+    cursor marks the start of the unread data. Token headers can be examined
+    in place (with find_high_bit, byte_at, and header_value), and token
+    bodies are copied out exactly once, by popleft(). Consumed bytes are
+    discarded lazily, when more data is appended.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._buf) - self._pos
+
+    def append(self, data):
+        """ Add data to the end of the buffer. """
+        pos = self._pos
+        if pos:
+            if pos == len(self._buf):
+                # everything has been consumed: start over, releasing the
+                # memory held by any large body we just delivered
+                self._buf = bytearray()
+                self._pos = 0
+            elif pos >= COMPACT_THRESHOLD and 2*pos >= len(self._buf):
+                del self._buf[:pos]
+                self._pos = 0
+        self._buf += data
+
+    def find_high_bit(self, limit):
+        """Return the offset (relative to the read cursor) of the first byte
+        with its high bit set, only looking at the first 'limit' bytes. If
+        there is no such byte, return -1."""
+        pos = self._pos
+        m = _HIGH_BIT.search(self._buf, pos, pos+limit)
+        if m is None:
+            return -1
+        return m.start() - pos
+
+    def byte_at(self, offset):
+        """Return the single byte at 'offset' as a length-1 bytes object."""
+        return _BYTES[self._buf[self._pos+offset]]
+
+    def header_value(self, length):
+        """Decode the first 'length' bytes as a little-endian base-128
+        integer, in place."""
+        buf = self._buf
+        start = self._pos
+        value = 0
+        for i in range(start+length-1, start-1, -1):
+            value = (value << 7) | buf[i]
+        return value
+
+    def peek(self, numbytes):
+        """ Return a copy of the leading bytes, without consuming them. """
+        pos = self._pos
+        return bytes(self._buf[pos:pos+numbytes])
+
+    def popleft(self, numbytes):
+        """ Remove some of the leading bytes and return them as a string. """
+        pos = self._pos
+        end = min(pos + numbytes, len(self._buf))
+        # slicing a memoryview does not copy, so bytes() makes the one and
+        # only copy of the body. The views are released as soon as this
+        # statement finishes, which allows the bytearray to be resized again.
+        data = bytes(memoryview(self._buf)[pos:end])
+        self._pos = end
+        return data
+
+    def raw(self):
+        """Return the underlying bytearray and the offset of the read cursor
+        within it, for callers which want to parse many small tokens
+        without a method call per byte. Hand the new offset to seek() when
+        done. Only valid until the next append()."""
+        return self._buf, self._pos
+
+    def seek(self, pos):
+        """Move the read cursor to an absolute offset in the bytearray
+        returned by raw()."""
+        assert self._pos <= pos <= len(self._buf)
+        self._pos = pos
+
+    def skip(self, numbytes):
+        """ Discard some of the leading bytes. """
+        self._pos = min(self._pos + numbytes, len(self._buf))
+
+    def rewind(self, numbytes):
+        """Un-consume the most recently skipped or popped bytes. This is only
+        valid until the next append()."""
+        assert numbytes <= self._pos
+        self._pos -= numbytes
+
+    def clear(self):
+        """ Empty it out. """
+        self._buf = bytearray()
+        self._pos = 0
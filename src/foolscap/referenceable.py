@@ -11,7 +11,7 @@ from zope.interface import interface
 from zope.interface import implementer
 from twisted.python.components import registerAdapter
 Interface = interface.Interface
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.python import failure, log
 
 from foolscap import ipb, slicer, tokens, call
@@ -21,8 +21,11 @@ from foolscap.constraint import IConstraint, ByteStringConstraint
 from foolscap.remoteinterface import getRemoteInterface, \
      getRemoteInterfaceByName, RemoteInterfaceConstraint
 from foolscap.schema import constraintMap
+from foolscap.slicers.root import CONTROL, INTERACTIVE, BULK, PRIORITIES
 from foolscap.copyable import Copyable, RemoteCopy
 from foolscap.eventual import eventually, fireEventually
+from foolscap.observer import OneShotObserverList
+from foolscap.executors import callRemoteMethod
 from foolscap.furl import decode_furl
 
 @implementer(ipb.IReferenceable)
@@ -57,7 +60,8 @@ class Referenceable(OnlyReferenceable):
 
     def doRemoteCall(self, methodname, args, kwargs):
         meth = getattr(self, "remote_%s" % methodname)
-        res = meth(*args, **kwargs)
+        # this might start it in a thread or a process
+        res = callRemoteMethod(meth, args, kwargs)
         return res
 
 constraintMap[Referenceable] = RemoteInterfaceConstraint(None)
@@ -367,6 +371,16 @@ class RemoteReferenceOnly(object):
         keepalives are disabled (the default), it returns None."""
         return self.tracker.broker.getDataLastReceivedAt()
 
+    def waitForSendQueue(self):
+        """Return a Deferred that fires (with None) once this connection has
+        few enough messages waiting to be sent (the Tub's
+        'send-queue-low-water' option, 0 by default, or
+        'send-queue-low-water-bytes'), or once it is lost.
+        Code which sends many calls to a peer that may be slow to read them
+        should wait for this before sending more. This is connection-wide,
+        not specific to this particular object."""
+        return self.tracker.broker.waitForSendQueue()
+
     def notifyOnDisconnect(self, callback, *args, **kwargs):
         """Register a callback to run when we lose this connection.
 
@@ -416,7 +430,35 @@ class RemoteReference(RemoteReferenceOnly):
         del d
         return None
 
+    def callRemotePipelined(self, _name, *args, **kwargs):
+        """Like callRemote, but return a PipelinedReference to the answer
+        instead of a Deferred. Calls made on that are sent right away,
+        without waiting for the answer to come back, and the far end
+        delivers them to the answer once it is known, so a chain of
+        dependent calls costs a single round trip. The answer must be a
+        Referenceable."""
+        retain = self.tracker.broker.acceptsPipelining
+        try:
+            req = self._sendCall(_name, False, args, kwargs, retain)
+        except:
+            return PipelinedReference(self, None, defer.fail())
+        if not retain:
+            # calls made on the answer will wait for it to come back
+            return PipelinedReference(self, None, req.deferred)
+        return PipelinedReference(self, req.reqID, req.deferred, req.priority)
+
     def _callRemote(self, _name, callOnly, args, kwargs):
+        req = self._sendCall(_name, callOnly, args, kwargs)
+        if req is not None:
+            return req.deferred
+
+    def _makeCallSlicer(self, reqID, methodName, args, kwargs):
+        return call.CallSlicer(reqID, self.tracker.clid, methodName,
+                               args, kwargs)
+
+    def _sendCall(self, _name, callOnly, args, kwargs, retain=False):
+        # returns the PendingRequest. If 'retain' is True, the far end is
+        # asked to keep the answer for calls pipelined on it.
         req = None
         broker = self.tracker.broker
         _name = six.ensure_str(_name)
@@ -428,6 +470,8 @@ class RemoteReference(RemoteReferenceOnly):
         methodConstraintOverride = kwargs.get("_methodConstraint", "none")
         resultConstraint = kwargs.get("_resultConstraint", "none")
         useSchema = kwargs.get("_useSchema", True)
+        timeout = kwargs.pop("_timeout", None)
+        priority = kwargs.pop("_priority", None)
 
         if "_methodConstraint" in kwargs:
             del kwargs["_methodConstraint"]
@@ -467,6 +511,15 @@ class RemoteReference(RemoteReferenceOnly):
         if methodConstraintOverride != "none":
             methodSchema = methodConstraintOverride
 
+        priority = self._getPriority(priority, methodSchema)
+        req.priority = priority
+        # control traffic is never refused
+        if (priority != CONTROL and broker.sendQueueFailFast
+            and broker.isSendQueueFull()):
+            raise ipb.SendQueueFullError(
+                "%d messages waiting to be sent (about %d bytes)"
+                % (broker.getSendQueueSize(), broker.getSendQueueBytes()))
+
         if useSchema and methodSchema:
             # check args against the arg constraint. This could fail if
             # any arguments are of the wrong type
@@ -487,8 +540,7 @@ class RemoteReference(RemoteReferenceOnly):
             # overrides schema
             req.setConstraint(IConstraint(resultConstraint))
 
-        clid = self.tracker.clid
-        slicer = call.CallSlicer(reqID, clid, methodName, args, kwargs)
+        slicer = self._makeCallSlicer(reqID, methodName, args, kwargs)
 
         # up to this point, we are not committed to sending anything to the
         # far end. The various phases of commitment are:
@@ -525,8 +577,11 @@ class RemoteReference(RemoteReferenceOnly):
         # slicing process made it.
 
         try:
+            if retain:
+                # this must arrive before anything pipelined on the answer
+                broker.send(call.RetainAnswerSlicer(reqID), priority)
             # commitment point 2
-            d = broker.send(slicer)
+            d = broker.send(slicer, priority)
             # d will fire when the last argument has been serialized. It will
             # errback if the arguments (or any of their children) could not
             # be serialized. We need to catch this case and errback the
@@ -542,6 +597,10 @@ class RemoteReference(RemoteReferenceOnly):
         except:
             req.fail(failure.Failure())
 
+        if timeout is not None and not callOnly:
+            # errbacks with defer.TimeoutError, after cancelling the request
+            req.deferred.addTimeout(timeout, reactor)
+
         # the remote end could send back an error response for many reasons:
         #  bad method name
         #  bad argument types (violated their schema)
@@ -554,7 +613,7 @@ class RemoteReference(RemoteReferenceOnly):
         #  method result violated our results schema
         # if none of those occurred, the callback will be run
 
-        return req.deferred
+        return req
 
     def _getMethodInfo(self, name):
         assert type(name) is str
@@ -572,6 +631,247 @@ class RemoteReference(RemoteReferenceOnly):
                                 (interfaceName, self, name))
         return interfaceName, methodName, methodSchema
 
+    def _getPriority(self, priority, methodSchema):
+        # an explicit _priority= wins, then the RemoteInterface
+        if priority is None:
+            priority = getattr(methodSchema, "priority", None) or INTERACTIVE
+        if priority not in PRIORITIES:
+            raise ValueError("send priority must be one of %s, not %r"
+                             % (", ".join(PRIORITIES), priority))
+        return priority
+
+    def startBatch(self):
+        """Return a CallBatch, which collects calls to this object and then
+        sends them all at once."""
+        return CallBatch(self)
+
+
+class PipelinedReference(RemoteReference):
+    """I stand for the answer to a call which has not come back yet. Calls
+    made on me are sent at once, aimed at that answer, and the far end holds
+    them until it is known. Once the answer arrives, calls go straight to
+    it. If the far end is too old to understand this, calls made on me wait
+    for the answer instead.
+
+    Use whenResolved() to get the answer itself."""
+
+    def __init__(self, rref, answerOf, d, priority=INTERACTIVE):
+        # we use the same connection as 'rref', so we share its tracker
+        RemoteReference.__init__(self, rref.tracker)
+        self.answerOf = answerOf # the far end's retained reqID, or None
+        self.priority = priority # that of the call which answers to us
+        self.resolved = False
+        self._observers = OneShotObserverList()
+        d.addBoth(self._resolve)
+
+    def _resolve(self, result):
+        self.resolved = True
+        broker = self.tracker.broker
+        if self.answerOf is not None and not broker.disconnected:
+            # everything we pipelined is ahead of this on the wire, since
+            # nothing overtakes the least urgent lane
+            broker.send(call.ReleaseAnswerSlicer(self.answerOf), BULK)
+        self._observers.fire(result)
+
+    def whenResolved(self):
+        """Return a Deferred that fires with the answer (usually a
+        RemoteReference), or errbacks if the call failed."""
+        return self._observers.whenFired()
+
+    def _isPipelining(self):
+        return self.answerOf is not None and not self.resolved
+
+    def _getTarget(self, answer):
+        if not isinstance(answer, RemoteReference):
+            raise Violation("the answer (%r) cannot receive method calls"
+                            % (answer,))
+        return answer
+
+    def callRemote(self, _name, *args, **kwargs):
+        if self._isPipelining():
+            return RemoteReference.callRemote(self, _name, *args, **kwargs)
+        d = self.whenResolved()
+        d.addCallback(self._getTarget)
+        d.addCallback(lambda target: target.callRemote(_name, *args, **kwargs))
+        return d
+
+    def callRemoteOnly(self, _name, *args, **kwargs):
+        if self._isPipelining():
+            return RemoteReference.callRemoteOnly(self, _name, *args, **kwargs)
+        d = self.whenResolved()
+        d.addCallback(self._getTarget)
+        d.addCallback(lambda target: target.callRemoteOnly(_name, *args,
+                                                           **kwargs))
+        d.addErrback(lambda f: None)
+        return None
+
+    def callRemotePipelined(self, _name, *args, **kwargs):
+        if self._isPipelining():
+            return RemoteReference.callRemotePipelined(self, _name,
+                                                       *args, **kwargs)
+        d = self.whenResolved()
+        d.addCallback(self._getTarget)
+        d.addCallback(lambda target: target.callRemote(_name, *args, **kwargs))
+        return PipelinedReference(self, None, d)
+
+    def _getMethodInfo(self, name):
+        # we don't know what the answer will be, so the far end checks the
+        # arguments once it does
+        return None, name, None
+
+    def _getPriority(self, priority, methodSchema):
+        priority = RemoteReference._getPriority(self, priority, methodSchema)
+        # our calls must not overtake the call whose answer they are aimed
+        # at, so they use its lane if it is a less urgent one
+        return max(priority, self.priority, key=PRIORITIES.index)
+
+    def _makeCallSlicer(self, reqID, methodName, args, kwargs):
+        return call.PipelinedCallSlicer(reqID, self.answerOf, methodName,
+                                        args, kwargs)
+
+    def __repr__(self):
+        return "<%s at 0x%x [answer to %s]>" % (self.__class__.__name__,
+                                                abs(id(self)), self.answerOf)
+
+
+class CallBatch(object):
+    """I collect several calls to a single RemoteReference, then send them
+    in one message. The far end starts them in order, just as if they had
+    been sent separately, and returns all the results in a single answer.
+    Each call still gets its own Deferred::
+
+     b = rref.startBatch()
+     d1 = b.callRemote("get", b"a")
+     d2 = b.callRemote("get", b"b")
+     b.send()
+
+    Arguments are checked against the RemoteInterface when callRemote() is
+    invoked. If the far end is too old to understand batches, the calls are
+    sent one at a time instead.
+    """
+
+    def __init__(self, rref):
+        self.rref = rref
+        self.calls = [] # (name, args, kwargs, useSchema, resultConstraint,
+                        #  constraint, Deferred)
+        self.sent = False
+        self._pending = [] # Deferreds to cancel, once sent
+
+    def callRemote(self, _name, *args, **kwargs):
+        assert not self.sent, "this batch has already been sent"
+        try:
+            entry = self._prepare(six.ensure_str(_name), args, kwargs)
+        except:
+            return defer.fail()
+        d = defer.Deferred()
+        self.calls.append(entry + (d,))
+        return d
+
+    def _prepare(self, name, args, kwargs):
+        useSchema = kwargs.pop("_useSchema", True)
+        resultConstraint = kwargs.pop("_resultConstraint", "none")
+        (interfaceName,
+         methodName,
+         methodSchema) = self.rref._getMethodInfo(name)
+        constraint = None
+        if useSchema and methodSchema:
+            try:
+                methodSchema.checkAllArgs(args, kwargs, False)
+            except Violation as v:
+                v.setLocation("%s.%s(%s)" % (interfaceName, methodName,
+                                             v.getLocation()))
+                raise
+            constraint = methodSchema.getResponseConstraint()
+        if resultConstraint != "none":
+            constraint = IConstraint(resultConstraint)
+        return (name, args, kwargs, useSchema, resultConstraint, constraint)
+
+    def send(self, timeout=None, priority=None):
+        """Send every call added so far. If 'timeout' is set, any call which
+        has not been answered after that many seconds will errback with
+        defer.TimeoutError. 'priority' sets the send priority of the whole
+        batch (the default is 'interactive')."""
+        assert not self.sent, "this batch has already been sent"
+        self.sent = True
+        calls, self.calls = self.calls, []
+        if not calls:
+            return
+        broker = self.rref.tracker.broker
+        if not broker.acceptsBatches:
+            for (name, args, kwargs, useSchema, resultConstraint,
+                 constraint, d) in calls:
+                d2 = self.rref.callRemote(name, _useSchema=useSchema,
+                                          _resultConstraint=resultConstraint,
+                                          _timeout=timeout,
+                                          _priority=priority, *args, **kwargs)
+                d2.addBoth(self._deliver, d)
+                self._pending.append(d2)
+            return
+        ds = [c[-1] for c in calls]
+        try:
+            req = self._sendBatch(broker, calls, priority)
+        except:
+            self._failAll(failure.Failure(), ds)
+            return
+        if timeout is not None:
+            req.deferred.addTimeout(timeout, reactor)
+        req.deferred.addCallbacks(self._distribute, self._failAll,
+                                  callbackArgs=(ds,), errbackArgs=(ds,))
+        self._pending.append(req.deferred)
+
+    def _sendBatch(self, broker, calls, priority):
+        priority = self.rref._getPriority(priority, None)
+        if (priority != CONTROL and broker.sendQueueFailFast
+            and broker.isSendQueueFull()):
+            raise ipb.SendQueueFullError(
+                "%d messages waiting to be sent (about %d bytes)"
+                % (broker.getSendQueueSize(), broker.getSendQueueBytes()))
+        # newRequestID() could fail with a DeadReferenceError
+        reqID = broker.newRequestID()
+        interfaceName = None
+        if self.rref.tracker.interface:
+            interfaceName = self.rref.tracker.interface.__remote_name__
+        req = call.PendingRequest(reqID, self.rref, interfaceName, "<batch>")
+        req.interfaceName = interfaceName
+        req.methodName = "<batch>"
+        # one result constraint per call, see BatchAnswerUnslicer
+        req.setConstraint([c[5] for c in calls])
+        slicer = call.BatchSlicer(reqID, self.rref.tracker.clid,
+                                  [(c[0], c[1], c[2]) for c in calls])
+        broker.addRequest(req)
+        try:
+            d = broker.send(slicer, priority)
+            d.addErrback(req.fail)
+        except:
+            req.fail(failure.Failure())
+        return req
+
+    def _deliver(self, res, d):
+        if d.called:
+            return # the caller has cancelled it
+        if isinstance(res, failure.Failure):
+            d.errback(res)
+        else:
+            d.callback(res)
+
+    def _distribute(self, results, ds):
+        for ((ok, res), d) in zip(results, ds):
+            self._deliver(res, d)
+
+    def _failAll(self, f, ds):
+        for d in ds:
+            self._deliver(f, d)
+
+    def cancel(self):
+        """Give up on every call in this batch. The far end is asked to
+        abandon any that it has started, and their Deferreds errback with
+        defer.CancelledError."""
+        for entry in self.calls:
+            entry[-1].cancel()
+        self.calls = []
+        for d in self._pending:
+            d.cancel()
+
 
 class RemoteMethodReferenceTracker(RemoteReferenceTracker):
     def getRef(self):
@@ -757,9 +1057,7 @@ class TheirReferenceUnslicer(slicer.LeafUnslicer):
     def ackGift(self, rref):
         # giftID==0 means they aren't doing reference counting
         if self.giftID != 0:
-            rb = self.broker.remote_broker
-            # if we lose the connection, they'll decref the gift anyway
-            rb.callRemoteOnly("decgift", giftID=self.giftID, count=1)
+            self.broker.freeGift(self.giftID)
         return rref
 
     def describe(self):
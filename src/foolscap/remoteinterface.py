@@ -6,6 +6,7 @@ from foolscap.constraint import Constraint, OpenerConstraint, nothingTaster, \
      IConstraint, IRemoteMethodConstraint, Optional, Any
 from foolscap.tokens import Violation, InvalidRemoteInterface
 from foolscap.schema import addToConstraintTypeMap
+from foolscap.slicers.root import PRIORITIES
 from foolscap import ipb
 
 class RemoteInterfaceClass(interface.InterfaceClass):
@@ -123,6 +124,26 @@ def registerRemoteInterface(iface, name=None):
 def getRemoteInterfaceByName(iname):
     return RemoteInterfaceRegistry.get(iname)
 
+def _checkPriority(priority):
+    if priority is not None and priority not in PRIORITIES:
+        raise InvalidRemoteInterface("send priority must be one of %s, not %r"
+                                     % (", ".join(PRIORITIES), priority))
+
+def sendPriority(priority):
+    """Decorate a RemoteInterface method to set the send priority ('control',
+    'interactive', or 'bulk') of calls to it, and of the answers it returns::
+
+     class RIStore(RemoteInterface):
+         @sendPriority("bulk")
+         def get(name=bytes):
+             return bytes
+    """
+    _checkPriority(priority)
+    def _setPriority(method):
+        method.__priority__ = priority
+        return method
+    return _setPriority
+
 
 @implementer(IRemoteMethodConstraint)
 class RemoteMethodSchema(object):
@@ -140,6 +161,9 @@ class RemoteMethodSchema(object):
     __acceptUnknown__: if True, unexpected argument names are always
     accepted without a constraint (which also makes this schema unbounded)
 
+    __priority__: the send priority of calls to this method and of their
+    answers, see sendPriority()
+
     The remotely-accesible object's .getMethodSchema() method may return one
     of these objects.
     """
@@ -148,6 +172,7 @@ class RemoteMethodSchema(object):
     opentypes = [] # overkill
     ignoreUnknown = False
     acceptUnknown = False
+    priority = None # send priority, None means the default (interactive)
 
     name = None # method name, set when the RemoteInterface is parsed
     interface = None # points to the RemoteInterface which defines the method
@@ -174,6 +199,9 @@ class RemoteMethodSchema(object):
         if "__acceptUnknown__" in kwargs:
             self.acceptUnknown = kwargs["__acceptUnknown__"]
             del kwargs["__acceptUnknown__"]
+        if "__priority__" in kwargs:
+            self.priority = kwargs.pop("__priority__")
+            _checkPriority(self.priority)
 
         for argname, constraint in list(kwargs.items()):
             self.argumentNames.append(argname)
@@ -181,6 +209,7 @@ class RemoteMethodSchema(object):
             self.argConstraints[argname] = constraint
             if not isinstance(constraint, Optional):
                 self.required.append(argname)
+        self.compile()
 
     def initFromMethod(self, method):
         # call this with the Interface's prototype method: the one that has
@@ -217,33 +246,53 @@ class RemoteMethodSchema(object):
         # call the method, its 'return' value is the return constraint
         self.responseConstraint = IConstraint(method())
         self.options = {} # return, wait, reliable, etc
+        self.priority = getattr(method, "__priority__", None)
+        self.compile()
+
+    def compile(self):
+        """Digest the argument and response constraints into the tables that
+        the per-call methods use, so that each call only does lookups. This
+        is run once, when the RemoteInterface is defined: call it again if
+        you modify the schema afterwards."""
+        self._argIndex = {}
+        self._argConstraints = {} # argname -> (True, constraint)
+        self._checkers = [] # (argname, checkObject or None), by position
+        self._unenforced = [] # (argpos, argname, checkObject)
+        for i, argname in enumerate(self.argumentNames):
+            c = self.argConstraints[argname]
+            if isinstance(c, Optional):
+                c = c.constraint
+            self._argIndex[argname] = i
+            self._argConstraints[argname] = (True, c)
+            check = None
+            if type(c).checkObject is not Constraint.checkObject:
+                check = c.checkObject
+            self._checkers.append((argname, check))
+            if check and not c.enforcedOnReceive():
+                self._unenforced.append((i, argname, check))
+        self._required = [(self._argIndex[argname], argname)
+                          for argname in self.required]
+        self._checkResults = None
+        c = self.responseConstraint
+        if c and type(c).checkObject is not Constraint.checkObject:
+            self._checkResults = c.checkObject
 
 
     def getPositionalArgConstraint(self, argnum):
         if argnum >= len(self.argumentNames):
             raise Violation("too many positional arguments: %d >= %d" %
                             (argnum, len(self.argumentNames)))
-        argname = self.argumentNames[argnum]
-        c = self.argConstraints.get(argname)
-        assert c
-        if isinstance(c, Optional):
-            c = c.constraint
-        return (True, c)
+        return self._argConstraints[self.argumentNames[argnum]]
 
     def getKeywordArgConstraint(self, argname,
                                 num_posargs=0, previous_kwargs=[]):
-        previous_args = self.argumentNames[:num_posargs]
-        for pkw in previous_kwargs:
-            assert pkw not in previous_args
-            previous_args.append(pkw)
-        if argname in previous_args:
+        argpos = self._argIndex.get(argname)
+        if ((argpos is not None and argpos < num_posargs)
+            or argname in previous_kwargs):
             raise Violation("got multiple values for keyword argument '%s'"
                             % (argname,))
-        c = self.argConstraints.get(argname)
-        if c:
-            if isinstance(c, Optional):
-                c = c.constraint
-            return (True, c)
+        if argpos is not None:
+            return self._argConstraints[argname]
         # what do we do with unknown arguments?
         if self.ignoreUnknown:
             return (False, None)
@@ -255,40 +304,63 @@ class RemoteMethodSchema(object):
         return self.responseConstraint
 
     def checkAllArgs(self, args, kwargs, inbound):
-        # first we map the positional arguments
-        allargs = {}
-        if len(args) > len(self.argumentNames):
+        numargs = len(args)
+        if numargs > len(self.argumentNames):
             raise Violation("method takes %d positional arguments (%d given)"
-                            % (len(self.argumentNames), len(args)))
-        for i,argvalue in enumerate(args):
-            allargs[self.argumentNames[i]] = argvalue
-        for argname,argvalue in list(kwargs.items()):
-            if argname in allargs:
+                            % (len(self.argumentNames), numargs))
+        checkers = self._checkers
+        # first the positional arguments
+        for i in range(numargs):
+            argname, check = checkers[i]
+            if check:
+                self._checkArg(check, argname, args[i], inbound)
+        for argname, argvalue in kwargs.items():
+            argpos = self._argIndex.get(argname)
+            if argpos is None:
+                # unknown arguments are either ignored by the far end (TODO:
+                # emit a warning), accepted without a constraint, or refused
+                if self.ignoreUnknown or self.acceptUnknown:
+                    continue
+                raise Violation("unknown argument '%s'" % argname)
+            if argpos < numargs:
                 raise Violation("got multiple values for keyword argument '%s'"
                                 % (argname,))
-            allargs[argname] = argvalue
-
-        for argname, argvalue in list(allargs.items()):
-            accept, constraint = self.getKeywordArgConstraint(argname)
-            if not accept:
-                # this argument will be ignored by the far end. TODO: emit a
-                # warning
-                pass
-            try:
-                constraint.checkObject(argvalue, inbound)
-            except Violation as v:
-                v.setLocation("%s=" % argname)
-                raise
-
-        for argname in self.required:
-            if argname not in allargs:
+            check = checkers[argpos][1]
+            if check:
+                self._checkArg(check, argname, argvalue, inbound)
+        self._checkRequired(numargs, kwargs)
+
+    def checkReceivedArgs(self, args, kwargs):
+        """Like checkAllArgs(inbound=True), for arguments which were checked
+        token-by-token as they arrived (by an ArgumentUnslicer that saw no
+        shared references). Those have already been matched against the
+        argument names, so this only looks for missing arguments, and for
+        arguments whose constraints could not be enforced on the wire."""
+        numargs = len(args)
+        for argpos, argname, check in self._unenforced:
+            if argpos < numargs:
+                self._checkArg(check, argname, args[argpos], True)
+            elif argname in kwargs:
+                self._checkArg(check, argname, kwargs[argname], True)
+        self._checkRequired(numargs, kwargs)
+
+    def _checkArg(self, check, argname, argvalue, inbound):
+        try:
+            check(argvalue, inbound)
+        except Violation as v:
+            v.setLocation("%s=" % argname)
+            raise
+
+    def _checkRequired(self, numargs, kwargs):
+        for argpos, argname in self._required:
+            if argpos >= numargs and argname not in kwargs:
                 raise Violation("missing required argument '%s'" % argname)
 
     def checkResults(self, results, inbound):
-        if self.responseConstraint:
+        if self._checkResults:
             # this might raise a Violation. The caller will annotate its
             # location appropriately: they have more information than we do.
-            self.responseConstraint.checkObject(results, inbound)
+            self._checkResults(results, inbound)
 
 @implementer(IRemoteMethodConstraint)
 class UnconstrainedMethod(object):
@@ -310,6 +382,8 @@ class UnconstrainedMethod(object):
         return (True, Any())
     def checkAllArgs(self, args, kwargs, inbound):
         pass # accept everything
+    def checkReceivedArgs(self, args, kwargs):
+        pass
     def getResponseConstraint(self):
         return Any()
     def checkResults(self, results, inbound):
@@ -59,7 +59,8 @@ from foolscap.tokens import Violation, UnknownSchemaType, BananaError, \
 
 # make constraints available in a single location
 from foolscap.constraint import Constraint, Any, ByteStringConstraint, \
-     IntegerConstraint, NumberConstraint, IConstraint, Optional, Shared
+     SpooledStringConstraint, IntegerConstraint, NumberConstraint, \
+     IConstraint, Optional, Shared
 from foolscap.slicers.unicode import UnicodeConstraint
 from foolscap.slicers.bool import BooleanConstraint
 from foolscap.slicers.dict import DictConstraint
@@ -69,7 +70,8 @@ from foolscap.slicers.tuple import TupleConstraint
 from foolscap.slicers.none import Nothing
 #  we don't import RemoteMethodSchema from remoteinterface.py, because
 #  remoteinterface.py needs to import us (for addToConstraintTypeMap)
-ignored = [Constraint, Any, ByteStringConstraint, UnicodeConstraint,
+ignored = [Constraint, Any, ByteStringConstraint, SpooledStringConstraint,
+           UnicodeConstraint,
            IntegerConstraint, NumberConstraint, BooleanConstraint,
            DictConstraint, ListConstraint, SetConstraint, TupleConstraint,
            Nothing, Optional, Shared,
@@ -82,6 +84,19 @@ ListOf = ListConstraint
 DictOf = DictConstraint
 SetOf = SetConstraint
 
+class StreamConstraint(ListConstraint):
+    """The answer of a method which streams its results, by returning an
+    iterator (see foolscap.streaming). Each item must obey the given
+    constraint, and there may be any number of them. Peers which cannot
+    receive streams get the items as a single list, so this accepts a list
+    too."""
+    name = "StreamConstraint"
+
+    def __init__(self, constraint):
+        ListConstraint.__init__(self, constraint, maxLength=None)
+
+StreamOf = StreamConstraint
+
 
 # note: using PolyConstraint (aka ChoiceOf) for inbound tasting is probably
 # not fully vetted. One of the issues would be with something like
@@ -198,6 +198,26 @@ class BaseUnslicer(metaclass=UnslicerClass):
 
         return self.open(opentype)
 
+    def primitiveSink(self):
+        """Containers may return a (receive, check) tuple to let Banana hand
+        them runs of primitive tokens (ints, strings, and floats) without
+        going through receiveChild() for each one. receive(obj) must do what
+        receiveChild(obj) would do. check(typebyte, size) is called before
+        each token, just like checkToken(), and may be None if every token
+        is acceptable. Return None to see each token the usual way.
+        """
+        return None
+
+    def openStringSpool(self, size):
+        """Called when a STRING token of 'size' bytes is about to be
+        received, after checkToken() has accepted it. Return a file-like
+        object to have the body written to it as it arrives, instead of
+        being held in memory: the object (rewound, if it can seek) is then
+        passed to receiveChild() in place of the bytes. Return None to
+        receive the bytes the usual way.
+        """
+        return None
+
     def receiveChild(self, obj, ready_deferred=None):
         """Unslicers for containers should accumulate their children's
         ready_deferreds, then combine them in an AsyncAND when receiveClose()
@@ -216,14 +236,19 @@ class BaseUnslicer(metaclass=UnslicerClass):
         pass
 
 
+    # set this to True to hold references for your children: see setObject
+    referenceScope = False
+
     def setObject(self, counter, obj):
         """To pass references to previously-sent objects, the [OPEN,
         'reference', number, CLOSE] sequence is used. The numbers are
         generated implicitly by the sending Banana, counting from 0 for the
         object described by the very first OPEN sent over the wire,
         incrementing for each subsequent one. The objects themselves are
-        stored in any/all Unslicers who cares to. Generally this is the
-        RootUnslicer, but child slices could do it too if they wished.
+        stored by the outermost Unslicer on the receive stack which has
+        .referenceScope set, and are forgotten when that Unslicer is
+        popped. Generally this is the RootUnslicer, but child slices could
+        do it too if they wished.
         """
         # TODO: examine how abandoned child objects could mess up this
         # counter
@@ -255,6 +280,8 @@ class ScopedUnslicer(BaseUnslicer):
     """This Unslicer provides a containing scope for referenceable things
     like lists. It corresponds to the ScopedSlicer base class."""
 
+    referenceScope = True
+
     def __init__(self):
         BaseUnslicer.__init__(self)
         self.references = {}
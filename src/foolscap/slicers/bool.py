@@ -70,3 +70,6 @@ class BooleanConstraint(OpenerConstraint):
         if self.value != None:
             if obj != self.value:
                 raise Violation("not %s" % self.value)
+
+    def enforcedOnReceive(self):
+        return True
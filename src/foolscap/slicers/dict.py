@@ -1,5 +1,6 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
+from itertools import chain
 from twisted.python import log
 from twisted.internet.defer import Deferred
 from foolscap.tokens import Violation, BananaError
@@ -12,6 +13,10 @@ class DictSlicer(BaseSlicer):
     trackReferences = True
     slices = None
     def sliceBody(self, streamable, banana):
+        if (banana.canSendPrimitives(self.obj.keys())
+            and banana.canSendPrimitives(self.obj.values())):
+            banana.sendPrimitives(chain.from_iterable(self.obj.items()))
+            return
         for key,value in list(self.obj.items()):
             yield key
             yield value
@@ -69,6 +74,28 @@ class DictUnslicer(BaseUnslicer):
                     unslicer.setConstraint(self.valueConstraint)
         return unslicer
 
+    def primitiveSink(self):
+        cls = type(self)
+        if (cls.receiveChild is not DictUnslicer.receiveChild
+            or cls.receiveKey is not DictUnslicer.receiveKey
+            or cls.receiveValue is not DictUnslicer.receiveValue):
+            return None # a subclass wants to see every child
+        check = None
+        if (self.maxKeys is not None or self.keyConstraint
+            or self.valueConstraint):
+            check = self.checkToken
+        return self.receivePrimitive, check
+
+    def receivePrimitive(self, obj):
+        # receiveChild() for a key or value which cannot be a Deferred
+        if self.gettingKey:
+            if obj in self.d:
+                raise BananaError("duplicate key '%s'" % obj)
+            self.key = obj
+        else:
+            self.d[self.key] = obj
+        self.gettingKey = not self.gettingKey
+
     def update(self, value, key):
         # this is run as a Deferred callback, hence the backwards arguments
         self.d[key] = value
@@ -121,6 +148,12 @@ class OrderedDictSlicer(DictSlicer):
     def sliceBody(self, streamable, banana):
         keys = list(self.obj.keys())
         keys.sort()
+        if (banana.canSendPrimitives(keys)
+            and banana.canSendPrimitives(self.obj.values())):
+            obj = self.obj
+            banana.sendPrimitives(chain.from_iterable((key, obj[key])
+                                                      for key in keys))
+            return
         for key in keys:
             value = self.obj[key]
             yield key
@@ -143,3 +176,7 @@ class DictConstraint(OpenerConstraint):
         for key, value in obj.items():
             self.keyConstraint.checkObject(key, inbound)
             self.valueConstraint.checkObject(value, inbound)
+
+    def enforcedOnReceive(self):
+        return (self.keyConstraint.enforcedOnReceive() and
+                self.valueConstraint.enforcedOnReceive())
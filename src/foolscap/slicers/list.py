@@ -14,6 +14,9 @@ class ListSlicer(BaseSlicer):
     slices = list
 
     def sliceBody(self, streamable, banana):
+        if banana.canSendPrimitives(self.obj):
+            banana.sendPrimitives(self.obj)
+            return
         for i in self.obj:
             yield i
 
@@ -64,6 +67,14 @@ class ListUnslicer(BaseUnslicer):
                 unslicer.setConstraint(self.itemConstraint)
         return unslicer
 
+    def primitiveSink(self):
+        if type(self).receiveChild is not ListUnslicer.receiveChild:
+            return None # a subclass wants to see every child
+        check = None
+        if self.maxLength is not None or self.itemConstraint:
+            check = self.checkToken
+        return self.list.append, check
+
     def update(self, obj, index):
         # obj has already passed typechecking
         if self.debug:
@@ -135,3 +146,7 @@ class ListConstraint(OpenerConstraint):
             raise Violation("list too short")
         for o in obj:
             self.constraint.checkObject(o, inbound)
+
+    def enforcedOnReceive(self):
+        # ListUnslicer enforces maxLength, but not minLength
+        return self.minLength == 0 and self.constraint.enforcedOnReceive()
@@ -32,3 +32,6 @@ class Nothing(OpenerConstraint):
     def checkObject(self, obj, inbound):
         if obj is not None:
             raise Violation("'%s' is not None" % (obj,))
+
+    def enforcedOnReceive(self):
+        return True
@@ -1,8 +1,10 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
 import six
-from zope.interface import implementer
+from collections import deque
+from zope.interface import implementer, implementedBy, providedBy
 from twisted.internet.defer import Deferred
+from twisted.python.components import globalRegistry
 from foolscap import tokens
 from foolscap.tokens import Violation, BananaError
 from foolscap.slicer import BaseUnslicer, ReferenceSlicer
@@ -13,17 +15,285 @@ from foolscap import copyable # does this create a cycle?
 from twisted.python import log
 from functools import reduce
 
+def _adaptSlowly(obj):
+    # do the adapter lookup first, so that registered adapters override
+    # UnsafeSlicerTable's InstanceSlicer
+    slicer = tokens.ISlicer(obj, None)
+    if slicer:
+        return slicer
+
+    # zope.interface doesn't do transitive adaptation, which is a shame
+    # because we want to let people register ICopyable adapters for
+    # third-party code, and there is an ICopyable->ISlicer adapter
+    # defined in copyable.py, but z.i won't do the transitive
+    #  ThirdPartyClass -> ICopyable -> ISlicer
+    # so instead we manually do it here
+    copier = copyable.ICopyable(obj, None)
+    if copier:
+        return tokens.ISlicer(copier)
+    return None
+
+def _adaptItself(obj):
+    return obj
+
+def _findAdapter(typ):
+    """Work out how _adaptSlowly() would handle any instance of 'typ' which
+    has no interface declarations of its own. Returns a function that turns
+    such an instance into an ISlicer, or None if the slicerTable should be
+    consulted instead."""
+    if hasattr(typ, "__conform__"):
+        # the object gets a say in its own adaptation, so we cannot predict
+        # the outcome from the type alone
+        return _adaptSlowly
+    if tokens.ISlicer.implementedBy(typ):
+        return _adaptItself
+    provides = implementedBy(typ)
+    factory = globalRegistry.lookup1(provides, tokens.ISlicer)
+    if factory is not None:
+        return factory
+    if copyable.ICopyable.implementedBy(typ):
+        return tokens.ISlicer
+    copierFactory = globalRegistry.lookup1(provides, copyable.ICopyable)
+    if copierFactory is not None:
+        def _adaptCopier(obj):
+            copier = copierFactory(obj)
+            if copier:
+                return tokens.ISlicer(copier)
+            return None
+        return _adaptCopier
+    return None
+
+# maps type to (the __sro__ of its declaration, the result of
+# _findAdapter()). Every registerAdapter() (and therefore every
+# registerCopier()) bumps the registry's generation, which throws the whole
+# cache away. classImplements() (on the type or any of its bases) leaves
+# the generation alone, but gives the declaration a new __sro__, which
+# throws away that entry.
+_adapterCache = {}
+_adapterCacheGeneration = None
+
+def adapterForType(typ, spec=None):
+    global _adapterCacheGeneration
+    if _adapterCacheGeneration != globalRegistry._generation:
+        _adapterCache.clear()
+        _adapterCacheGeneration = globalRegistry._generation
+    if spec is None:
+        spec = implementedBy(typ)
+    entry = _adapterCache.get(typ)
+    if entry is not None and entry[0] is spec.__sro__:
+        return entry[1]
+    adapter = _findAdapter(typ)
+    _adapterCache[typ] = (spec.__sro__, adapter)
+    return adapter
+
+# Send priorities, most urgent first. Each has its own lane in the
+# SendQueue, and the RootSlicer always starts on the most urgent object it
+# has. Once an object has started to be serialized, it is finished before
+# anything else is sent, so big objects should be sent in chunks (as byte
+# streams and streamed answers are) if they are to let others through.
+CONTROL = "control"
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (CONTROL, INTERACTIVE, BULK)
+
+# _Lane.charging when there is nothing to charge for. None is the default
+# flow, so it cannot mean that too.
+_NOT_CHARGING = object()
+
+class _Lane:
+    # the entries of one priority, in one FIFO per flow. Flows with entries
+    # take turns, deficit-round-robin style: each turn adds 'quantum' bytes
+    # to the flow's deficit, and the flow keeps sending objects until the
+    # bytes they turned out to need have used it up. An overdrawn flow
+    # waits for as many turns as it takes to get back above zero. A flow
+    # which has the lane to itself is not charged at all.
+
+    def __init__(self):
+        self.flows = {} # flow -> deque of entries
+        self.active = deque() # flows with entries, the current turn first
+        self.deficits = {} # flow -> bytes
+        self.turnStarted = False # whether active[0] has had its quantum
+        # the flow to charge for the current object, if it needs charging
+        self.charging = _NOT_CHARGING
+        self.size = 0
+        # statistics
+        self.bytesCharged = 0
+        self.objectsSent = 0
+        self.turns = 0
+
+    def append(self, entry, flow):
+        queue = self.flows.get(flow)
+        if queue is None:
+            queue = self.flows[flow] = deque()
+            self.active.append(flow)
+            self.deficits.setdefault(flow, 0)
+        queue.append(entry)
+        self.size += 1
+
+    def popleft(self, quantum):
+        # sets self.charging to its flow if the object must be charged for
+        active = self.active
+        self.size -= 1
+        self.objectsSent += 1
+        if len(active) == 1:
+            # nobody to share with
+            flow = active[0]
+            self.charging = _NOT_CHARGING
+        else:
+            deficits = self.deficits
+            if not (self.turnStarted and deficits[active[0]] > 0):
+                if self.turnStarted:
+                    active.rotate(-1)
+                while True:
+                    flow = active[0]
+                    deficits[flow] += quantum
+                    self.turns += 1
+                    if deficits[flow] > 0:
+                        break
+                    active.rotate(-1)
+                self.turnStarted = True
+            flow = active[0]
+            self.charging = flow
+        queue = self.flows[flow]
+        entry = queue.popleft()
+        if not queue:
+            self._retire(flow)
+        return entry
+
+    def _retire(self, flow):
+        # a flow with nothing left to send loses its turn and its deficit,
+        # once any object it has in progress has been charged
+        del self.flows[flow]
+        if self.active[0] == flow:
+            self.turnStarted = False
+        self.active.remove(flow)
+        if flow != self.charging:
+            del self.deficits[flow]
+
+    def charge(self, size):
+        flow = self.charging
+        self.charging = _NOT_CHARGING
+        self.bytesCharged += size
+        if flow in self.flows:
+            self.deficits[flow] -= size
+        else:
+            self.deficits.pop(flow, None)
+
+    def remove(self, entry):
+        for flow, queue in list(self.flows.items()):
+            if entry in queue:
+                queue.remove(entry)
+                self.size -= 1
+                if not queue:
+                    self._retire(flow)
+                return True
+        return False
+
+    def __iter__(self):
+        for flow in self.active:
+            for entry in self.flows[flow]:
+                yield entry
+
+
+class SendQueue:
+    """The objects waiting to be serialized, as (obj, Deferred) entries, in
+    one lane per priority. This otherwise behaves like the deque it
+    replaced: len() and iteration cover every lane, most urgent first.
+
+    The next entry always comes from the most urgent lane that has any.
+    Within a lane, entries belong to flows (the default flow is None), and
+    the flows share the lane by deficit round robin, with turns of
+    'quantum' bytes. An entry is never sent ahead of anything which was
+    queued before it in the same flow of its lane, or in a more urgent
+    lane. So a message which must follow another can safely go in the same
+    flow, or in the default flow of a less urgent lane."""
+
+    def __init__(self, quantum=65536):
+        self.quantum = quantum
+        self.lanes = [_Lane() for priority in PRIORITIES]
+        self.laneNumbers = dict([(priority, i)
+                                 for (i, priority) in enumerate(PRIORITIES)])
+        self.size = 0
+        # the lane of the last entry taken, while it needs charging for.
+        # Whoever serializes that entry should pass its size to charge().
+        self.charging = None
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for lane in self.lanes:
+            for entry in lane:
+                yield entry
+
+    def append(self, entry, priority=INTERACTIVE, flow=None):
+        try:
+            lane = self.lanes[self.laneNumbers[priority]]
+        except KeyError:
+            raise ValueError("unknown send priority %r" % (priority,))
+        lane.append(entry, flow)
+        self.size += 1
+
+    def popleft(self):
+        for lane in self.lanes:
+            if lane.size:
+                self.size -= 1
+                entry = lane.popleft(self.quantum)
+                if lane.charging is not _NOT_CHARGING:
+                    self.charging = lane
+                return entry
+        raise IndexError("pop from an empty SendQueue")
+
+    def charge(self, size):
+        """Record that the entry most recently taken by popleft() turned out
+        to need 'size' bytes."""
+        lane, self.charging = self.charging, None
+        if lane is not None:
+            lane.charge(size)
+
+    def remove(self, entry):
+        for lane in self.lanes:
+            if lane.remove(entry):
+                self.size -= 1
+                return
+        raise ValueError("entry is not queued")
+
+    def getLaneSizes(self):
+        """Return a dict mapping each priority to the number of objects
+        waiting in its lane."""
+        return dict([(priority, lane.size)
+                     for (priority, lane) in zip(PRIORITIES, self.lanes)])
+
+    def getStats(self):
+        """Return a dict mapping each priority to a dict of statistics for
+        its lane: 'objectsSent' so far, 'bytesCharged' (the bytes sent
+        while flows were sharing the lane), 'turns' (the number of quanta
+        handed out), and 'flows', which maps each flow that has objects
+        waiting to a (queued objects, deficit in bytes) tuple."""
+        stats = {}
+        for (priority, lane) in zip(PRIORITIES, self.lanes):
+            flows = dict([(flow, (len(queue), lane.deficits[flow]))
+                          for (flow, queue) in lane.flows.items()])
+            stats[priority] = {"objectsSent": lane.objectsSent,
+                               "bytesCharged": lane.bytesCharged,
+                               "turns": lane.turns,
+                               "flows": flows,
+                               }
+        return stats
+
 @implementer(tokens.ISlicer, tokens.IRootSlicer)
 class RootSlicer:
     streamableInGeneral = True
     producingDeferred = None
     objectSentDeferred = None
+    objectStart = None # getBytesProduced() when the current object began
     slicerTable = {}
     debug = False
+    sendQuantum = 64*1024 # bytes per deficit-round-robin turn
 
     def __init__(self, protocol):
         self.protocol = protocol
-        self.sendQueue = []
+        self.sendQueue = SendQueue(self.sendQuantum)
 
     def allowStreaming(self, streamable):
         self.streamableInGeneral = streamable
@@ -32,30 +302,26 @@ class RootSlicer:
         pass
 
     def slicerForObject(self, obj):
-        # could use a table here if you think it'd be faster than an
-        # adapter lookup
         if self.debug: log.msg("slicerForObject(%s)" % type(obj))
 
-        # do the adapter lookup first, so that registered adapters override
-        # UnsafeSlicerTable's InstanceSlicer
-        slicer = tokens.ISlicer(obj, None)
-        if slicer:
-            if self.debug: log.msg("got ISlicer %s" % slicer)
-            return slicer
-
-        # zope.interface doesn't do transitive adaptation, which is a shame
-        # because we want to let people register ICopyable adapters for
-        # third-party code, and there is an ICopyable->ISlicer adapter
-        # defined in copyable.py, but z.i won't do the transitive
-        #  ThirdPartyClass -> ICopyable -> ISlicer
-        # so instead we manually do it here
-
-        copier = copyable.ICopyable(obj, None)
-        if copier:
-            s = tokens.ISlicer(copier)
-            return s
-
-        slicerFactory = self.slicerTable.get(type(obj))
+        typ = type(obj)
+        spec = implementedBy(typ)
+        if providedBy(obj) is spec:
+            # the usual case: the object's interfaces all come from its
+            # class, so every instance adapts the same way
+            adapter = adapterForType(typ, spec)
+        else:
+            # alsoProvides() was used on this particular object
+            adapter = _adaptSlowly
+        if adapter is not None:
+            slicer = adapter(obj)
+            if slicer:
+                if self.debug: log.msg("got ISlicer %s" % slicer)
+                return slicer
+
+        # the slicerTable is consulted afresh every time, so it may be
+        # changed at any point
+        slicerFactory = self.slicerTable.get(typ)
         if slicerFactory:
             if self.debug: log.msg(" got slicerFactory %s" % slicerFactory)
             return slicerFactory(obj)
@@ -74,11 +340,20 @@ class RootSlicer:
         return self
 
     def __next__(self):
+        if self.objectStart is not None:
+            # charge the object we just finished to its flow
+            size = self.protocol.getBytesProduced() - self.objectStart
+            self.objectStart = None
+            self.sendQueue.charge(size)
         if self.objectSentDeferred:
             self.objectSentDeferred.callback(None)
             self.objectSentDeferred = None
-        if self.sendQueue:
-            (obj, self.objectSentDeferred) = self.sendQueue.pop()
+        queue = self.sendQueue
+        if queue:
+            (obj, self.objectSentDeferred) = queue.popleft()
+            if queue.charging is not None:
+                # its flow is sharing the lane, so we measure it
+                self.objectStart = self.protocol.getBytesProduced()
             self.streamable = self.streamableInGeneral
             return obj
         if self.protocol.debugSend:
@@ -94,12 +369,14 @@ class RootSlicer:
         self.objectSentDeferred = None
         return None
 
-    def send(self, obj):
+    def send(self, obj, priority=INTERACTIVE, flow=None):
         # obj can also be a Slicer, say, a CallSlicer. We return a Deferred
-        # which fires when the object has been fully serialized.
+        # which fires when the object has been fully serialized. 'priority'
+        # picks the SendQueue lane it waits in, and 'flow' the flow within
+        # that lane.
         idle = (len(self.protocol.slicerStack) == 1) and not self.sendQueue
         objectSentDeferred = Deferred()
-        self.sendQueue.append((obj, objectSentDeferred))
+        self.sendQueue.append((obj, objectSentDeferred), priority, flow)
         if idle:
             # wake up
             if self.protocol.debugSend:
@@ -120,9 +397,10 @@ class RootSlicer:
         if self.objectSentDeferred:
             self.objectSentDeferred.errback(why)
             self.objectSentDeferred = None
-        for obj, d in self.sendQueue:
+        queue, self.sendQueue = self.sendQueue, SendQueue(self.sendQuantum)
+        self.objectStart = None
+        for obj, d in queue:
             d.errback(why)
-        self.sendQueue = []
 
 class ScopedRootSlicer(RootSlicer):
     # this combines RootSlicer with foolscap.slicer.ScopedSlicer . The funny
@@ -149,6 +427,23 @@ class ScopedRootSlicer(RootSlicer):
 
 
 
+# a new RootUnslicer is made for every connection (and for every call to
+# storage.unserialize), so remember the answer. Registries only ever grow,
+# so their sizes tell us when to work it out again.
+_maxIndexLengths = {}
+
+def _maxIndexLength(registries):
+    key = tuple([(id(r), len(r)) for r in registries])
+    try:
+        return _maxIndexLengths[key]
+    except KeyError:
+        keys = []
+        for r in registries:
+            for k in list(r.keys()):
+                keys.append(len(k[0]))
+        length = _maxIndexLengths[key] = reduce(max, keys)
+        return length
+
 class RootUnslicer(BaseUnslicer):
     # topRegistries is used for top-level objects
     topRegistries = [UnslicerRegistry, BananaUnslicerRegistry]
@@ -160,11 +455,8 @@ class RootUnslicer(BaseUnslicer):
     def __init__(self, protocol):
         self.protocol = protocol
         self.objects = {}
-        keys = []
-        for r in self.topRegistries + self.openRegistries:
-            for k in list(r.keys()):
-                keys.append(len(k[0]))
-        self.maxIndexLength = reduce(max, keys)
+        self.maxIndexLength = _maxIndexLength(self.topRegistries
+                                              + self.openRegistries)
 
     def start(self, count):
         pass
@@ -272,6 +564,8 @@ class RootUnslicer(BaseUnslicer):
 class ScopedRootUnslicer(RootUnslicer):
     # combines RootUnslicer and ScopedUnslicer
 
+    referenceScope = True
+
     def __init__(self, protocol):
         RootUnslicer.__init__(self, protocol)
         self.references = {}
@@ -15,6 +15,9 @@ class SetSlicer(ListSlicer):
     slices = set
 
     def sliceBody(self, streamable, banana):
+        if banana.canSendPrimitives(self.obj):
+            banana.sendPrimitives(self.obj)
+            return
         for i in self.obj:
             yield i
 
@@ -172,3 +175,7 @@ class SetConstraint(OpenerConstraint):
         if self.constraint:
             for o in obj:
                 self.constraint.checkObject(o, inbound)
+
+    def enforcedOnReceive(self):
+        # SetUnslicer doesn't know about 'mutable'
+        return self.mutable is None and self.constraint.enforcedOnReceive()
@@ -56,6 +56,14 @@ class TupleUnslicer(BaseUnslicer):
                 unslicer.setConstraint(self.constraints[where])
         return unslicer
 
+    def primitiveSink(self):
+        if type(self).receiveChild is not TupleUnslicer.receiveChild:
+            return None # a subclass wants to see every child
+        check = None
+        if self.constraints is not None:
+            check = self.checkToken
+        return self.list.append, check
+
     def update(self, obj, index):
         if self.debug:
             print("%s[%d].update: [%d]=%s" % (self, self.count, index, obj))
@@ -104,6 +112,9 @@ class TupleUnslicer(BaseUnslicer):
     def receiveClose(self):
         if self.debug:
             print("%s[%d].receiveClose" % (self, self.count))
+        if (self.constraints is not None
+            and len(self.list) < len(self.constraints)):
+            raise Violation("wrong size tuple")
         self.finished = 1
 
         if self.num_unreferenceable_children:
@@ -135,3 +146,9 @@ class TupleConstraint(OpenerConstraint):
             raise Violation("wrong size tuple")
         for i in range(len(self.constraints)):
             self.constraints[i].checkObject(obj[i], inbound)
+
+    def enforcedOnReceive(self):
+        for c in self.constraints:
+            if not c.enforcedOnReceive():
+                return False
+        return True
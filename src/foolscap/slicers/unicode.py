@@ -36,6 +36,9 @@ class UnicodeUnslicer(LeafUnslicer):
         if self.string != None:
             raise BananaError("already received a string")
         self.string = obj.decode("UTF-8")
+        if self.constraint:
+            # the taster can't look at characters, so check them here
+            self.constraint.checkObject(self.string, True)
 
     def receiveClose(self):
         return self.string, None
@@ -83,3 +86,6 @@ class UnicodeConstraint(OpenerConstraint):
         if self.regexp:
             if not self.regexp.search(obj):
                 raise Violation("regexp failed to match")
+
+    def enforcedOnReceive(self):
+        return True # UnicodeUnslicer checks the whole string
@@ -114,7 +114,7 @@ class AddVocabSlicer(BaseSlicer):
     trackReferences = False
 
     def __init__(self, value):
-        assert isinstance(value, str)
+        assert isinstance(value, bytes)
         self.value = value
 
     def slice(self, streamable, banana):
@@ -12,7 +12,9 @@ over network connections.
 from io import BytesIO
 
 from foolscap import banana
+from foolscap.tokens import Violation, BananaError
 from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 from foolscap.slicers.root import ScopedRootSlicer, ScopedRootUnslicer
 
 
@@ -58,11 +60,97 @@ class StorageBanana(banana.Banana):
         self.disconnectReason = f
         f.raiseException()
 
+class SynchronousStorageBanana(StorageBanana):
+    """I am a StorageBanana that serializes and unserializes in a single
+    call, without Deferreds, the RootSlicer's send queue, or a reactor. I
+    am used by serializeSync() and unserializeSync(), which are safe to call
+    from any thread.
+
+    Objects whose Slicers need to wait for something (by yielding a
+    Deferred which has not yet fired) cannot be serialized this way."""
+
+    def __init__(self):
+        StorageBanana.__init__(self)
+        self.results = []
+
+    def receiveChild(self, obj, ready_deferred):
+        self.results.append((obj, ready_deferred))
+
+    def serialize(self, obj):
+        self.initSlicer()
+        root = self.rootSlicer
+        # we cannot wait for anything, so tell the Slicers not to ask
+        root.streamable = False
+        stack = self.slicerStack
+        self.outputBuffer = out = bytearray()
+        self.outputChunks = chunks = []
+        try:
+            if type(obj) in banana.SIMPLE_TOKENS:
+                # the RootSlicer would send a top-level primitive as a bare
+                # token, so we do too
+                self.sendToken(obj)
+            else:
+                self.pushSlicer(self.newSlicerFor(obj), obj)
+            # this is produceTokens() without the recovery: any Violation
+            # simply abandons the whole serialization
+            while len(stack) > 1:
+                try:
+                    item = next(stack[-1][1])
+                except StopIteration:
+                    self.popSlicer()
+                    continue
+                if type(item) in banana.SIMPLE_TOKENS:
+                    self.sendToken(item)
+                elif isinstance(item, Deferred):
+                    _waitFor(item, stack[-1][0])
+                else:
+                    self.pushSlicer(self.newSlicerFor(item), item)
+        except Violation as v:
+            v.setLocation(self.describeSend())
+            raise
+        finally:
+            self.outputBuffer = self.outputChunks = None
+        chunks.append(bytes(out))
+        return b"".join(chunks)
+
+    def unserialize(self, data):
+        self.initUnslicer()
+        self.dataReceived(data) # protocol errors are raised from here
+        if self.violation:
+            self.violation.raiseException()
+        if not self.results:
+            raise BananaError("incomplete data: no object was finished")
+        if len(self.results) > 1:
+            raise BananaError("data holds %d objects, not one"
+                              % len(self.results))
+        if len(self.buffer):
+            raise BananaError("incomplete data: %d bytes left over"
+                              % len(self.buffer))
+        obj, ready_deferred = self.results[0]
+        if ready_deferred:
+            _waitFor(ready_deferred, obj)
+        if isinstance(obj, Deferred):
+            obj = _waitFor(obj, obj)
+        return obj
+
+def _waitFor(d, who):
+    # return the result of a Deferred which has already fired
+    results = []
+    d.addBoth(results.append)
+    if not results:
+        raise BananaError("%s is waiting for a Deferred, which cannot be "
+                          "done synchronously" % (who,))
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+    return results[0]
+
 class SerializerTransport:
     def __init__(self, sio):
         self.sio = sio
     def write(self, data):
         self.sio.write(data)
+    def writeSequence(self, iovec):
+        self.sio.writelines(iovec)
     def loseConnection(self, why="ignored"):
         pass
 
@@ -116,3 +204,17 @@ def unserialize(str_or_instream, banana=None, root_class=StorageRootUnslicer):
     d.addCallback(_report_error)
     return d
 
+
+def serializeSync(obj, root_class=StorageRootSlicer):
+    """Serialize an object graph into a sequence of bytes, and return them.
+    Violations are raised directly."""
+    b = SynchronousStorageBanana()
+    b.slicerClass = root_class
+    return b.serialize(obj)
+
+def unserializeSync(data, root_class=StorageRootUnslicer):
+    """Unserialize a sequence of bytes back into an object graph, and return
+    it. Violations and BananaErrors are raised directly."""
+    b = SynchronousStorageBanana()
+    b.unslicerClass = root_class
+    return b.unserialize(data)
@@ -0,0 +1,1009 @@
+# -*- test-case-name: foolscap.test.test_streaming -*-
+
+"""Streamed answers.
+
+A remote_ method which returns an iterator (or an async iterator) has its
+answer sent one chunk of items at a time, instead of as a single list::
+
+ class RIDatabase(RemoteInterface):
+     def rows(query=bytes): return StreamOf(TupleOf(int, bytes))
+
+ class Database(Referenceable):
+     def remote_rows(self, query):
+         for row in self.cursor.execute(query):
+             yield row
+
+The caller's Deferred fires with an AnswerStream as soon as the first chunk
+arrives. Its items can be read one at a time (each next() returns a
+Deferred), with 'async for', or all at once with consume(). The caller
+grants credit as it reads, and the far end stops pulling items from the
+iterator when the credit runs out, so neither side holds more than a window
+of items at once. Each item is checked against the StreamOf constraint.
+
+Peers which negotiated a version older than 7 cannot receive streams, so
+they get the items as a single list instead.
+
+Large arguments can be streamed too. Wrap a file, a bytes-like object (such
+as an mmap), or use a ByteSource as the consumer of an IPullProducer, and
+pass it to callRemote::
+
+ class RIStore(RemoteInterface):
+     def put(name=str, data=ByteSource): return None
+
+ rref.callRemote("put", "big.iso", ByteSource(open("big.iso", "rb")))
+
+The remote_ method is invoked as soon as the call arrives, with an
+IncomingByteStream in place of the ByteSource. The bytes follow the call in
+bounded chunks: the sender only reads more from the source when the
+transport has taken the previous chunk and the receiver has granted credit,
+so neither side holds more than a window of bytes at once. Peers older than
+version 8 get the whole thing as a single bytestring instead.
+"""
+
+import collections
+from collections.abc import Iterator, AsyncIterator
+from zope.interface import implementer
+from twisted.python import failure
+from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
+from foolscap import slicer, tokens
+from foolscap.tokens import BananaError, Violation
+from foolscap.constraint import Any, OpenerConstraint
+from foolscap.schema import StreamConstraint, constraintMap
+from foolscap.eventual import eventually
+from foolscap.call import CancelSlicer, CancelUnslicer, FailureConstraint, \
+     wrap_remote_failure
+from foolscap.util import AsyncAND
+from foolscap.slicers.root import CONTROL, BULK
+
+# the far end may send this many items before hearing from the caller
+INITIAL_STREAM_CREDIT = 16
+
+def isStream(obj):
+    return isinstance(obj, (Iterator, AsyncIterator))
+
+async def _anext(iterator):
+    return await iterator.__anext__()
+
+async def _aclose(iterator):
+    await iterator.aclose()
+
+def collectStream(iterator):
+    """Return a Deferred that fires with a list of everything the iterator
+    produces. This is how streams are sent to peers which cannot receive
+    them."""
+    if not isinstance(iterator, AsyncIterator):
+        return defer.maybeDeferred(list, iterator)
+    items = []
+    d = defer.Deferred()
+    def _next(res=None):
+        d2 = defer.Deferred.fromCoroutine(_anext(iterator))
+        d2.addCallbacks(_got, _done)
+    def _got(item):
+        items.append(item)
+        _next()
+    def _done(f):
+        if f.check(StopAsyncIteration):
+            d.callback(items)
+        else:
+            d.errback(f)
+    _next()
+    return d
+
+def getItemConstraint(constraint):
+    """Return the constraint for each item of a streamed answer, or raise
+    Violation if the answer should not have been a stream at all."""
+    if constraint is None or isinstance(constraint, Any):
+        return None
+    if isinstance(constraint, StreamConstraint):
+        return constraint.constraint
+    raise Violation("the answer was a stream, but %s is not a StreamOf"
+                    % (constraint,))
+
+
+class StreamItemsSlicer(slicer.ScopedSlicer):
+    opentype = ('stream-items',)
+
+    def __init__(self, reqID, items):
+        slicer.ScopedSlicer.__init__(self, None)
+        self.reqID = reqID
+        self.items = items
+
+    def sliceBody(self, streamable, banana):
+        yield self.reqID
+        for item in self.items:
+            yield item
+
+    def describe(self):
+        return "<stream-items-%s>" % self.reqID
+
+class StreamItemsUnslicer(slicer.ScopedUnslicer):
+    request = None
+    itemConstraint = None
+
+    def start(self, count):
+        slicer.ScopedUnslicer.start(self, count)
+        self.items = []
+        self._ready_deferreds = []
+
+    def checkToken(self, typebyte, size):
+        if self.request is None:
+            if typebyte != tokens.INT:
+                raise BananaError("request ID must be an INT")
+        elif self.itemConstraint:
+            self.itemConstraint.checkToken(typebyte, size)
+
+    def doOpen(self, opentype):
+        if self.itemConstraint:
+            self.itemConstraint.checkOpentype(opentype)
+        unslicer = self.open(opentype)
+        if unslicer and self.itemConstraint:
+            unslicer.setConstraint(self.itemConstraint)
+        return unslicer
+
+    def receiveChild(self, token, ready_deferred=None):
+        if self.request is None:
+            assert ready_deferred is None
+            # may raise Violation for bad reqIDs, or cancelled ones
+            self.request = self.broker.getRequest(token)
+            self.itemConstraint = getItemConstraint(self.request.constraint)
+            return
+        if ready_deferred:
+            self._ready_deferreds.append(ready_deferred)
+        self.items.append(token)
+
+    def reportViolation(self, f):
+        if self.request is not None:
+            request = self.request
+            request.fail(f)
+            if request.stream is not None:
+                # the rest of the stream is no use to us
+                self.broker.cancelRequest(request.reqID)
+        return f
+
+    def receiveClose(self):
+        if self.request is None:
+            raise BananaError("'stream-items' sequence needs a request ID")
+        request = self.request
+        if request.stream is None:
+            # the first chunk, which may be empty, announces the stream
+            request.stream = AnswerStream(request, self.broker.streamWindow)
+            request.deferred.callback(request.stream)
+        ready_deferred = None
+        if self._ready_deferreds:
+            ready_deferred = AsyncAND(self._ready_deferreds)
+        request.stream._addItems(self.items, ready_deferred)
+        return None, None
+
+    def describe(self):
+        if self.request:
+            return "StreamItems(req=%s)" % self.request.reqID
+        return "StreamItems(req=?)"
+
+class StreamEndSlicer(CancelSlicer):
+    opentype = ('stream-end',)
+
+class StreamEndUnslicer(CancelUnslicer):
+    name = "stream-end"
+
+    def handleRequestID(self, reqID):
+        request = self.broker.waitingForAnswers.get(reqID)
+        if request is not None and request.stream is not None:
+            request.finishStream()
+
+class StreamCreditSlicer(slicer.BaseSlicer):
+    opentype = ('stream-credit',)
+
+    def __init__(self, reqID, count):
+        self.reqID = reqID
+        self.count = count
+
+    def sliceBody(self, streamable, banana):
+        yield self.reqID
+        yield self.count
+
+    def describe(self):
+        return "<stream-credit-%s>" % self.reqID
+
+class StreamCreditUnslicer(slicer.LeafUnslicer):
+    name = "stream-credit"
+
+    def start(self, count):
+        self.values = []
+
+    def checkToken(self, typebyte, size):
+        if typebyte != tokens.INT or len(self.values) >= 2:
+            raise BananaError("'%s' takes an ID and a count" % self.name)
+
+    def receiveChild(self, token, ready_deferred=None):
+        assert ready_deferred is None
+        self.values.append(token)
+
+    def receiveClose(self):
+        if len(self.values) != 2:
+            raise BananaError("'%s' takes an ID and a count" % self.name)
+        self.handleCredit(*self.values)
+        return None, None
+
+    def handleCredit(self, reqID, count):
+        self.broker.addStreamCredit(reqID, count)
+
+    def describe(self):
+        return "<%s>" % self.name
+
+
+class OutboundStream(object):
+    """I pull items from the iterator returned by a remote_ method and send
+    them to the caller, as long as it has given us credit."""
+
+    chunkSize = 100 # at most this many items in each (stream-items)
+
+    def __init__(self, broker, delivery, iterator):
+        self.broker = broker
+        self.delivery = delivery
+        self.reqID = delivery.reqID
+        self.iterator = iterator
+        self.isAsync = isinstance(iterator, AsyncIterator)
+        self.itemConstraint = None
+        if delivery.methodSchema:
+            # may raise Violation
+            self.itemConstraint = getItemConstraint(
+                delivery.methodSchema.getResponseConstraint())
+        self.credit = INITIAL_STREAM_CREDIT
+        self.busy = False
+        self.stopped = False
+        self.itemsSent = 0
+        self.priority = broker.getAnswerPriority(delivery)
+        # our own flow, so other streams (and calls) get their turns in
+        # between our items
+        self.flow = ("answer-stream", self.reqID)
+
+    def start(self):
+        # announce the stream, so the caller's Deferred can fire
+        self.broker.send(StreamItemsSlicer(self.reqID, []), self.priority,
+                         self.flow)
+        self._scheduleNext()
+
+    def addCredit(self, count):
+        self.credit += count
+        self._scheduleNext()
+
+    def _scheduleNext(self):
+        if self.busy or self.stopped or self.credit <= 0:
+            return
+        self.busy = True
+        eventually(self._produce)
+
+    def _produce(self):
+        if self.stopped:
+            return
+        if self.broker.disconnected:
+            self.stop()
+            return
+        if self.isAsync:
+            # one item at a time, since each may take a while
+            d = defer.Deferred.fromCoroutine(_anext(self.iterator))
+            d.addCallbacks(self._gotItem, self._asyncDone)
+            d.addErrback(self._fail)
+            return
+        items = []
+        limit = min(self.credit, self.chunkSize)
+        try:
+            while len(items) < limit:
+                items.append(next(self.iterator))
+        except StopIteration:
+            if self._sendItems(items):
+                self._finish()
+            return
+        except:
+            f = failure.Failure()
+            if self._sendItems(items):
+                self._fail(f)
+            return
+        if self._sendItems(items):
+            self.busy = False
+            self._scheduleNext()
+
+    def _gotItem(self, item):
+        if self.stopped:
+            return
+        if self._sendItems([item]):
+            self.busy = False
+            self._scheduleNext()
+
+    def _asyncDone(self, f):
+        if self.stopped:
+            return
+        if f.check(StopAsyncIteration):
+            self._finish()
+        else:
+            self._fail(f)
+
+    def _sendItems(self, items):
+        # returns False if the stream had to be abandoned
+        f = None
+        if self.itemConstraint:
+            for i, item in enumerate(items):
+                try:
+                    self.itemConstraint.checkObject(item, False)
+                except Violation as v:
+                    v.prependLocation("in item %d of the streamed answer"
+                                      % (self.itemsSent + i))
+                    f = failure.Failure()
+                    items = items[:i] # send the ones before it
+                    break
+        if items:
+            self.credit -= len(items)
+            self.itemsSent += len(items)
+            self.broker.send(StreamItemsSlicer(self.reqID, items),
+                             self.priority, self.flow)
+        if f:
+            self._fail(f)
+            return False
+        return True
+
+    def _finish(self):
+        self.stopped = True
+        self.broker.send(StreamEndSlicer(self.reqID), self.priority,
+                         self.flow)
+        self.broker.streamFinished(self.delivery)
+
+    def _fail(self, f):
+        self.stopped = True
+        self.broker.callFailed(f, self.reqID, self.delivery)
+
+    def stop(self):
+        """The caller has gone away, so stop pulling items."""
+        self.stopped = True
+        if self.isAsync:
+            if hasattr(self.iterator, "aclose"):
+                d = defer.Deferred.fromCoroutine(_aclose(self.iterator))
+                d.addErrback(lambda f: None)
+        elif hasattr(self.iterator, "close"):
+            self.iterator.close()
+
+
+class AnswerStream(object):
+    """I am the caller's end of a streamed answer. Read items with next(),
+    with 'async for', or with consume(). Nothing more is sent to us than
+    'window' items beyond what has been read."""
+
+    def __init__(self, request, window):
+        self._request = request
+        self._broker = request.broker
+        self.window = window
+        self._items = collections.deque()
+        self._waiting = collections.deque() # Deferreds from next()
+        self._arrival = None # set while items wait for a ready_deferred
+        self._end = None # True, or a Failure
+        self._consumed = 0 # items read since we last granted credit
+        extra = window - INITIAL_STREAM_CREDIT
+        if extra > 0:
+            self._grant(extra)
+
+    def _grant(self, count):
+        if not self._broker.disconnected:
+            self._broker.send(StreamCreditSlicer(self._request.reqID, count),
+                              CONTROL)
+
+    def _addItems(self, items, ready_deferred):
+        if self._arrival is None and ready_deferred is None:
+            self._deliver(items)
+            return
+        # keep the items in order, behind any that are still waiting
+        if self._arrival is None:
+            self._arrival = defer.succeed(None)
+        if ready_deferred:
+            self._arrival.addCallback(lambda _: ready_deferred)
+        self._arrival.addCallback(lambda _: self._deliver(items))
+
+    def _deliver(self, items):
+        if self._end is not None:
+            return # cancelled
+        for item in items:
+            if isinstance(item, defer.Deferred):
+                # it has fired by now, since the ready_deferred has
+                item = item.result
+            if self._waiting:
+                self._waiting.popleft().callback(item)
+                self._read()
+            else:
+                self._items.append(item)
+
+    def _read(self):
+        self._consumed += 1
+        if self._end is None and self._consumed >= max(self.window // 2, 1):
+            self._grant(self._consumed)
+            self._consumed = 0
+
+    def _finish(self, f=None):
+        def _ended(res):
+            self._end = f or True
+            while self._waiting:
+                self._waiting.popleft().errback(self._endFailure())
+        if self._arrival is None:
+            _ended(None)
+        else:
+            self._arrival.addCallback(_ended)
+
+    def _endFailure(self):
+        if self._end is True:
+            return failure.Failure(StopAsyncIteration())
+        return self._end
+
+    def next(self):
+        """Return a Deferred that fires with the next item. At the end of
+        the stream it errbacks with StopAsyncIteration, or with whatever
+        went wrong on the far end."""
+        if self._items:
+            item = self._items.popleft()
+            self._read()
+            return defer.succeed(item)
+        if self._end is not None:
+            return defer.fail(self._endFailure())
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.next()
+
+    def consume(self, callback):
+        """Call callback(item) for each item in turn, and return a Deferred
+        that fires (with None) at the end of the stream. If callback returns
+        a Deferred, the next item waits for it."""
+        done = defer.Deferred()
+        def _next(res=None):
+            d = self.next()
+            d.addCallbacks(_got, _ended)
+        def _got(item):
+            d = defer.maybeDeferred(callback, item)
+            d.addCallbacks(_next, _failed)
+        def _ended(f):
+            if f.check(StopAsyncIteration):
+                done.callback(None)
+            else:
+                done.errback(f)
+        def _failed(f):
+            self.cancel()
+            done.errback(f)
+        _next()
+        return done
+
+    def cancel(self):
+        """Stop reading. The far end is told to stop sending, and anything
+        waiting on next() errbacks with defer.CancelledError."""
+        self._request.cancelStream()
+        self._items.clear()
+        self._arrival = None
+        self._end = failure.Failure(defer.CancelledError())
+        while self._waiting:
+            self._waiting.popleft().errback(self._end)
+
+
+# Streamed arguments. A ByteSource is sent as a (byte-stream) sequence inside
+# the call, holding a stream ID chosen by the sender. The bytes follow as
+# top-level (byte-stream-data) sequences, one chunk each, and the stream ends
+# with (byte-stream-end), or with (byte-stream-abort) and a failure if the
+# source could not be read. The receiver grants more credit (in bytes) with
+# (byte-stream-credit), or stops the sender with (byte-stream-cancel).
+
+BYTE_STREAM_CHUNK_SIZE = 64*1024 # no (byte-stream-data) may carry more
+# the sender may send this many bytes before hearing from the receiver
+INITIAL_BYTE_STREAM_CREDIT = 256*1024
+
+@implementer(IConsumer)
+class ByteSource(object):
+    """I wrap the bytes of a large argument, so they can be streamed to the
+    far end instead of being sent as a single bytestring. The source may be
+    a file-like object (anything with a read() method), or a bytes-like
+    object such as an mmap. With no source, I am an IConsumer: register a
+    producer (an IPullProducer, or an IPushProducer, which is paused while
+    too much of its data is waiting to be sent) and I will send whatever it
+    writes to me, until it unregisters itself."""
+
+    bufferSize = 256*1024 # pause a push producer beyond this many bytes
+
+    def __init__(self, source=None):
+        self._source = source
+        self._offset = 0 # for bytes-like sources
+        self._producer = None
+        self._streaming = False
+        self._paused = False
+        self._buffer = bytearray()
+        self._finished = source is not None
+        self._waiting = None # (Deferred, size) while we wait for a producer
+
+    # IConsumer
+
+    def registerProducer(self, producer, streaming):
+        if self._source is not None or self._producer is not None:
+            raise RuntimeError("this ByteSource already has a source")
+        self._producer = producer
+        self._streaming = streaming
+        self._finished = False
+        if self._waiting and not streaming:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self._producer = None
+        self._finished = True
+        self._wake()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        if (self._streaming and not self._paused
+            and len(self._buffer) >= self.bufferSize):
+            self._paused = True
+            self._producer.pauseProducing()
+        self._wake()
+
+    def _wake(self):
+        if self._waiting:
+            d, size = self._waiting
+            self._waiting = None
+            d.callback(self._take(size))
+
+    def _take(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        if self._paused and len(self._buffer) < self.bufferSize:
+            self._paused = False
+            self._producer.resumeProducing()
+        return data
+
+    def _read(self, size):
+        """Return a Deferred that fires with up to 'size' bytes, or with an
+        empty bytestring at the end of the source."""
+        if self._source is None:
+            # fill a whole chunk, if a pull producer writes as soon as it is
+            # asked to
+            while (self._producer and not self._streaming
+                   and len(self._buffer) < size):
+                before = len(self._buffer)
+                self._producer.resumeProducing()
+                if len(self._buffer) == before:
+                    break # it will write later
+            if self._buffer or self._finished:
+                return defer.succeed(self._take(size))
+            d = defer.Deferred()
+            self._waiting = (d, size)
+            return d
+        if hasattr(self._source, "read"):
+            return defer.maybeDeferred(self._source.read, size)
+        data = memoryview(self._source)[self._offset:self._offset+size]
+        self._offset += len(data)
+        return defer.succeed(data.tobytes())
+
+    def _readAll(self):
+        # for peers which cannot receive byte streams
+        if self._source is None:
+            raise Violation("the far end cannot receive a ByteSource that "
+                            "is fed by a producer")
+        if hasattr(self._source, "read"):
+            return self._source.read()
+        data = memoryview(self._source)[self._offset:].tobytes()
+        self._offset += len(data)
+        return data
+
+    def _stop(self):
+        if self._producer is not None:
+            producer, self._producer = self._producer, None
+            producer.stopProducing()
+
+
+class ByteStreamConstraint(OpenerConstraint):
+    """An argument which is streamed from a ByteSource. The receiving
+    method gets an IncomingByteStream, which fails with a Violation once
+    more than maxLength bytes have arrived."""
+    opentypes = [("byte-stream",)]
+    name = "ByteStreamConstraint"
+
+    def __init__(self, maxLength=None):
+        self.maxLength = maxLength
+
+    def checkObject(self, obj, inbound):
+        if inbound:
+            if not isinstance(obj, IncomingByteStream):
+                raise Violation("'%r' is not an IncomingByteStream" % (obj,))
+        elif not isinstance(obj, ByteSource):
+            raise Violation("'%r' is not a ByteSource" % (obj,))
+
+# so RemoteInterfaces can say data=ByteSource
+constraintMap[ByteSource] = ByteStreamConstraint()
+
+
+class ByteSourceSlicer(slicer.BaseSlicer):
+    opentype = ('byte-stream',)
+    slices = ByteSource
+
+    def slice(self, streamable, banana):
+        broker = self.requireBroker(banana)
+        if not broker.acceptsByteStreams:
+            # send the whole thing as a plain bytestring instead
+            self.sendOpen = False
+            return iter([self.obj._readAll()])
+        return slicer.BaseSlicer.slice(self, streamable, banana)
+
+    def sliceBody(self, streamable, banana):
+        yield banana.startByteStream(self.obj)
+
+    def describe(self):
+        return "<byte-stream>"
+
+class ByteStreamUnslicer(slicer.LeafUnslicer):
+    streamID = None
+    maxLength = None
+
+    def setConstraint(self, constraint):
+        if isinstance(constraint, ByteStreamConstraint):
+            self.maxLength = constraint.maxLength
+
+    def checkToken(self, typebyte, size):
+        if typebyte != tokens.INT or self.streamID is not None:
+            raise BananaError("'byte-stream' takes a single stream ID")
+
+    def receiveChild(self, token, ready_deferred=None):
+        assert ready_deferred is None
+        self.streamID = token
+
+    def receiveClose(self):
+        if self.streamID is None:
+            raise BananaError("'byte-stream' sequence needs a stream ID")
+        # may raise BananaError for duplicate stream IDs
+        stream = self.broker.openByteStream(self.streamID, self.maxLength)
+        # tell the call we are part of, so it can cancel the stream if the
+        # call is rejected or fails
+        parent = self.parent
+        while parent is not None:
+            opened = getattr(parent, "byteStreamOpened", None)
+            if opened:
+                opened(stream)
+                break
+            parent = parent.parent
+        return stream, None
+
+    def describe(self):
+        return "<byte-stream-%s>" % self.streamID
+
+class ByteStreamDataSlicer(slicer.BaseSlicer):
+    opentype = ('byte-stream-data',)
+
+    def __init__(self, streamID, data):
+        self.streamID = streamID
+        self.data = data
+
+    def sliceBody(self, streamable, banana):
+        yield self.streamID
+        yield self.data
+
+    def describe(self):
+        return "<byte-stream-data-%s>" % self.streamID
+
+class ByteStreamDataUnslicer(slicer.LeafUnslicer):
+    streamID = None
+    stream = None
+    data = None
+
+    def checkToken(self, typebyte, size):
+        if self.streamID is None:
+            if typebyte != tokens.INT:
+                raise BananaError("stream ID must be an INT")
+            return
+        if typebyte != tokens.STRING or self.data is not None:
+            raise BananaError("'byte-stream-data' takes a single STRING")
+        if size > BYTE_STREAM_CHUNK_SIZE:
+            raise BananaError("byte-stream chunk too large (%d > %d)"
+                              % (size, BYTE_STREAM_CHUNK_SIZE))
+        if self.stream is not None:
+            # may raise BananaError if the sender ignored its credit, or
+            # Violation if the stream has grown too long
+            self.stream._checkChunk(size)
+
+    def receiveChild(self, token, ready_deferred=None):
+        assert ready_deferred is None
+        if self.streamID is None:
+            self.streamID = token
+            # None if we have already given up on it
+            self.stream = self.broker.getByteStream(token)
+        else:
+            self.data = token
+
+    def reportViolation(self, f):
+        if self.stream is not None:
+            # the rest of it is no use to us
+            self.stream._fail(f)
+        return f
+
+    def receiveClose(self):
+        if self.data is None:
+            raise BananaError("'byte-stream-data' needs a stream ID and data")
+        if self.stream is not None:
+            self.stream._addChunk(self.data)
+        return None, None
+
+    def describe(self):
+        return "<byte-stream-data-%s>" % self.streamID
+
+class ByteStreamEndSlicer(CancelSlicer):
+    opentype = ('byte-stream-end',)
+
+class ByteStreamEndUnslicer(CancelUnslicer):
+    name = "byte-stream-end"
+
+    def handleRequestID(self, streamID):
+        stream = self.broker.inboundByteStreams.get(streamID)
+        if stream is not None:
+            stream._finish()
+
+class ByteStreamAbortSlicer(slicer.ScopedSlicer):
+    opentype = ('byte-stream-abort',)
+
+    def __init__(self, streamID, f):
+        slicer.ScopedSlicer.__init__(self, None)
+        self.streamID = streamID
+        self.f = f
+
+    def sliceBody(self, streamable, banana):
+        yield self.streamID
+        yield self.f
+
+    def describe(self):
+        return "<byte-stream-abort-%s>" % self.streamID
+
+class ByteStreamAbortUnslicer(slicer.ScopedUnslicer):
+    streamID = None
+    failure = None
+    fConstraint = FailureConstraint()
+
+    def checkToken(self, typebyte, size):
+        if self.streamID is None:
+            if typebyte != tokens.INT:
+                raise BananaError("stream ID must be an INT")
+        elif self.failure is None:
+            self.fConstraint.checkToken(typebyte, size)
+        else:
+            raise BananaError("'byte-stream-abort' takes an ID and a failure")
+
+    def doOpen(self, opentype):
+        self.fConstraint.checkOpentype(opentype)
+        unslicer = self.open(opentype)
+        if unslicer:
+            unslicer.setConstraint(self.fConstraint)
+        return unslicer
+
+    def receiveChild(self, token, ready_deferred=None):
+        assert ready_deferred is None
+        if self.streamID is None:
+            self.streamID = token
+        else:
+            self.failure = token
+
+    def receiveClose(self):
+        if self.failure is None:
+            raise BananaError("'byte-stream-abort' needs an ID and a failure")
+        stream = self.broker.inboundByteStreams.get(self.streamID)
+        if stream is not None:
+            f = self.failure
+            if not self.broker._expose_remote_exception_types:
+                f = wrap_remote_failure(f)
+            stream._fail(f, cancel=False)
+        return None, None
+
+    def describe(self):
+        return "<byte-stream-abort-%s>" % self.streamID
+
+class ByteStreamCreditSlicer(StreamCreditSlicer):
+    opentype = ('byte-stream-credit',)
+
+class ByteStreamCreditUnslicer(StreamCreditUnslicer):
+    name = "byte-stream-credit"
+
+    def handleCredit(self, streamID, count):
+        self.broker.addByteStreamCredit(streamID, count)
+
+class ByteStreamCancelSlicer(CancelSlicer):
+    opentype = ('byte-stream-cancel',)
+
+class ByteStreamCancelUnslicer(CancelUnslicer):
+    name = "byte-stream-cancel"
+
+    def handleRequestID(self, streamID):
+        self.broker.stopByteStream(streamID)
+
+
+class OutboundByteStream(object):
+    """I read chunks from a ByteSource and send them, as long as the
+    receiver has given us credit and the transport has taken everything we
+    sent before."""
+
+    chunkSize = BYTE_STREAM_CHUNK_SIZE
+
+    def __init__(self, broker, streamID, source):
+        self.broker = broker
+        self.streamID = streamID
+        self.source = source
+        self.credit = INITIAL_BYTE_STREAM_CREDIT
+        self.busy = False
+        self.stopped = False
+        self.flow = ("byte-stream", streamID)
+
+    def start(self):
+        self._scheduleNext()
+
+    def addCredit(self, count):
+        self.credit += count
+        self._scheduleNext()
+
+    def _scheduleNext(self):
+        if self.busy or self.stopped or self.credit <= 0:
+            return
+        self.busy = True
+        eventually(self._produce)
+
+    def _produce(self):
+        # this waits until the transport has drained the send queue, so a
+        # slow connection slows down the reads
+        d = self.broker.waitForSendQueue()
+        d.addCallback(self._read)
+        d.addCallbacks(self._gotData, self._readFailed)
+
+    def _read(self, res):
+        if self.stopped:
+            return None
+        if self.broker.disconnected:
+            self.broker.stopByteStream(self.streamID)
+            return None
+        return self.source._read(min(self.credit, self.chunkSize))
+
+    def _gotData(self, data):
+        if data is None or self.stopped:
+            return
+        if not data:
+            self.stopped = True
+            self.broker.send(ByteStreamEndSlicer(self.streamID), BULK,
+                             self.flow)
+            self.broker.byteStreamSent(self.streamID)
+            return
+        self.credit -= len(data)
+        self.broker.send(ByteStreamDataSlicer(self.streamID, data), BULK,
+                         self.flow)
+        self.busy = False
+        self._scheduleNext()
+
+    def _readFailed(self, f):
+        if self.stopped:
+            return
+        self.stopped = True
+        # in the same flow as the data, so it arrives after all of it
+        self.broker.send(ByteStreamAbortSlicer(self.streamID, f), BULK,
+                         self.flow)
+        self.broker.byteStreamSent(self.streamID)
+
+    def stop(self):
+        """The receiver has gone away, so stop reading."""
+        self.stopped = True
+        self.source._stop()
+
+
+class IncomingByteStream(object):
+    """I am what a remote_ method receives in place of a ByteSource. Read
+    the bytes a chunk at a time with read(), hand each chunk to a callback
+    (such as the write() method of a file) with consume(), or collect them
+    all with readAll(). Nothing more is sent to us than 'window' bytes
+    beyond what has been read."""
+
+    def __init__(self, broker, streamID, window, maxLength=None):
+        self._broker = broker
+        self._streamID = streamID
+        self.window = window
+        self.maxLength = maxLength
+        self.received = 0 # bytes so far
+        self._chunks = collections.deque()
+        self._waiting = collections.deque() # Deferreds from read()
+        self._end = None # True, or a Failure
+        self._credit = INITIAL_BYTE_STREAM_CREDIT # the sender may send this
+        self._consumed = 0 # bytes read since we last granted credit
+        extra = window - INITIAL_BYTE_STREAM_CREDIT
+        if extra > 0:
+            self._grant(extra)
+
+    def _grant(self, count):
+        self._credit += count
+        if not self._broker.disconnected:
+            self._broker.send(ByteStreamCreditSlicer(self._streamID, count),
+                              CONTROL)
+
+    def _checkChunk(self, size):
+        if size > self._credit:
+            raise BananaError("byte-stream sent beyond its credit")
+        if (self.maxLength is not None
+            and self.received + size > self.maxLength):
+            raise Violation("byte stream too long (more than %d bytes)"
+                            % self.maxLength)
+
+    def _addChunk(self, data):
+        self._credit -= len(data)
+        self.received += len(data)
+        if self._waiting:
+            self._waiting.popleft().callback(data)
+            self._read(len(data))
+        else:
+            self._chunks.append(data)
+
+    def _read(self, size):
+        self._consumed += size
+        if self._end is None and self._consumed >= max(self.window // 2, 1):
+            self._grant(self._consumed)
+            self._consumed = 0
+
+    def _finish(self):
+        self._broker.closeByteStream(self._streamID)
+        self._end = True
+        while self._waiting:
+            self._waiting.popleft().callback(b"")
+
+    def _fail(self, f, cancel=True):
+        if self._end is not None:
+            return
+        if cancel:
+            # tell the sender to stop
+            self._broker.stopReceivingByteStream(self._streamID)
+        else:
+            self._broker.closeByteStream(self._streamID)
+        self._chunks.clear()
+        self._end = f
+        while self._waiting:
+            self._waiting.popleft().errback(f)
+
+    def read(self):
+        """Return a Deferred that fires with the next chunk of bytes, or with
+        an empty bytestring at the end of the stream. It errbacks with
+        whatever went wrong while the far end was reading its source."""
+        if self._chunks:
+            data = self._chunks.popleft()
+            self._read(len(data))
+            return defer.succeed(data)
+        if self._end is True:
+            return defer.succeed(b"")
+        if self._end is not None:
+            return defer.fail(self._end)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def consume(self, callback):
+        """Call callback(data) for each chunk in turn, and return a Deferred
+        that fires (with None) at the end of the stream. If callback returns
+        a Deferred, the next chunk waits for it."""
+        done = defer.Deferred()
+        def _next(res=None):
+            d = self.read()
+            d.addCallbacks(_got, done.errback)
+        def _got(data):
+            if not data:
+                done.callback(None)
+                return
+            d = defer.maybeDeferred(callback, data)
+            d.addCallbacks(_next, _failed)
+        def _failed(f):
+            self.cancel()
+            done.errback(f)
+        _next()
+        return done
+
+    def readAll(self):
+        """Return a Deferred that fires with all of the bytes. This is only
+        sensible for streams that are known to fit in memory."""
+        chunks = []
+        d = self.consume(chunks.append)
+        d.addCallback(lambda res: b"".join(chunks))
+        return d
+
+    def cancel(self):
+        """Stop reading. The far end is told to stop sending, and anything
+        waiting on read() errbacks with defer.CancelledError."""
+        self._fail(failure.Failure(defer.CancelledError()))
@@ -1,6 +1,6 @@
 # -*- test-case-name: foolscap.test.test_pb -*-
 
-import time
+import gc, time
 from zope.interface import implementer, implementer_only, implementedBy, Interface
 from twisted.python import log
 from twisted.internet import defer, reactor, task, protocol
@@ -33,6 +33,8 @@ class Loopback:
     connected = True
     def write(self, data):
         eventually(self._write, data)
+    def writeSequence(self, iovec):
+        self.write(b"".join(iovec))
 
     def _write(self, data):
         if not self.connected:
@@ -219,6 +221,10 @@ class TargetMixin(PollMixin, StallMixin):
         # returns a Deferred which fires when the Loopbacks are drained
         dl = [l.flush() for l in self.loopbacks]
         d = defer.DeferredList(dl)
+        # a RemoteReference caught in a cycle (say, by a Failure's
+        # traceback) queues its decref whenever it is collected. Make that
+        # happen now, rather than in the middle of some later test.
+        d.addCallback(lambda res: gc.collect())
         d.addCallback(flushEventualQueue)
         return d
 
@@ -0,0 +1,156 @@
+import asyncio
+from twisted.trial import unittest
+from twisted.internet import defer
+from zope.interface import implementer
+from foolscap.api import Referenceable, RemoteInterface, Violation, \
+     runAsTask, fireEventually, RemoteException
+from foolscap import aio, executors
+from foolscap.test.common import TargetMixin, ShouldFailMixin
+
+class RICoroutines(RemoteInterface):
+    def add(a=int, b=int): return int
+    def wrong(): return int
+    def explode(): return None
+    def hold(): return int
+    def sleep(seconds=float): return float
+
+@implementer(RICoroutines)
+class Coroutines(Referenceable):
+    def __init__(self):
+        self.held = None
+        self.cancelled = False
+
+    async def remote_add(self, a, b):
+        await fireEventually()
+        return a + b
+
+    async def remote_wrong(self):
+        return "not an int"
+
+    async def remote_explode(self):
+        await fireEventually()
+        raise ValueError("boom")
+
+    async def remote_hold(self):
+        self.held = defer.Deferred()
+        try:
+            return (await self.held)
+        except defer.CancelledError:
+            self.cancelled = True
+            raise
+
+    @runAsTask
+    async def remote_sleep(self, seconds):
+        # an asyncio-only awaitable, which fromCoroutine would reject
+        await asyncio.sleep(seconds)
+        return seconds
+
+class AsyncMethods(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_coroutine(self):
+        rr, target = self.setupTarget(Coroutines(), True)
+        d = rr.callRemote("add", 1, 2)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        return d
+
+    def test_results_are_checked(self):
+        rr, target = self.setupTarget(Coroutines(), True)
+        return self.shouldFail(Violation, "wrong", "is not a number",
+                               rr.callRemote, "wrong")
+
+    def test_failure(self):
+        rr, target = self.setupTarget(Coroutines(), True)
+        return self.shouldFail(ValueError, "explode", "boom",
+                               rr.callRemote, "explode")
+
+    def test_cancel(self):
+        # cancelling the call cancels whatever the coroutine is awaiting
+        rr, target = self.setupTarget(Coroutines(), True)
+        d = rr.callRemote("hold")
+        d2 = self.poll(lambda: target.held)
+        d2.addCallback(lambda res: d.cancel())
+        d2.addCallback(lambda res: self.assertFailure(d, defer.CancelledError))
+        d2.addCallback(lambda res: self.poll(lambda: target.cancelled))
+        d2.addCallback(lambda res:
+                       self.assertEqual(self.targetBroker.activeLocalCalls,
+                                        {}))
+        return d2
+
+    def test_await(self):
+        # a coroutine run by fromCoroutine can await callRemote directly
+        rr, target = self.setupTarget(Coroutines(), True)
+        async def _go():
+            a = await rr.callRemote("add", 1, 2)
+            return await rr.callRemote("add", a, 3)
+        d = defer.Deferred.fromCoroutine(_go())
+        d.addCallback(lambda res: self.assertEqual(res, 6))
+        return d
+
+    def test_task_needs_asyncio(self):
+        # trial does not use the asyncio reactor
+        rr, target = self.setupTarget(Coroutines(), True)
+        return self.shouldFail(RuntimeError, "sleep", "no running event loop",
+                               rr.callRemote, "sleep", 0.0)
+
+class Futures(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    # we can't run the asyncio reactor under trial, so these use a loop of
+    # their own, and step it by hand
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.patch(asyncio, "get_running_loop", lambda: self.loop)
+
+    def test_call(self):
+        rr, target = self.setupTarget(Coroutines(), True)
+        f = aio.callRemote(rr, "add", 1, 2)
+        self.assertIsInstance(f, asyncio.Future)
+        d = self.poll(f.done)
+        d.addCallback(lambda res: self.assertEqual(f.result(), 3))
+        return d
+
+    def test_failure(self):
+        rr, target = self.setupTarget(Coroutines(), True)
+        f = aio.callRemote(rr, "explode")
+        d = self.poll(f.done)
+        def _check(res):
+            e = f.exception()
+            self.assertIsInstance(e, RemoteException)
+            self.assertTrue(e.failure.check(ValueError))
+        d.addCallback(_check)
+        return d
+
+    def test_cancel(self):
+        # cancelling the Future cancels the call
+        rr, target = self.setupTarget(Coroutines(), True)
+        f = aio.callRemote(rr, "hold")
+        d = self.poll(lambda: target.held)
+        def _cancel(res):
+            f.cancel()
+            # the cancellation reaches the Deferred once the loop runs
+            self.loop.run_until_complete(asyncio.sleep(0))
+        d.addCallback(_cancel)
+        d.addCallback(lambda res: self.poll(lambda: target.cancelled))
+        d.addCallback(lambda res:
+                      self.assertEqual(self.callingBroker.waitingForAnswers,
+                                       {}))
+        return d
+
+    def test_task(self):
+        rr, target = self.setupTarget(Coroutines(), True)
+        d1 = rr.callRemote("sleep", 0.0)
+        d = self.poll(lambda: asyncio.all_tasks(self.loop))
+        # this runs the Task, and then tells its Deferred
+        d.addCallback(lambda res:
+                      self.loop.run_until_complete(asyncio.sleep(0.01)))
+        d.addCallback(lambda res: d1)
+        d.addCallback(lambda res: self.assertEqual(res, 0.0))
+        return d
+
+    def test_task_runner(self):
+        self.assertIsInstance(Coroutines.remote_sleep.foolscapRunner,
+                              executors.TaskRunner)
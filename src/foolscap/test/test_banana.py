@@ -5,17 +5,22 @@ from twisted.trial import unittest
 from twisted.python.failure import Failure
 from twisted.python.components import registerAdapter
 from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
+from zope.interface import alsoProvides, implementer, classImplements
 
 from foolscap.tokens import ISlicer, Violation, BananaError
 from foolscap.tokens import BananaFailure, tokenNames, \
      OPEN, CLOSE, ABORT, INT, LONGINT, NEG, LONGNEG, FLOAT, STRING
-from foolscap import slicer, schema, storage, banana, vocab
+from foolscap import slicer, schema, storage, banana, vocab, compression
+from foolscap import copyable
+from foolscap.slicers import root
 from foolscap.eventual import fireEventually, flushEventualQueue
 from foolscap.slicers.allslicers import RootSlicer, DictUnslicer, TupleUnslicer
 from foolscap.constraint import IConstraint
 from foolscap.banana import int2b128, long_to_bytes
 
 import io
+import zlib
 import struct
 from decimal import Decimal
 
@@ -70,6 +75,7 @@ tABORT = ("ABORT",)
 class TokenBanana(banana.Banana):
     """this Banana formats tokens as strings, numbers, and ('OPEN',) tuples
     instead of bytes. Used for testing purposes."""
+    sendPrimitivesInBulk = False # that would bypass sendToken()
 
     def sendOpen(self):
         openID = self.openCount
@@ -229,6 +235,8 @@ class UnbananaTestMixin:
 
 class TestTransport(io.BytesIO):
     disconnectReason = None
+    def writeSequence(self, iovec):
+        self.writelines(iovec)
     def loseConnection(self):
         pass
 
@@ -1195,6 +1203,432 @@ class ByteStream(TestBananaMixin, unittest.TestCase):
         d.addCallback(self.wantEqual, expected)
         return d
 
+class RecordingTransport(TestTransport):
+    def __init__(self):
+        TestTransport.__init__(self)
+        self.calls = []
+    def write(self, data):
+        self.calls.append([data])
+        TestTransport.write(self, data)
+    def writeSequence(self, iovec):
+        self.calls.append(list(iovec))
+        TestTransport.writeSequence(self, iovec)
+
+class WriteCoalescing(TestBananaMixin, unittest.TestCase):
+    def setUp(self):
+        TestBananaMixin.setUp(self)
+        self.banana.transport = RecordingTransport()
+
+    def test_small_tokens(self):
+        obj = [1, 2, b"three", -4, 2**40, 5.0]
+        d = self.encode(obj)
+        def _check(data):
+            calls = self.banana.transport.calls
+            # one object, one write
+            self.assertEqual(calls, [[data]])
+            self.assertEqual(self.shouldDecode(data), obj)
+        d.addCallback(_check)
+        return d
+
+    def test_large_bodies(self):
+        big1 = b"a" * banana.LARGE_WRITE
+        big2 = b"b" * (banana.LARGE_WRITE + 1)
+        obj = [big1, 1, big2]
+        d = self.encode(obj)
+        def _check(data):
+            calls = self.banana.transport.calls
+            self.assertEqual(len(calls), 1)
+            iovec = calls[0]
+            self.assertEqual(b"".join(iovec), data)
+            # the large bodies were handed over without being copied
+            self.assertIdentical(iovec[1], big1)
+            self.assertIdentical(iovec[3], big2)
+            self.assertEqual(len(iovec), 5)
+            self.assertEqual(self.shouldDecode(data), obj)
+        d.addCallback(_check)
+        return d
+
+    def test_not_producing(self):
+        # outside of produce(), tokens are written immediately
+        self.banana.sendPING(3)
+        self.assertEqual(self.banana.transport.calls, [[b"\x03\x8e"]])
+
+@implementer(IConsumer)
+class ConsumerTransport(TestTransport):
+    producer = None
+    def registerProducer(self, producer, streaming):
+        assert self.producer is None
+        assert streaming
+        self.producer = producer
+    def unregisterProducer(self):
+        assert self.producer is not None
+        self.producer = None
+
+@implementer(IConsumer)
+class PausingTransport(ConsumerTransport):
+    # like a TCP transport, this pauses its producer once too much has been
+    # written, and resumes it when drain() empties the buffer
+    limit = 65536
+    buffered = 0
+    def write(self, data):
+        ConsumerTransport.write(self, data)
+        self.buffered += len(data)
+        if self.buffered > self.limit and self.producer:
+            self.producer.pauseProducing()
+    def writeSequence(self, iovec):
+        for data in iovec:
+            self.write(data)
+    def drain(self, banana):
+        self.buffered = 0
+        banana.resumeProducing()
+
+class FlowControl(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        TestBananaMixin.makeBanana(self)
+        self.banana.transport = ConsumerTransport()
+        self.banana.connectionMade()
+
+    def test_registration(self):
+        # we are only registered while there is something to send
+        t = self.banana.transport
+        self.banana.pauseProducing()
+        d = self.banana.send([1])
+        self.assertIdentical(t.producer, self.banana)
+        self.assertEqual(t.getvalue(), b"")
+        self.banana.resumeProducing()
+        self.assertIdentical(t.producer, None)
+        d.addCallback(lambda res:
+                      self.assertEqual(self.shouldDecode(t.getvalue()), [1]))
+        return d
+
+    def test_order(self):
+        self.banana.pauseProducing()
+        sent = []
+        dl = []
+        for i in range(5):
+            d = self.banana.send(i)
+            d.addCallback(lambda res, i=i: sent.append(i))
+            dl.append(d)
+        self.assertEqual(self.banana.getSendQueueSize(), 5)
+        self.banana.resumeProducing()
+        self.assertEqual(self.banana.getSendQueueSize(), 0)
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda res: self.assertEqual(sent, [0, 1, 2, 3, 4]))
+        return d
+
+    def test_water_marks(self):
+        b = self.banana
+        b.sendQueueHighWater = 3
+        b.sendQueueLowWater = 1
+        self.assertFalse(b.isSendQueueFull())
+        self.assertTrue(b.waitForSendQueue().called)
+        b.pauseProducing()
+        for i in range(3):
+            b.send(i)
+        self.assertTrue(b.isSendQueueFull())
+        waited = []
+        b.waitForSendQueue().addCallback(waited.append)
+        b.resumeProducing()
+        self.assertFalse(b.isSendQueueFull())
+        d = flushEventualQueue()
+        d.addCallback(lambda res: self.assertEqual(waited, [None]))
+        return d
+
+    def test_backpressure(self):
+        # a pause from the transport takes effect after the current object,
+        # so it never holds much more than its limit
+        b = self.banana
+        t = b.transport = PausingTransport()
+        b.pauseProducing()
+        sent = []
+        dl = []
+        for i in range(20):
+            d = b.send(b"%02d" % i + b"x" * 29998) # 30004 bytes each
+            d.addCallback(lambda res, i=i: sent.append(i))
+            dl.append(d)
+        self.assertEqual(b.getSendQueueSize(), 20)
+        b.resumeProducing()
+        # the third object took the transport past its limit
+        self.assertTrue(b.paused)
+        self.assertEqual(t.buffered, 3*30004)
+        self.assertEqual(b.getSendQueueSize(), 17)
+        while b.getSendQueueSize():
+            t.drain(b)
+            self.assertTrue(t.buffered <= t.limit + 30004, t.buffered)
+        t.drain(b)
+        self.assertFalse(b.paused)
+        self.assertIdentical(t.producer, None)
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.assertEqual(sent, list(range(20)))
+            self.assertEqual(len(t.getvalue()), 20*30004)
+        d.addCallback(_check)
+        return d
+
+    def test_backpressure_within_object(self):
+        # a large object is handed over in pieces, and the pause stops it
+        # part way through (between tokens: a list of primitives is
+        # written all at once, so this one holds lists)
+        b = self.banana
+        t = b.transport = PausingTransport()
+        b.pauseProducing()
+        obj = [[b"x" * 30000] for i in range(10)]
+        d = b.send(obj)
+        b.resumeProducing()
+        self.assertTrue(b.paused)
+        self.assertTrue(t.buffered < 5*30000, t.buffered)
+        while b.paused:
+            t.drain(b)
+        d.addCallback(lambda res:
+                      self.assertEqual(self.shouldDecode(t.getvalue()), obj))
+        return d
+
+    def test_water_marks_bytes(self):
+        # the byte limits use the average size of the objects sent so far
+        b = self.banana
+        t = b.transport = PausingTransport()
+        t.limit = 50000
+        b.sendQueueHighWaterBytes = 100000
+        b.sendQueueLowWaterBytes = 40000
+        self.assertEqual(b.getSendQueueBytes(), 0)
+        b.send(b"x" * 9997) # 10000 bytes
+        self.assertEqual(b.averageObjectSize, 10000)
+        b.pauseProducing()
+        for i in range(9):
+            b.send(b"x" * 9997)
+        self.assertEqual(b.getSendQueueBytes(), 90000)
+        self.assertFalse(b.isSendQueueFull())
+        b.send(b"x" * 9997)
+        self.assertTrue(b.isSendQueueFull())
+        waited = []
+        b.waitForSendQueue().addCallback(waited.append)
+        t.drain(b)
+        # six were sent before the transport paused us, leaving four
+        self.assertEqual(b.getSendQueueBytes(), 40000)
+        self.assertFalse(b.isSendQueueFull())
+        d = flushEventualQueue()
+        d.addCallback(lambda res: self.assertEqual(waited, [None]))
+        return d
+
+    def test_connection_lost(self):
+        b = self.banana
+        b.pauseProducing()
+        b.send(1)
+        waited = []
+        b.waitForSendQueue().addCallback(waited.append)
+        self.assertEqual(waited, [])
+        b.connectionLost(Failure(ValueError("gone")))
+        self.assertEqual(waited, [None])
+
+    def test_priority(self):
+        # the most urgent lane goes first, each lane in order
+        b = self.banana
+        b.pauseProducing()
+        sent = []
+        dl = []
+        for (obj, priority) in [(1, "bulk"), (2, "interactive"),
+                                (3, "bulk"), (4, "control"),
+                                (5, "interactive")]:
+            d = b.send(obj, priority)
+            d.addCallback(lambda res, obj=obj: sent.append(obj))
+            dl.append(d)
+        self.assertEqual(b.getSendQueueSize(), 5)
+        self.assertEqual(b.rootSlicer.sendQueue.getLaneSizes(),
+                         {"control": 1, "interactive": 2, "bulk": 2})
+        b.resumeProducing()
+        self.assertEqual(b.getSendQueueSize(), 0)
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda res: self.assertEqual(sent, [4, 2, 5, 1, 3]))
+        return d
+
+    def test_control_overtakes_bulk(self):
+        # the transport pauses us between objects, so a CONTROL object sent
+        # while a big BULK backlog is waiting goes out on the next resume,
+        # not after the whole backlog
+        b = self.banana
+        t = b.transport = PausingTransport()
+        b.pauseProducing()
+        sent = []
+        dl = []
+        for i in range(20):
+            d = b.send(b"%02d" % i + b"x" * 29998) # 30004 bytes each
+            d.addCallback(lambda res, i=i: sent.append(i))
+            dl.append(d)
+        b.resumeProducing()
+        self.assertTrue(b.paused)
+        self.assertEqual(b.getSendQueueSize(), 17)
+        d = b.send(b"ping", "control")
+        d.addCallback(lambda res: sent.append("ping"))
+        dl.append(d)
+        t.drain(b)
+        # it was written straight after the three which filled the transport
+        self.assertEqual(t.getvalue()[3*30004:3*30004+6], b"\x04\x82ping")
+        while b.getSendQueueSize():
+            t.drain(b)
+        t.drain(b)
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda res:
+                      self.assertEqual(sent, [0, 1, 2, "ping"] +
+                                       list(range(3, 20))))
+        return d
+
+    def test_bad_priority(self):
+        self.assertRaises(ValueError, self.banana.send, 1, "urgent")
+        self.assertEqual(self.banana.getSendQueueSize(), 0)
+
+    def test_flows(self):
+        # the flows of a lane take turns by deficit round robin, so a flow
+        # of big objects gets no more bytes than a flow of small ones
+        b = self.banana
+        b.rootSlicer.sendQueue.quantum = 1000
+        b.pauseProducing()
+        sent = []
+        dl = []
+        big = b"a" * 2500 # 2503 bytes on the wire
+        small = b"b" * 400 # 403 bytes
+        objs = ([("a%d" % i, big, "a") for i in range(1, 4)] +
+                [("b%d" % i, small, "b") for i in range(1, 7)])
+        for (name, obj, flow) in objs:
+            d = b.send(obj, "bulk", flow)
+            d.addCallback(lambda res, name=name: sent.append(name))
+            dl.append(d)
+        self.assertEqual(b.getSendQueueStats()["bulk"]["flows"],
+                         {"a": (3, 0), "b": (6, 0)})
+        b.resumeProducing()
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.assertEqual(sent, ["a1", "b1", "b2", "b3", "b4", "b5",
+                                    "a2", "b6", "a3"])
+            stats = b.getSendQueueStats()["bulk"]
+            # a3 had the lane to itself, so it was not charged for
+            self.assertEqual(stats["bytesCharged"], 2*2503 + 6*403)
+            self.assertEqual(stats["objectsSent"], 9)
+            self.assertEqual(stats["flows"], {})
+            self.assertEqual(b.getBytesProduced(), 3*2503 + 6*403)
+        d.addCallback(_check)
+        return d
+
+    def test_default_flow(self):
+        # the default flow (None) is charged like any other, so it takes
+        # turns with a named one instead of keeping the lane until it is
+        # empty
+        b = self.banana
+        b.rootSlicer.sendQueue.quantum = 1000
+        b.pauseProducing()
+        sent = []
+        dl = []
+        big = b"a" * 2500 # 2503 bytes on the wire
+        objs = ([("d%d" % i, None) for i in range(1, 4)] +
+                [("s%d" % i, "s") for i in range(1, 4)])
+        for (name, flow) in objs:
+            d = b.send(big, "bulk", flow)
+            d.addCallback(lambda res, name=name: sent.append(name))
+            dl.append(d)
+        b.resumeProducing()
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.assertEqual(sent, ["d1", "s1", "d2", "s2", "d3", "s3"])
+            stats = b.getSendQueueStats()["bulk"]
+            # only s3 had the lane to itself
+            self.assertEqual(stats["bytesCharged"], 5*2503)
+        d.addCallback(_check)
+        return d
+
+class BulkPrimitives(TestBananaMixin, unittest.TestCase):
+    def encodeBoth(self, obj):
+        # encode 'obj' with and without the bulk path, on fresh Bananas
+        results = []
+        for bulk in (True, False):
+            self.makeBanana()
+            self.banana.sendPrimitivesInBulk = bulk
+            self.banana.populateVocabTable([b"vocabized"])
+            d = self.encode(obj)
+            d.addCallback(results.append)
+        return results
+
+    def check(self, obj):
+        fast, slow = self.encodeBoth(obj)
+        self.assertEqual(fast, slow)
+        self.makeBanana()
+        self.banana.populateVocabTable([b"vocabized"])
+        self.assertEqual(self.shouldDecode(fast), obj)
+
+    def test_list(self):
+        self.check([0, 1, 127, 128, 16383, 16384, 2**31-1, 2**31, 2**64,
+                    -1, -2**31, -2**31-1, -2**64, 1.5, b"", b"abc", b"vocabized",
+                    b"x" * banana.LARGE_WRITE, True, False, None])
+
+    def test_tuple(self):
+        self.check((1, b"two", 3.0, None))
+
+    def test_set(self):
+        self.check(set([1, 2, b"three"]))
+        self.check(frozenset([4, 5, b"six"]))
+
+    def test_dict(self):
+        # dict keys are sorted, so they must be comparable
+        self.check({b"one": 1, b"two": 2.0, b"vocabized": None, b"3": True})
+        self.check({1: b"one", 2: b"vocabized"})
+
+    def test_mixed(self):
+        # any non-primitive element sends the whole container the slow way
+        self.check([1, 2, [3, 4], b"five"])
+        self.check({1: [2], 3: 4})
+
+    def test_used(self):
+        calls = []
+        self.patch(self.banana, "sendPrimitives",
+                   lambda items: calls.append(list(items)))
+        self.banana.send([1, 2, 3])
+        self.assertEqual(calls, [[1, 2, 3]])
+
+class StreamCompression(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        self.banana = storage.StorageBanana({"compression": "zlib"})
+        self.banana.slicerClass = storage.StorageRootSlicer
+        self.banana.unslicerClass = storage.StorageRootUnslicer
+        self.banana.transport = RecordingTransport()
+        self.banana.connectionMade()
+
+    def test_send(self):
+        obj = [b"compressible" * 100, 1, 2]
+        d = self.encode(obj)
+        def _check(data):
+            self.assertEqual(len(self.banana.transport.calls), 1)
+            self.assertTrue(len(data) < 100)
+            # each write ends with a sync-flush, so it can be decoded
+            # without waiting for the rest of the stream
+            plain = zlib.decompressobj().decompress(data)
+            self.assertIn(banana.b128(1200) + STRING + b"compressible" * 100,
+                          plain)
+            self.assertTrue(plain.endswith(bINT(1) + bINT(2) + bCLOSE(0)))
+            # and we can read our own stream
+            self.assertEqual(self.shouldDecode(data), obj)
+        d.addCallback(_check)
+        return d
+
+    def test_not_producing(self):
+        self.banana.sendPING(3)
+        [[data]] = self.banana.transport.calls
+        self.assertEqual(zlib.decompressobj().decompress(data), b"\x03\x8e")
+
+    def test_receive(self):
+        c = zlib.compressobj()
+        def compress(data):
+            return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+        self.assertEqual(self.shouldDecode(compress(bSTR("a"))), b"a")
+        self.assertEqual(self.shouldDecode(compress(bINT(7))), 7)
+
+    def test_receive_in_pieces(self):
+        self.patch(compression, "MAX_DECOMPRESSED_CHUNK", 100)
+        body = b"e" * 5000
+        data = zlib.compress(b"\x08\x27\x82" + body)
+        self.assertEqual(self.shouldDecode(data), body)
+
+    def test_corrupt(self):
+        f = self.shouldDropConnection(b"not a zlib stream")
+        self.assertIn("corrupt compressed stream", str(f.value))
+
 class InboundByteStream(TestBananaMixin, unittest.TestCase):
 
     def check(self, obj, stream):
@@ -1232,6 +1666,22 @@ class InboundByteStream(TestBananaMixin, unittest.TestCase):
         self.check(b"c"*1025, b"\x01\x08\x82" + b"c" * 1025 + b"extra")
         self.check(b"fluuber", bSTR("fluuber"))
 
+    def testStringInPieces(self):
+        # the header and body arrive in separate dataReceived calls
+        body = b"d" * 5000
+        stream = b"\x08\x27\x82" + body # 5000 == 0x27*128 + 0x08
+        for chunksize in (1, 2, 100, 4096):
+            self.makeBanana()
+            results = []
+            d = self.banana.prepare()
+            d.addCallback(results.append)
+            for i in range(0, len(stream), chunksize):
+                self.banana.dataReceived(stream[i:i+chunksize])
+            self.assertEqual(results, [body])
+            self.assertFalse(self.banana.disconnectReason)
+            # and the buffer is ready for the next object
+            self.assertEqual(self.shouldDecode(bINT(7)), 7)
+
 
     def testList(self):
         self.check([1,2],
@@ -1271,6 +1721,47 @@ class InboundByteStream(TestBananaMixin, unittest.TestCase):
         self.check(True, self.TRUE())
         self.check(False, self.FALSE())
 
+class Spool(object):
+    def __init__(self):
+        self.writes = []
+    def write(self, data):
+        self.writes.append(data)
+
+class SpoolingRootUnslicer(storage.StorageRootUnslicer):
+    def openStringSpool(self, size):
+        if size > 100:
+            self.protocol.spool_ = Spool()
+            return self.protocol.spool_
+        return None
+
+class Spooling(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        TestBananaMixin.makeBanana(self)
+        self.banana.unslicerClass = SpoolingRootUnslicer
+        self.banana.initUnslicer()
+
+    def testSpool(self):
+        body = b"d" * 5000
+        stream = b"\x08\x27\x82" + body # 5000 == 0x27*128 + 0x08
+        for chunksize in (1, 100, 4096, len(stream)):
+            self.makeBanana()
+            results = []
+            d = self.banana.prepare()
+            d.addCallback(results.append)
+            for i in range(0, len(stream), chunksize):
+                self.banana.dataReceived(stream[i:i+chunksize])
+                # the body is never held in the receive buffer
+                self.assertTrue(len(self.banana.buffer) < 3)
+            spool = self.banana.spool_
+            self.assertEqual(results, [spool])
+            self.assertEqual(b"".join(spool.writes), body)
+            self.assertFalse(self.banana.disconnectReason)
+            # and the buffer is ready for the next object
+            self.assertEqual(self.shouldDecode(bINT(7)), 7)
+
+    def testSmall(self):
+        self.assertEqual(self.shouldDecode(bSTR("fluuber")), b"fluuber")
+
 class InboundByteStream2(TestBananaMixin, unittest.TestCase):
 
     def setConstraints(self, constraint, childConstraint):
@@ -1494,6 +1985,144 @@ class InboundByteStream2(TestBananaMixin, unittest.TestCase):
                       schema.BooleanConstraint(True))
 
 
+class BulkReceive(TestBananaMixin, unittest.TestCase):
+    def stream(self):
+        return join(bOPEN("list", 1),
+                    bINT(1), bINT(-2), b"\x00\x01\x81", # 128
+                    b"\x02\x01\x83", # -130
+                    b"\x06" + LONGINT + long_to_bytes(2**40),
+                    bSTR("abc"), b"\x00\x87", # VOCAB 0
+                    FLOAT + struct.pack("!d", 1.5),
+                    b"\x01\x10\x82" + b"x" * 2049, # longer than bulk
+                    bOPEN("list", 2), bINT(3), bCLOSE(2),
+                    bINT(4),
+                    bCLOSE(1))
+
+    def expected(self):
+        return [1, -2, 128, -130, 2**40, b"abc", b"vocabized", 1.5,
+                b"x" * 2049, [3], 4]
+
+    def test_all_at_once(self):
+        self.banana.populateVocabTable([b"vocabized"])
+        tokens = []
+        handleToken = self.banana.handleToken
+        def _record(token, ready_deferred=None):
+            tokens.append(token)
+            return handleToken(token, ready_deferred)
+        self.patch(self.banana, "handleToken", _record)
+        self.assertEqual(self.shouldDecode(self.stream()), self.expected())
+        # only the tokens which the fast path leaves to handleData, and the
+        # lists themselves, go through handleToken
+        self.assertEqual(tokens, [2**40, b"x" * 2049, [3], self.expected()])
+
+    def test_in_pieces(self):
+        stream = self.stream()
+        for chunksize in (1, 2, 3, 7):
+            self.makeBanana()
+            self.banana.populateVocabTable([b"vocabized"])
+            results = []
+            d = self.banana.prepare()
+            d.addCallback(results.append)
+            for i in range(0, len(stream), chunksize):
+                self.banana.dataReceived(stream[i:i+chunksize])
+            self.assertEqual(results, [self.expected()])
+
+    def test_dict(self):
+        self.assertEqual(self.shouldDecode(join(bOPEN("dict", 1),
+                                                bINT(1), bSTR("one"),
+                                                bSTR("two"), bINT(2),
+                                                bCLOSE(1))),
+                         {1: b"one", b"two": 2})
+
+    def test_duplicate_key(self):
+        f = self.shouldDropConnection(join(bOPEN("dict", 1),
+                                           bINT(1), bSTR("one"),
+                                           bINT(1), bSTR("uno"),
+                                           bCLOSE(1)))
+        self.assertIn("duplicate key", f.value.args[0])
+
+class ScopeUnslicer(slicer.ScopedUnslicer):
+    opentype = ('scope',)
+
+    def start(self, count):
+        self.children = []
+
+    def receiveChild(self, obj, ready_deferred=None):
+        self.children.append(obj)
+
+    def receiveClose(self):
+        return self.children, None
+
+class UnscopedRootUnslicer(storage.StorageRootUnslicer):
+    # references only live as long as the enclosing ('scope',) node
+    referenceScope = False
+    topRegistries = (storage.StorageRootUnslicer.topRegistries
+                     + [{('scope',): ScopeUnslicer}])
+    openRegistries = (storage.StorageRootUnslicer.openRegistries
+                      + [{('scope',): ScopeUnslicer}])
+
+class ReferenceScopes(TestBananaMixin, unittest.TestCase):
+    def makeBanana(self):
+        TestBananaMixin.makeBanana(self)
+        self.banana.unslicerClass = UnscopedRootUnslicer
+        self.banana.initUnslicer()
+
+    def test_scope(self):
+        obj = self.shouldDecode(join(bOPEN("scope", 0),
+                                     bOPEN("list", 1), bINT(1), bCLOSE(1),
+                                     bOPEN("reference", 2), bINT(1),
+                                     bCLOSE(2),
+                                     bCLOSE(0)))
+        self.assertEqual(obj, [[1], [1]])
+        self.assertIdentical(obj[0], obj[1])
+        # the scope is gone, and took its references with it
+        self.assertEqual(self.banana.scopeDepth, None)
+        self.assertRaises(ValueError, self.banana.getObject, 1)
+
+    def test_nested_scopes(self):
+        # objects made inside an inner scope are still visible to the outer
+        # one after the inner scope has closed
+        obj = self.shouldDecode(join(bOPEN("scope", 0),
+                                     bOPEN("scope", 1),
+                                     bOPEN("list", 2), bCLOSE(2),
+                                     bCLOSE(1),
+                                     bOPEN("reference", 3), bINT(2),
+                                     bCLOSE(3),
+                                     bCLOSE(0)))
+        self.assertIdentical(obj[0][0], obj[1])
+
+    def test_deep_reference(self):
+        # a reference at the bottom of a deep stack finds its target
+        # without asking every unslicer on the way down
+        self.banana.unslicerClass = storage.StorageRootUnslicer
+        self.banana.initUnslicer()
+        depth = 500
+        outer = inner = []
+        for i in range(depth):
+            child = []
+            inner.append(child)
+            inner = child
+        inner.append(outer)
+        calls = []
+        getObject = storage.StorageRootUnslicer.getObject
+        def _getObject(unslicer, count):
+            calls.append(count)
+            return getObject(unslicer, count)
+        self.patch(storage.StorageRootUnslicer, "getObject", _getObject)
+        def _notAsked(unslicer, count):
+            calls.append(unslicer)
+        self.patch(slicer.BaseUnslicer, "getObject", _notAsked)
+        d = self.encode(outer)
+        def _decode(stream):
+            obj = self.shouldDecode(stream)
+            top = obj
+            for i in range(depth):
+                obj = obj[0]
+            self.assertIdentical(obj[0], top)
+            self.assertEqual(calls, [0])
+        d.addCallback(_decode)
+        return d
+
 class ThereAndBackAgain(TestBananaMixin, unittest.TestCase):
 
     def test_int(self):
@@ -1744,6 +2373,129 @@ class VocabTest2(TestBananaMixin, unittest.TestCase):
         return d
 
 
+class ObjectBanana(banana.Banana):
+    # accepts (add-vocab) and (set-vocab) between objects, like a Broker
+    def __init__(self):
+        banana.Banana.__init__(self)
+        self.received = []
+    def receivedObject(self, obj):
+        self.received.append(obj)
+
+class AdaptiveVocab(unittest.TestCase):
+    def setUp(self):
+        self.sender = ObjectBanana()
+        self.sender.transport = TestTransport()
+        self.sender.adaptiveVocabulary = True
+        self.sender.connectionMade()
+        self.receiver = ObjectBanana()
+        self.receiver.transport = TestTransport()
+        self.receiver.connectionMade()
+
+    def transfer(self):
+        data = self.sender.transport.getvalue()
+        self.sender.transport = TestTransport()
+        self.receiver.dataReceived(data)
+        return data
+
+    def test_promote(self):
+        obj = [b"method-name"] * 4
+        self.sender.send(obj)
+        first = self.transfer()
+        self.assertEqual(self.receiver.received, [obj])
+        self.assertEqual(self.sender.vocabPromotions, 1)
+        self.assertIn(b"method-name", self.sender.outgoingVocabulary)
+        self.assertIn(b"method-name",
+                      self.receiver.incomingVocabulary.values())
+        self.assertEqual(self.sender.vocabTokensSent, 0)
+
+        self.sender.send(obj)
+        second = self.transfer()
+        self.assertEqual(self.receiver.received, [obj, obj])
+        self.assertEqual(self.sender.vocabTokensSent, 4)
+        # each use saves the 11-byte string and its 1-byte length header,
+        # but costs a 1-byte index header
+        self.assertEqual(self.sender.vocabBytesSaved, 4*11)
+        self.assertTrue(len(second) < len(first) - 4*10)
+
+    def test_ignored(self):
+        # short strings, long strings, and rare strings stay as they are
+        obj = [b"abc"]*5 + [b"x"*101]*5 + [b"once", b"twice", b"twice"]
+        self.sender.send(obj)
+        self.transfer()
+        self.assertEqual(self.receiver.received, [obj])
+        self.assertEqual(self.sender.vocabPromotions, 0)
+        self.assertEqual(self.sender.outgoingVocabulary, {})
+        # (the "list" opentype is a candidate too)
+        self.assertEqual(list(self.sender.vocabCandidates.items()),
+                         [(b"list", 1), (b"once", 1), (b"twice", 2)])
+
+    def test_candidates_are_bounded(self):
+        self.sender.maxVocabCandidates = 3
+        obj = [b"one!", b"two!", b"three", b"four", b"one!", b"one!"]
+        self.sender.send(obj)
+        self.transfer()
+        self.assertEqual(self.receiver.received, [obj])
+        # "one!" was pushed out before it could be seen three times
+        self.assertEqual(self.sender.vocabPromotions, 0)
+        self.assertEqual(list(self.sender.vocabCandidates.keys()),
+                         [b"three", b"four", b"one!"])
+
+    def test_evict(self):
+        self.sender.maxAdaptiveVocabulary = 2
+        self.sender.populateVocabTable([b"list"])
+        self.receiver.populateVocabTable([b"list"])
+        strings = [b"apple", b"banana", b"cherry"]
+        obj1 = [strings[0]]*3 + [strings[1]]*3
+        self.sender.send(obj1)
+        self.transfer()
+        obj2 = [strings[1]]*2 + [strings[0]] + [strings[2]]*3
+        self.sender.send(obj2)
+        self.transfer()
+        self.assertEqual(self.sender.vocabPromotions, 3)
+        self.assertEqual(self.sender.vocabReplacements, 1)
+        # the initial entry and the more popular of the old entries survive
+        self.assertEqual(self.sender.outgoingVocabulary,
+                         {b"list": 0, b"banana": 1, b"cherry": 2})
+        self.assertEqual(self.receiver.incomingVocabulary,
+                         {0: b"list", 1: b"banana", 2: b"cherry"})
+        obj3 = strings * 2
+        self.sender.send(obj3)
+        self.transfer()
+        self.assertEqual(self.receiver.received, [obj1, obj2, obj3])
+
+    def test_evict_pending(self):
+        # strings promoted while this object is being sent are still
+        # waiting for their (add-vocab) when the table is replaced, and
+        # must survive the replacement
+        self.sender.maxAdaptiveVocabulary = 2
+        obj1 = [b"apple"]*3 + [b"banana"]*3 + [b"cherry"]*3
+        self.sender.send(obj1)
+        self.transfer()
+        self.assertEqual(self.sender.vocabReplacements, 1)
+        self.assertEqual(self.sender.pendingVocabAdditions, set())
+        for s in self.sender.adaptiveVocabUses:
+            self.assertIn(s, self.sender.outgoingVocabulary)
+        self.assertEqual(sorted(self.sender.outgoingVocabulary),
+                         [b"apple", b"banana", b"cherry"])
+        incoming = self.receiver.incomingVocabulary
+        self.assertEqual(dict((v, k) for (k, v) in incoming.items()),
+                         self.sender.outgoingVocabulary)
+        obj2 = [b"banana"]*2
+        self.sender.send(obj2)
+        self.transfer()
+        self.assertEqual(self.receiver.received, [obj1, obj2])
+
+    def test_incoming_limit(self):
+        self.receiver.maxIncomingVocabulary = 1
+        self.receiver.logReceiveErrors = False
+        self.sender.addToOutgoingVocabulary(b"one")
+        self.sender.addToOutgoingVocabulary(b"two")
+        self.receiver.dataReceived(self.sender.transport.getvalue())
+        self.assertTrue(self.receiver.connectionAbandoned)
+        self.assertEqual(self.receiver.incomingVocabulary, {0: b"one"})
+        self.flushLoggedErrors(BananaError)
+
+
 class SliceableByItself(slicer.BaseSlicer):
     def __init__(self, value):
         self.value = value
@@ -1792,6 +2544,69 @@ class Sliceable(unittest.TestCase):
                        tCLOSE(0)])
         return d
 
+class NotYetSliceable:
+    pass
+class NotYetCopyable:
+    pass
+
+class SlicerDispatch(unittest.TestCase):
+    def setUp(self):
+        self.root = RootSlicer(None)
+
+    def test_cached(self):
+        self.assertIsInstance(self.root.slicerForObject(CouldBeSliceable(1)),
+                              _AndICanHelp)
+        self.assertIn(CouldBeSliceable, root._adapterCache)
+        self.assertIsInstance(self.root.slicerForObject(CouldBeSliceable(2)),
+                              _AndICanHelp)
+        i = SliceableByItself(3)
+        self.assertIdentical(self.root.slicerForObject(i), i)
+
+    def test_register_adapter(self):
+        self.assertRaises(Violation,
+                          self.root.slicerForObject, NotYetSliceable())
+        registerAdapter(_AndICanHelp, NotYetSliceable, ISlicer)
+        self.assertIsInstance(self.root.slicerForObject(NotYetSliceable()),
+                              _AndICanHelp)
+
+    def test_register_copier(self):
+        self.assertRaises(Violation,
+                          self.root.slicerForObject, NotYetCopyable())
+        copyable.registerCopier(NotYetCopyable,
+                                lambda orig: ("NotYetCopyable", {}))
+        s = self.root.slicerForObject(NotYetCopyable())
+        self.assertIsInstance(s, copyable.CopyableSlicer)
+
+    def test_class_implements(self):
+        # a declaration made after an instance has been sliced is noticed
+        class Pt:
+            typeToCopy = "Pt"
+            def getTypeToCopy(self):
+                return self.typeToCopy
+            def getStateToCopy(self):
+                return {}
+        self.assertRaises(Violation, storage.serializeSync, Pt())
+        classImplements(Pt, copyable.ICopyable)
+        data = storage.serializeSync(Pt())
+        self.assertIn(b"copyable", data)
+        self.assertIn(b"Pt", data)
+
+    def test_slicer_table(self):
+        class Thing:
+            pass
+        self.assertRaises(Violation, self.root.slicerForObject, Thing())
+        self.root.slicerTable = {Thing: _AndICanHelp}
+        self.assertIsInstance(self.root.slicerForObject(Thing()),
+                              _AndICanHelp)
+
+    def test_provided_by_instance(self):
+        other = CouldBeSliceable(4)
+        alsoProvides(other, ISlicer)
+        # the instance declaration wins over the adapter for its class
+        self.assertIdentical(self.root.slicerForObject(other), other)
+        self.assertIsInstance(self.root.slicerForObject(CouldBeSliceable(5)),
+                              _AndICanHelp)
+
 
 
 # TODO: vocab test:
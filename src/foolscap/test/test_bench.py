@@ -0,0 +1,142 @@
+import json, os, sys
+from io import StringIO
+from twisted.trial import unittest
+from twisted.internet import utils
+from twisted.python import usage
+from foolscap.bench import timing, serialization, rpc, flog, coroutines, cli
+from foolscap.eventual import flushEventualQueue
+
+class Timing(unittest.TestCase):
+    def test_measure(self):
+        calls = []
+        times = timing.measure(lambda: calls.append(1), mintime=0)
+        self.assertEqual(len(times), 3)
+        self.assertEqual(len(calls), 3)
+        times = timing.measure(lambda: None, mintime=10, maxrounds=5)
+        self.assertEqual(len(times), 5)
+
+    def test_percentile(self):
+        samples = list(range(101))
+        self.assertEqual(timing.percentile(samples, 0.5), 50)
+        self.assertEqual(timing.percentile(samples, 0.99), 99)
+        self.assertEqual(timing.percentile([7], 0.9), 7)
+
+    def test_summarize(self):
+        r = timing.summarize("x", [2.0, 1.0, 4.0], ops=10, bytes=5)
+        self.assertEqual(r["name"], "x")
+        self.assertEqual(r["best_s"], 1.0)
+        self.assertEqual(r["median_s"], 2.0)
+        self.assertEqual(r["ops_per_sec"], 10.0)
+        self.assertEqual(r["bytes"], 5)
+        r = timing.summarizeLatencies("y", [0.001, 0.003, 0.002], 0.5)
+        self.assertEqual(r["ops"], 3)
+        self.assertEqual(r["ops_per_sec"], 6.0)
+        self.assertAlmostEqual(r["latency_ms"]["p50"], 2.0)
+        self.assertAlmostEqual(r["latency_ms"]["max"], 3.0)
+
+class Groups(unittest.TestCase):
+    def checkResults(self, results, prefix):
+        self.assertTrue(results)
+        for r in results:
+            self.assertTrue(r["name"].startswith(prefix), r["name"])
+            self.assertTrue(r["ops_per_sec"] > 0, r)
+        # everything must survive a trip through JSON
+        self.assertEqual(json.loads(json.dumps(results)), results)
+        return [r["name"] for r in results]
+
+    def test_serialization(self):
+        d = serialization.run(size=100, hugeSize=1000, mintime=0)
+        def _check(results):
+            names = self.checkResults(results, "serialization.")
+            self.assertIn("serialization.decode.copyables", names)
+            self.assertIn("serialization.decode.huge_string", names)
+        d.addCallback(_check)
+        return d
+
+    def test_payloads_round_trip(self):
+        serializeSync = serialization.storage.serializeSync
+        for name, make in serialization.PAYLOADS:
+            data = serializeSync(make(100))
+            # Records don't compare equal, so compare their encodings
+            obj = serialization.decodeInChunks(data, 7)
+            self.assertEqual(serializeSync(obj), data, name)
+
+    def test_rpc(self):
+        d = rpc.run(calls=5, connections=1, payloadSize=10)
+        def _check(results):
+            names = self.checkResults(results, "")
+            self.assertEqual(names, ["rpc.loopback.echo_small",
+                                     "rpc.tcp.echo_small",
+                                     "rpc.tcp.echo_records",
+                                     "rpc.tcp.echo_pipelined",
+                                     "rpc.tcp.failure",
+                                     "connect.tcp"])
+            failures = dict([(r["name"], r.get("failures"))
+                             for r in results])
+            self.assertEqual(failures["rpc.tcp.echo_small"], 0)
+            self.assertEqual(failures["rpc.tcp.failure"], 1)
+        d.addCallback(_check)
+        d.addCallback(flushEventualQueue)
+        return d
+
+    def test_logging(self):
+        d = flog.run(events=10, mintime=0)
+        d.addCallback(self.checkResults, "logging.")
+        return d
+
+    def test_asyncio(self):
+        # trial is not on the asyncio reactor, so the measurements that need
+        # asyncio Tasks are skipped
+        d = coroutines.run(calls=5)
+        def _check(results):
+            names = self.checkResults(results, "asyncio.")
+            self.assertEqual(names, ["asyncio.deferred.echo",
+                                     "asyncio.coroutine_target.echo",
+                                     "asyncio.await.echo"])
+        d.addCallback(_check)
+        d.addCallback(flushEventualQueue)
+        return d
+
+class CLI(unittest.TestCase):
+    def test_options(self):
+        o = cli.Options()
+        o.parseOptions([])
+        self.assertEqual(o.groups, ["serialization", "rpc", "logging",
+                                    "asyncio"])
+        o = cli.Options()
+        o.parseOptions(["--quick", "--only", "logging,serialization"])
+        self.assertTrue(o["quick"])
+        self.assertEqual(o.groups, ["logging", "serialization"])
+        o = cli.Options()
+        self.assertRaises(usage.UsageError, o.parseOptions,
+                          ["--only", "nonesuch"])
+
+    def test_bad_option(self):
+        stderr = StringIO()
+        self.assertEqual(cli.run_bench(["bench", "--bogus"], stderr=stderr),
+                         1)
+        self.assertIn("--bogus", stderr.getvalue())
+        # and 'python -m foolscap.bench' exits with it, for make and CI
+        d = utils.getProcessValue(sys.executable,
+                                  ["-m", "foolscap.bench", "--bogus"],
+                                  env=os.environ)
+        d.addCallback(self.assertEqual, 1)
+        return d
+
+    def test_report(self):
+        self.patch(cli, "GROUPS",
+                   [("logging", flog.run, None, {"events": 10,
+                                                 "mintime": 0})])
+        stderr = StringIO()
+        d = cli.runBenchmarks(["logging"], quick=True, stderr=stderr)
+        def _check(report):
+            report = json.loads(json.dumps(report))
+            self.assertEqual(report["quick"], True)
+            self.assertIn("foolscap_version", report)
+            self.assertIn("python_version", report)
+            self.assertEqual([r["name"] for r in report["results"]],
+                             ["logging.msg", "logging.msg_format",
+                              "logging.flogfile_write"])
+            self.assertIn("running logging benchmarks", stderr.getvalue())
+        d.addCallback(_check)
+        return d
@@ -1,5 +1,7 @@
 
 import gc
+import io
+import os
 import re
 import sys
 
@@ -9,17 +11,25 @@ if False:
 
 from twisted.python import log
 from twisted.trial import unittest
+from twisted.internet import defer
 from twisted.internet.main import CONNECTION_LOST, CONNECTION_DONE
+from twisted.internet.error import ConnectionLost, ConnectionDone
 from twisted.python.failure import Failure
 from twisted.application import service
 
-from foolscap.tokens import Violation
+from zope.interface import implementer
+from foolscap.tokens import Violation, InvalidRemoteInterface, BananaError
 from foolscap.eventual import flushEventualQueue
 from foolscap.test.common import HelperTarget, TargetMixin, ShouldFailMixin
 from foolscap.test.common import RIMyTarget, Target, TargetWithoutInterfaces, \
      BrokenTarget, MakeTubsMixin
-from foolscap.api import RemoteException, DeadReferenceError
-from foolscap.call import CopiedFailure
+from foolscap.api import RemoteException, DeadReferenceError, \
+     RemoteInterface, Referenceable, Tub, SendQueueFullError, sendPriority
+from foolscap.schema import ListOf, ByteStringConstraint, UnicodeConstraint, \
+     SpooledStringConstraint
+from foolscap.call import CopiedFailure, BatchSlicer
+from foolscap.remoteinterface import RemoteMethodSchema
+from foolscap import broker
 from foolscap.logging import log as flog
 
 class Unsendable:
@@ -197,6 +207,24 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         return d
     testCall4.timeout = 2
 
+    def test_adaptive_vocabulary(self):
+        # peers which negotiate version 4 accept (add-vocab) at any time, so
+        # repeated method names get abbreviated after a few calls
+        self.callingBroker.adaptiveVocabulary = True
+        rr, target = self.setupTarget(HelperTarget())
+        d = rr.callRemote("echo", b"first")
+        for i in range(5):
+            d.addCallback(lambda res: rr.callRemote("echo", b"again"))
+        def _check(res):
+            self.assertEqual(res, b"again")
+            self.assertIn(b"echo", self.callingBroker.outgoingVocabulary)
+            self.assertIn(b"again", self.callingBroker.outgoingVocabulary)
+            self.assertTrue(self.callingBroker.vocabBytesSaved > 0)
+            self.assertIn(b"echo",
+                          self.targetBroker.incomingVocabulary.values())
+        d.addCallback(_check)
+        return d
+
     def testChoiceOf(self):
         # this is a really small test case to check specific bugs. We
         # definitely need more here.
@@ -547,6 +575,931 @@ class TestCallOnly(TargetMixin, unittest.TestCase):
         return d
     testCallOnly.timeout = 2
 
+class RIArgumentChecks(RemoteInterface):
+    def pair(a=ListOf(int), b=ListOf(bytes)): return None
+    def name(n=ByteStringConstraint(minLength=2),
+             title=UnicodeConstraint(maxLength=5)): return None
+
+@implementer(RIArgumentChecks)
+class ArgumentTarget(Referenceable):
+    def __init__(self):
+        self.calls = []
+    def remote_pair(self, a, b):
+        self.calls.append((a, b))
+    def remote_name(self, n, title=u"x"):
+        self.calls.append((n, title))
+
+class ArgumentChecks(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    """Inbound arguments are mostly checked as their tokens arrive, and then
+    only the parts that the tokens could not tell are checked again."""
+
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_token_checked(self):
+        rr, target = self.setupTarget(ArgumentTarget(), True)
+        d = rr.callRemote("pair", [1, 2], [b"one"])
+        d.addCallback(lambda res: rr.callRemote("name", b"ok", title=u"abc"))
+        def _check(res):
+            self.assertEqual(target.calls, [([1, 2], [b"one"]),
+                                            (b"ok", u"abc")])
+        d.addCallback(_check)
+        return d
+
+    def test_shared_reference(self):
+        # the second argument is a reference to the first, so its opentype
+        # is not checked on the way in, only the object it resolves to
+        rr, target = self.setupTarget(ArgumentTarget(), True)
+        shared = [1, 2]
+        d = self.shouldFail(Violation, "pair", "not a bytestring",
+                            rr.callRemote, "pair", shared, shared,
+                            _useSchema=False)
+        d.addCallback(lambda res: self.assertEqual(target.calls, []))
+        return d
+
+    def test_unenforced(self):
+        # minLength can't be checked by the tokens
+        rr, target = self.setupTarget(ArgumentTarget(), True)
+        d = self.shouldFail(Violation, "name", "string too short",
+                            rr.callRemote, "name", b"x", _useSchema=False)
+        d.addCallback(lambda res:
+                      self.shouldFail(Violation, "title", "string too long",
+                                      rr.callRemote, "name", b"ok",
+                                      title=u"toolong", _useSchema=False))
+        d.addCallback(lambda res: self.assertEqual(target.calls, []))
+        return d
+
+class Recorder(Referenceable):
+    def __init__(self):
+        self.calls = []
+        self.held = {}
+        self.cancelled = []
+    def remote_note(self, n):
+        self.calls.append(n)
+    def remote_hold(self, n):
+        self.calls.append(n)
+        self.held[n] = d = defer.Deferred(lambda d: self.cancelled.append(n))
+        return d
+    def remote_callBack(self, caller, n):
+        self.calls.append(n)
+        return caller.callRemote("note", n)
+
+class Dispatch(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_one_turn(self):
+        # a burst of pipelined calls should be started together, in order,
+        # not one per turn
+        rr, target = self.setupTarget(Recorder())
+        b = self.targetBroker
+        dispatches = []
+        doNextCall = b.doNextCall
+        def _counting():
+            dispatches.append(len(b.inboundDeliveryQueue))
+            return doNextCall()
+        b.doNextCall = _counting
+        d = defer.gatherResults([rr.callRemote("note", i)
+                                 for i in range(100)])
+        def _check(res):
+            self.assertEqual(target.calls, list(range(100)))
+            self.assertTrue(len(dispatches) < 10, dispatches)
+            self.assertEqual(b.inboundCallsRunning, 0)
+        d.addCallback(_check)
+        return d
+
+    def test_max_inbound_calls(self):
+        rr, target = self.setupTarget(Recorder())
+        b = self.targetBroker
+        b.maxInboundCalls = 2
+        results = []
+        for (methname, n) in [("hold", 1), ("hold", 2), ("hold", 3),
+                              ("note", 4)]:
+            rr.callRemote(methname, n).addCallback(results.append)
+        d = self.poll(lambda: len(target.calls) == 2)
+        d.addCallback(flushEventualQueue)
+        def _two_running(res):
+            self.assertEqual(target.calls, [1, 2])
+            self.assertEqual(b.inboundCallsRunning, 2)
+            self.assertEqual(len(b.inboundDeliveryQueue), 2)
+            target.held[1].callback("one")
+            return self.poll(lambda: len(target.calls) == 3)
+        d.addCallback(_two_running)
+        d.addCallback(flushEventualQueue)
+        def _three_started(res):
+            self.assertEqual(target.calls, [1, 2, 3])
+            target.held[2].callback("two")
+            target.held[3].callback("three")
+            return self.poll(lambda: len(results) == 4)
+        d.addCallback(_three_started)
+        def _done(res):
+            self.assertEqual(target.calls, [1, 2, 3, 4])
+            self.assertEqual(results, ["one", "two", "three", None])
+            self.assertEqual(b.inboundCallsRunning, 0)
+        d.addCallback(_done)
+        return d
+
+    def test_option(self):
+        tub = Tub()
+        self.assertEqual(tub.maxInboundCalls, None)
+        tub.setOption("max-inbound-calls", 10)
+        self.assertEqual(tub.maxInboundCalls, 10)
+        tub.setOption("max-inbound-calls", 0)
+        self.assertEqual(tub.maxInboundCalls, None)
+
+class SendQueue(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_wait(self):
+        rr, target = self.setupTarget(Recorder())
+        b = rr.tracker.broker
+        # pretend the transport's write buffer is full
+        b.pauseProducing()
+        dl = [rr.callRemote("note", i) for i in range(3)]
+        self.assertEqual(b.getSendQueueSize(), 3)
+        waited = []
+        rr.waitForSendQueue().addCallback(waited.append)
+        d = flushEventualQueue()
+        def _paused(res):
+            self.assertEqual(target.calls, [])
+            self.assertEqual(waited, [])
+            b.resumeProducing()
+            return defer.gatherResults(dl)
+        d.addCallback(_paused)
+        d.addCallback(flushEventualQueue)
+        def _done(res):
+            self.assertEqual(target.calls, [0, 1, 2])
+            self.assertEqual(waited, [None])
+        d.addCallback(_done)
+        return d
+
+    def test_fail_fast(self):
+        rr, target = self.setupTarget(Recorder())
+        b = rr.tracker.broker
+        b.sendQueueHighWater = 2
+        b.pauseProducing()
+        dl = [rr.callRemote("note", i) for i in range(2)]
+        # without the policy, calls are queued
+        self.assertFalse(b.sendQueueFailFast)
+        dl.append(rr.callRemote("note", 2))
+        self.assertEqual(b.getSendQueueSize(), 3)
+        b.sendQueueFailFast = True
+        d = self.shouldFail(SendQueueFullError, "fail_fast",
+                            "3 messages waiting to be sent",
+                            rr.callRemote, "note", 3)
+        def _resume(res):
+            b.resumeProducing()
+            return defer.gatherResults(dl)
+        d.addCallback(_resume)
+        d.addCallback(lambda res: rr.callRemote("note", 4))
+        d.addCallback(lambda res: self.assertEqual(target.calls,
+                                                   [0, 1, 2, 4]))
+        return d
+
+    def test_options(self):
+        tub = Tub()
+        tub.setOption("send-queue-high-water", 100)
+        tub.setOption("send-queue-low-water", 10)
+        tub.setOption("send-queue-fail-fast", True)
+        b = broker.Broker(None)
+        b.setTub(tub)
+        self.assertEqual(b.sendQueueHighWater, 100)
+        self.assertEqual(b.sendQueueLowWater, 10)
+        self.assertTrue(b.sendQueueFailFast)
+        tub.setOption("send-queue-high-water", 0)
+        self.assertEqual(tub.sendQueueHighWater, None)
+
+class InboundBackpressure(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def holdCalls(self, rr, target, count):
+        results = []
+        for n in range(count):
+            rr.callRemote("hold", n).addCallback(results.append)
+        return results
+
+    def releaseAll(self, target, results, count):
+        b = self.targetBroker
+        released = set()
+        def _releaseStarted():
+            # answer every call that has been started so far
+            for n, d in list(target.held.items()):
+                if n not in released:
+                    released.add(n)
+                    d.callback(n)
+            return len(results) == count
+        d = self.poll(_releaseStarted)
+        def _done(res):
+            self.assertEqual(results, list(range(count)))
+            self.assertFalse(b.receivePaused)
+            self.assertEqual(len(b.buffer), 0)
+        d.addCallback(_done)
+        return d
+
+    def test_queued_calls(self):
+        rr, target = self.setupTarget(Recorder())
+        b = self.targetBroker
+        b.maxInboundCalls = 1
+        b.maxQueuedCalls = 2
+        results = self.holdCalls(rr, target, 6)
+        d = self.poll(lambda: target.calls == [0])
+        d.addCallback(flushEventualQueue)
+        def _paused(res):
+            # call 0 is running, 1 and 2 are queued, and the rest have not
+            # been parsed
+            self.assertTrue(b.receivePaused)
+            self.assertEqual(len(b.inboundDeliveryQueue), 2)
+            self.assertNotEqual(len(b.buffer), 0)
+            self.assertEqual(b.inboundPauses, 2)
+            return self.releaseAll(target, results, 6)
+        d.addCallback(_paused)
+        def _done(res):
+            self.assertEqual(target.calls, list(range(6)))
+            self.assertTrue(b.inboundPausedTime > 0)
+        d.addCallback(_done)
+        return d
+
+    def test_unanswered_calls(self):
+        rr, target = self.setupTarget(Recorder())
+        b = self.targetBroker
+        b.maxUnansweredCalls = 2
+        results = self.holdCalls(rr, target, 5)
+        d = self.poll(lambda: target.calls == [0, 1])
+        d.addCallback(flushEventualQueue)
+        def _paused(res):
+            self.assertTrue(b.receivePaused)
+            self.assertEqual(len(b.activeLocalCalls), 2)
+            self.assertEqual(b.inboundPauses, 1)
+            return self.releaseAll(target, results, 5)
+        d.addCallback(_paused)
+        d.addCallback(lambda res:
+                      self.assertEqual(target.calls, list(range(5))))
+        return d
+
+    def test_call_back(self):
+        # a method which calls back to its caller, and waits for the answer,
+        # must be able to get that answer while its own call is holding
+        # the connection paused
+        rr, target = self.setupTarget(Recorder())
+        b = self.targetBroker
+        b.maxUnansweredCalls = 1
+        caller = Recorder()
+        d = rr.callRemote("callBack", caller, 1)
+        def _check(res):
+            self.assertEqual(target.calls, [1])
+            self.assertEqual(caller.calls, [1])
+            self.assertEqual(b.inboundPauses, 1)
+            self.assertFalse(b.receivePaused)
+        d.addCallback(_check)
+        return d
+
+    def test_receive_buffer(self):
+        rr, target = self.setupTarget(Recorder())
+        b = self.targetBroker
+        b.logReceiveErrors = False
+        b.maxReceiveBuffer = 100
+        b.pauseReceiving()
+        d = rr.callRemote("note", b"x" * 200)
+        def _check(f):
+            f.trap(DeadReferenceError, ConnectionLost, ConnectionDone)
+            self.assertTrue(b.connectionAbandoned)
+            self.assertEqual(target.calls, [])
+        d.addCallbacks(lambda res: self.fail("should have failed"), _check)
+        return d
+
+    def test_options(self):
+        tub = Tub()
+        tub.setOption("max-queued-calls", 100)
+        tub.setOption("max-unanswered-calls", 200)
+        tub.setOption("max-receive-buffer", 10**6)
+        b = broker.Broker(None)
+        b.setTub(tub)
+        self.assertEqual(b.maxQueuedCalls, 100)
+        self.assertEqual(b.maxUnansweredCalls, 200)
+        self.assertEqual(b.maxReceiveBuffer, 10**6)
+        tub.setOption("max-queued-calls", 0)
+        self.assertEqual(tub.maxQueuedCalls, None)
+
+class Cancellation(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_running(self):
+        rr, target = self.setupTarget(Recorder())
+        d = rr.callRemote("hold", 1)
+        d2 = self.poll(lambda: target.calls == [1])
+        d2.addCallback(lambda res: d.cancel())
+        d2.addCallback(lambda res: self.assertFailure(d, defer.CancelledError))
+        d2.addCallback(lambda res: self.poll(lambda: target.cancelled))
+        def _check(res):
+            self.assertEqual(target.cancelled, [1])
+            self.assertEqual(self.targetBroker.inboundCancels, 1)
+            self.assertEqual(self.targetBroker.activeLocalCalls, {})
+            self.assertEqual(self.callingBroker.waitingForAnswers, {})
+        d2.addCallback(_check)
+        return d2
+
+    def test_queued(self):
+        # a call which has not been started yet never will be
+        rr, target = self.setupTarget(Recorder())
+        b = self.targetBroker
+        b.maxInboundCalls = 1
+        d1 = rr.callRemote("hold", 1)
+        d2 = rr.callRemote("hold", 2)
+        d = self.poll(lambda: target.calls == [1])
+        d.addCallback(lambda res: d2.cancel())
+        d.addCallback(lambda res: self.poll(lambda: b.inboundCancels == 1))
+        def _cancelled(res):
+            self.assertEqual(len(b.inboundDeliveryQueue), 0)
+            target.held[1].callback("one")
+            return d1
+        d.addCallback(_cancelled)
+        d.addCallback(lambda res: self.assertEqual(res, "one"))
+        d.addCallback(flushEventualQueue)
+        d.addCallback(lambda res: self.assertEqual(target.calls, [1]))
+        d.addCallback(lambda res: self.assertFailure(d2, defer.CancelledError))
+        return d
+
+    def test_unsent(self):
+        # a call which is still in our send queue is simply dropped
+        rr, target = self.setupTarget(Recorder())
+        b = self.callingBroker
+        b.pauseProducing()
+        d1 = rr.callRemote("note", 1)
+        d1.cancel()
+        self.assertEqual(b.getSendQueueSize(), 0)
+        b.resumeProducing()
+        d = self.assertFailure(d1, defer.CancelledError)
+        d.addCallback(lambda res: rr.callRemote("note", 2))
+        def _check(res):
+            self.assertEqual(target.calls, [2])
+            self.assertEqual(self.targetBroker.inboundCancels, 0)
+        d.addCallback(_check)
+        return d
+
+    def test_timeout(self):
+        rr, target = self.setupTarget(Recorder())
+        d = self.shouldFail(defer.TimeoutError, "timeout", None,
+                            rr.callRemote, "hold", 1, _timeout=0.1)
+        d.addCallback(lambda res: self.poll(lambda: target.cancelled))
+        d.addCallback(lambda res: self.assertEqual(target.cancelled, [1]))
+        # calls which finish in time are unaffected
+        d.addCallback(lambda res: rr.callRemote("note", 2, _timeout=10))
+        d.addCallback(lambda res: self.assertEqual(target.calls, [1, 2]))
+        return d
+
+    def test_late_answer(self):
+        # the answer and the cancel cross on the wire
+        rr, target = self.setupTarget(Recorder())
+        d1 = rr.callRemote("hold", 1)
+        d = self.poll(lambda: target.calls == [1])
+        def _answer(res):
+            target.held[1].callback("one")
+            d1.cancel()
+            return self.assertFailure(d1, defer.CancelledError)
+        d.addCallback(_answer)
+        d.addCallback(flushEventualQueue)
+        d.addCallback(lambda res: rr.callRemote("note", 2))
+        def _check(res):
+            self.assertEqual(target.calls, [1, 2])
+            self.assertEqual(target.cancelled, [])
+            self.assertEqual(self.targetBroker.inboundCancels, 0)
+        d.addCallback(_check)
+        return d
+
+class Batch(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        # these brokers did not negotiate a version
+        self.callingBroker.acceptsBatches = True
+
+    def requestsUsed(self, f):
+        # how many reqIDs did f() use?
+        first = next(self.callingBroker.nextReqID)
+        d = f()
+        return d, next(self.callingBroker.nextReqID) - first - 1
+
+    def sendBatch(self, rr):
+        b = rr.startBatch()
+        dl = [b.callRemote("add", 1, 2),
+              b.callRemote("add", a=3, b=4),
+              b.callRemote("fail"),
+              b.callRemote("add", 5, "six")]
+        b.send()
+        d = defer.DeferredList(dl, consumeErrors=True)
+        return d
+
+    def checkResults(self, res, target):
+        self.assertEqual([ok for (ok, r) in res], [True, True, False, False])
+        self.assertEqual(res[0][1], 3)
+        self.assertEqual(res[1][1], 7)
+        self.assertTrue(res[2][1].check(ValueError))
+        # caught locally, before anything was sent
+        self.assertTrue(res[3][1].check(Violation))
+        self.assertEqual(target.calls, [(1, 2), (3, 4)])
+        self.assertEqual(self.callingBroker.waitingForAnswers, {})
+        self.assertEqual(self.targetBroker.activeLocalCalls, {})
+
+    def test_batch(self):
+        rr, target = self.setupTarget(Target(), True)
+        d, used = self.requestsUsed(lambda: self.sendBatch(rr))
+        self.assertEqual(used, 1) # one call, so one answer
+        d.addCallback(self.checkResults, target)
+        return d
+
+    def test_fallback(self):
+        # peers which do not understand batches get separate calls
+        self.callingBroker.acceptsBatches = False
+        rr, target = self.setupTarget(Target(), True)
+        d, used = self.requestsUsed(lambda: self.sendBatch(rr))
+        self.assertEqual(used, 3)
+        d.addCallback(self.checkResults, target)
+        return d
+
+    def test_empty(self):
+        # an empty batch is not sent at all
+        rr, target = self.setupTarget(Target(), True)
+        b = rr.startBatch()
+        d, used = self.requestsUsed(lambda: defer.succeed(b.send()))
+        self.assertEqual(used, 0)
+        return d
+
+    def test_empty_is_rejected(self):
+        # it would never be answered, so the receiver drops the connection
+        # rather than hold it against maxUnansweredCalls
+        rr, target = self.setupTarget(Target(), True)
+        self.targetBroker.logReceiveErrors = False
+        reqID = self.callingBroker.newRequestID()
+        self.callingBroker.send(BatchSlicer(reqID, rr.tracker.clid, []))
+        d = flushEventualQueue()
+        def _check(res):
+            self.assertTrue(self.targetBroker.connectionAbandoned)
+            self.flushLoggedErrors(BananaError)
+        d.addCallback(_check)
+        return d
+
+    def test_result_violation(self):
+        # the rest of the answer is discarded, so every call fails
+        rr, target = self.setupTarget(Recorder())
+        b = rr.startBatch()
+        d1 = b.callRemote("note", 1)
+        d2 = b.callRemote("note", 2, _resultConstraint=int)
+        b.send()
+        d = self.shouldFail(Violation, "result", "rejected by Integer",
+                            lambda: d2)
+        d.addCallback(lambda res: self.assertFailure(d1, Violation))
+        d.addCallback(lambda res: self.assertEqual(target.calls, [1, 2]))
+        return d
+
+    def test_cancel(self):
+        rr, target = self.setupTarget(Recorder())
+        b = rr.startBatch()
+        d1 = b.callRemote("note", 1)
+        d2 = b.callRemote("hold", 2)
+        b.send()
+        d = self.poll(lambda: target.calls == [1, 2])
+        d.addCallback(lambda res: b.cancel())
+        d.addCallback(lambda res: self.assertFailure(d1, defer.CancelledError))
+        d.addCallback(lambda res: self.assertFailure(d2, defer.CancelledError))
+        d.addCallback(lambda res: self.poll(lambda: target.cancelled))
+        def _check(res):
+            self.assertEqual(target.cancelled, [2])
+            self.assertEqual(self.targetBroker.inboundCancels, 1)
+            self.assertEqual(self.targetBroker.activeLocalCalls, {})
+        d.addCallback(_check)
+        return d
+
+class Child(Referenceable):
+    def __init__(self, name):
+        self.name = name
+    def remote_read(self):
+        return self.name
+    def remote_getChild(self, name):
+        return Child(self.name + name)
+
+class Parent(Referenceable):
+    def __init__(self):
+        self.held = []
+    def remote_getChild(self, name):
+        return Child(name)
+    def remote_holdChild(self):
+        d = defer.Deferred()
+        self.held.append(d)
+        return d
+    def remote_getTarget(self):
+        return Target()
+    def remote_getNumber(self):
+        return 3
+    def remote_fail(self):
+        raise ValueError("no children")
+
+class Pipelining(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        # these brokers did not negotiate a version
+        self.callingBroker.acceptsPipelining = True
+
+    def checkReleased(self, res):
+        # the far end forgets each answer once we have it
+        return self.poll(lambda: not self.targetBroker.retainedAnswers)
+
+    def test_pipelined(self):
+        rr, target = self.setupTarget(Parent())
+        p = rr.callRemotePipelined("getChild", b"a")
+        d1 = p.callRemote("read")
+        d2 = p.callRemotePipelined("getChild", b"b").callRemote("read")
+        # both were sent before the answer came back
+        self.assertTrue(p._isPipelining())
+        d = defer.gatherResults([d1, d2, p.whenResolved()])
+        def _check(res):
+            self.assertEqual(res[:2], [b"a", b"ab"])
+            self.assertFalse(p._isPipelining())
+            # once resolved, calls go straight to the answer
+            return p.callRemote("read")
+        d.addCallback(_check)
+        d.addCallback(lambda res: self.assertEqual(res, b"a"))
+        d.addCallback(self.checkReleased)
+        return d
+
+    def test_waiting(self):
+        # calls that arrive before the answer is known wait for it
+        rr, target = self.setupTarget(Parent())
+        p = rr.callRemotePipelined("holdChild")
+        d1 = p.callRemote("read")
+        d = self.poll(lambda: target.held and
+                      self.targetBroker.retainedAnswers[1].waiting)
+        d.addCallback(lambda res: target.held[0].callback(Child(b"c")))
+        d.addCallback(lambda res: d1)
+        d.addCallback(lambda res: self.assertEqual(res, b"c"))
+        d.addCallback(self.checkReleased)
+        return d
+
+    def test_failure(self):
+        rr, target = self.setupTarget(Parent())
+        p = rr.callRemotePipelined("fail")
+        d1 = p.callRemote("read")
+        d = self.shouldFail(ValueError, "pipelined", "no children",
+                            lambda: d1)
+        d.addCallback(lambda res: self.shouldFail(ValueError, "answer",
+                                                  "no children",
+                                                  p.whenResolved))
+        d.addCallback(self.checkReleased)
+        return d
+
+    def test_not_referenceable(self):
+        rr, target = self.setupTarget(Parent())
+        p = rr.callRemotePipelined("getNumber")
+        d = self.shouldFail(Violation, "number", "cannot receive method calls",
+                            p.callRemote, "read")
+        d.addCallback(lambda res: p.whenResolved())
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        d.addCallback(self.checkReleased)
+        return d
+
+    def test_arguments_are_checked(self):
+        rr, target = self.setupTarget(Parent())
+        p = rr.callRemotePipelined("getTarget")
+        d = self.shouldFail(Violation, "add", "is not a number",
+                            p.callRemote, "add", 1, b"two")
+        d.addCallback(lambda res: p.callRemote("add", 1, 2))
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        d.addCallback(self.checkReleased)
+        return d
+
+    def test_fallback(self):
+        # peers which do not understand pipelining get the calls once the
+        # answer has come back
+        self.callingBroker.acceptsPipelining = False
+        rr, target = self.setupTarget(Parent())
+        p = rr.callRemotePipelined("getChild", b"a")
+        d1 = p.callRemote("read")
+        d2 = p.callRemotePipelined("getChild", b"b").callRemote("read")
+        self.assertFalse(p._isPipelining())
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda res: self.assertEqual(res, [b"a", b"ab"]))
+        return d
+
+class DecrefBatching(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def countBatches(self):
+        batches = []
+        original = self.targetBroker.scheduleBatch
+        def _schedule(batch):
+            batches.append(len(batch.calls))
+            return original(batch)
+        self.targetBroker.scheduleBatch = _schedule
+        return batches
+
+    def dropChildren(self, rr, how_many):
+        # returns a Deferred that fires once the far end has forgotten them
+        self.rr = rr # but not the parent
+        # DeferredList would hold on to the references, so collect them
+        children = []
+        dl = []
+        for i in range(how_many):
+            d = rr.callRemote("getChild", str(i))
+            d.addCallback(children.append)
+            dl.append(d)
+        d = defer.DeferredList(dl, fireOnOneErrback=True)
+        # and so does the Deferred that is delivering the last one, until it
+        # has finished
+        d.addCallback(flushEventualQueue)
+        def _drop(res):
+            self.assertEqual(len(self.targetBroker.myReferenceByCLID),
+                             how_many + 1)
+            del children[:]
+            gc.collect()
+            return self.poll(lambda:
+                             len(self.targetBroker.myReferenceByCLID) == 1)
+        d.addCallback(_drop)
+        d.addCallback(lambda res: self.poll(lambda:
+                      len(self.callingBroker.yourReferenceByCLID) == 1))
+        return d
+
+    def test_batched(self):
+        # everything dropped in one turn is released in a single batch
+        self.callingBroker.acceptsBatches = True
+        self.callingBroker.decrefBatchSize = 15
+        batches = self.countBatches()
+        sent = recordSends(self.callingBroker)
+        rr, target = self.setupTarget(Parent())
+        d = self.dropChildren(rr, 20)
+        d.addCallback(lambda res: self.assertEqual(batches, [15, 5]))
+        # decrefs are control traffic
+        d.addCallback(lambda res:
+                      self.assertEqual([p for (name, p) in sent
+                                        if name == "BatchSlicer"],
+                                       ["control", "control"]))
+        return d
+
+    def test_fallback(self):
+        # peers which do not understand batches get one decref at a time
+        batches = self.countBatches()
+        sent = recordSends(self.callingBroker)
+        rr, target = self.setupTarget(Parent())
+        d = self.dropChildren(rr, 20)
+        d.addCallback(lambda res: self.assertEqual(batches, []))
+        d.addCallback(lambda res:
+                      self.assertEqual(sent.count(("CallSlicer", "control")),
+                                       20))
+        return d
+
+    def freeGifts(self, rr):
+        # we claim two copies of a gift that the far end gave us
+        self.rr = rr # the decref would be sent alongside
+        self.batches = self.countBatches()
+        self.sent = recordSends(self.callingBroker)
+        self.answers = recordSends(self.targetBroker)
+        giftID = self.targetBroker.makeGift(rr)
+        self.targetBroker.makeGift(rr)
+        self.callingBroker.freeGift(giftID)
+        self.callingBroker.freeGift(giftID)
+        d = flushEventualQueue()
+        d.addCallback(lambda res: self.assertEqual(self.targetBroker.myGifts,
+                                                   {}))
+        return d
+
+    def test_decgifts_batched(self):
+        # the two claims are sent as one decgift
+        self.callingBroker.acceptsBatches = True
+        rr, target = self.setupTarget(Parent())
+        d = self.freeGifts(rr)
+        d.addCallback(lambda res: self.assertEqual(self.batches, [1]))
+        d.addCallback(lambda res: self.assertEqual(self.sent,
+                                                   [("BatchSlicer",
+                                                     "control")]))
+        return d
+
+    def test_decgifts_fallback(self):
+        # without batches, the decgift is sent without asking for an answer
+        rr, target = self.setupTarget(Parent())
+        d = self.freeGifts(rr)
+        d.addCallback(lambda res: self.assertEqual(self.batches, []))
+        d.addCallback(lambda res: self.assertEqual(self.sent,
+                                                   [("CallSlicer",
+                                                     "control")]))
+        d.addCallback(lambda res: self.assertEqual(self.answers, []))
+        return d
+
+def recordSends(b):
+    # returns a list of (slicer class name, priority), one per b.send()
+    sent = []
+    original = b.send
+    def _send(obj, priority="interactive", flow=None):
+        sent.append((obj.__class__.__name__, priority))
+        return original(obj, priority, flow)
+    b.send = _send
+    return sent
+
+class RIPriorities(RemoteInterface):
+    @sendPriority("bulk")
+    def fetch(name=bytes):
+        return bytes
+    poke = RemoteMethodSchema(__priority__="control", _response=int)
+    def add(a=int, b=int):
+        return int
+
+@implementer(RIPriorities)
+class Priorities(Referenceable):
+    def remote_fetch(self, name):
+        return name * 3
+    def remote_poke(self):
+        return 1
+    def remote_add(self, a, b):
+        return a + b
+
+class SendPriority(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        self.callerSends = recordSends(self.callingBroker)
+        self.targetSends = recordSends(self.targetBroker)
+
+    def test_default(self):
+        rr, target = self.setupTarget(Target())
+        d = rr.callRemote("add", 1, 2)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        d.addCallback(lambda res:
+                      self.assertEqual(self.callerSends,
+                                       [("CallSlicer", "interactive")]))
+        d.addCallback(lambda res:
+                      self.assertEqual(self.targetSends,
+                                       [("AnswerSlicer", "interactive")]))
+        return d
+
+    def test_per_call(self):
+        rr, target = self.setupTarget(Target())
+        d = rr.callRemote("add", 1, 2, _priority="bulk")
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        d.addCallback(lambda res:
+                      self.assertEqual(self.callerSends,
+                                       [("CallSlicer", "bulk")]))
+        return d
+
+    def test_interface(self):
+        rr, target = self.setupTarget(Priorities(), True)
+        d = rr.callRemote("fetch", b"a")
+        d.addCallback(lambda res: self.assertEqual(res, b"aaa"))
+        d.addCallback(lambda res: rr.callRemote("poke"))
+        # an explicit _priority= overrides the RemoteInterface
+        d.addCallback(lambda res: rr.callRemote("fetch", b"b",
+                                                _priority="interactive"))
+        def _check(res):
+            self.assertEqual(self.callerSends,
+                             [("CallSlicer", "bulk"),
+                              ("CallSlicer", "control"),
+                              ("CallSlicer", "interactive")])
+            # answers take the priority from the target's RemoteInterface
+            self.assertEqual(self.targetSends,
+                             [("AnswerSlicer", "bulk"),
+                              ("AnswerSlicer", "control"),
+                              ("AnswerSlicer", "bulk")])
+        d.addCallback(_check)
+        return d
+
+    def test_overtake(self):
+        # while bulk calls are waiting to be sent, a control call goes first
+        rr, target = self.setupTarget(Target())
+        self.callingBroker.pauseProducing()
+        order = []
+        dl = []
+        for (a, priority) in [(1, "bulk"), (2, "bulk"), (3, "control")]:
+            d = rr.callRemote("add", a, 0, _priority=priority)
+            d.addCallback(order.append)
+            dl.append(d)
+        self.callingBroker.resumeProducing()
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda res: self.assertEqual(order, [3, 1, 2]))
+        d.addCallback(lambda res:
+                      self.assertEqual(target.calls, [(3, 0), (1, 0), (2, 0)]))
+        return d
+
+    def test_pipelined(self):
+        # calls aimed at an answer never overtake the call that produces it
+        self.callingBroker.acceptsPipelining = True
+        rr, target = self.setupTarget(Parent())
+        p = rr.callRemotePipelined("getChild", b"a", _priority="bulk")
+        d1 = p.callRemote("read", _priority="control")
+        self.assertEqual(self.callerSends,
+                         [("RetainAnswerSlicer", "bulk"),
+                          ("CallSlicer", "bulk"),
+                          ("PipelinedCallSlicer", "bulk")])
+        d1.addCallback(lambda res: self.assertEqual(res, b"a"))
+        d1.addCallback(lambda res: p.whenResolved())
+        # once it is resolved, the child is just another RemoteReference
+        d1.addCallback(lambda res: p.callRemote("read", _priority="control"))
+        d1.addCallback(lambda res:
+                       self.assertEqual(self.callerSends[-1],
+                                        ("CallSlicer", "control")))
+        return d1
+
+    def test_batch(self):
+        self.callingBroker.acceptsBatches = True
+        rr, target = self.setupTarget(Target())
+        b = rr.startBatch()
+        d = b.callRemote("add", 1, 2)
+        b.send(priority="bulk")
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        d.addCallback(lambda res:
+                      self.assertEqual(self.callerSends,
+                                       [("BatchSlicer", "bulk")]))
+        return d
+
+    def test_bad_priority(self):
+        rr, target = self.setupTarget(Target())
+        d = self.shouldFail(ValueError, "test_bad_priority",
+                            "send priority must be one of",
+                            rr.callRemote, "add", 1, 2, _priority="urgent")
+        d.addCallback(lambda res: self.assertEqual(self.callerSends, []))
+        return d
+
+    def test_bad_interface_priority(self):
+        self.assertRaises(InvalidRemoteInterface, sendPriority, "urgent")
+        self.assertRaises(InvalidRemoteInterface, RemoteMethodSchema,
+                          __priority__="urgent")
+
+class SpoolRecorder(object):
+    # a spool which is not a file
+    def __init__(self):
+        self.writes = []
+    def write(self, data):
+        self.writes.append(data)
+
+recorders = []
+def makeRecorder(size):
+    recorders.append(SpoolRecorder())
+    return recorders[-1]
+
+class RIUploads(RemoteInterface):
+    def upload(data=SpooledStringConstraint(maxLength=10*1000*1000,
+                                            threshold=1000),
+               name=bytes):
+        return bytes
+    def record(data=SpooledStringConstraint(spoolFactory=makeRecorder)):
+        return int
+
+@implementer(RIUploads)
+class Uploads(Referenceable):
+    def remote_upload(self, data, name):
+        self.data = data
+        return data.read()
+    def remote_record(self, data):
+        return len(data.writes)
+
+class Spooling(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_small(self):
+        rr, target = self.setupTarget(Uploads())
+        d = rr.callRemote("upload", b"small", name=b"a")
+        def _check(res):
+            self.assertEqual(res, b"small")
+            self.assertIsInstance(target.data, io.BytesIO)
+        d.addCallback(_check)
+        return d
+
+    def test_large(self):
+        body = os.urandom(2*1000*1000)
+        rr, target = self.setupTarget(Uploads())
+        d = rr.callRemote("upload", name=b"big", data=body)
+        def _check(res):
+            self.assertEqual(res, body)
+            # this one went to a real file
+            self.assertTrue(hasattr(target.data, "fileno"))
+            self.assertNotIsInstance(target.data, io.BytesIO)
+        d.addCallback(_check)
+        return d
+
+    def test_too_large(self):
+        rr, target = self.setupTarget(Uploads())
+        return self.shouldFail(Violation, "too_large", "token too large",
+                               rr.callRemote, "upload",
+                               b"x" * (10*1000*1000 + 1), b"big")
+
+    def test_factory(self):
+        del recorders[:]
+        rr, target = self.setupTarget(Uploads())
+        d = rr.callRemote("record", b"y" * 5000)
+        def _check(res):
+            self.assertEqual(len(recorders), 1)
+            self.assertEqual(b"".join(recorders[0].writes), b"y" * 5000)
+        d.addCallback(_check)
+        return d
+
 class ExamineFailuresMixin:
     def _examine_raise(self, r, should_be_remote):
         f = r[0]
@@ -0,0 +1,121 @@
+import os, threading
+import concurrent.futures
+from twisted.trial import unittest
+from twisted.internet import defer
+from foolscap.api import Referenceable, RemoteInterface, \
+     runInThread, runInProcess, Violation
+from foolscap import executors
+from foolscap.test.common import TargetMixin, ShouldFailMixin
+from zope.interface import implementer
+
+class RIOffloaded(RemoteInterface):
+    def where(): return bytes
+    def slow(n=int): return int
+    def wrong(): return int
+    def pid(): return int
+    def explode(): return None
+
+def _threadName():
+    return threading.current_thread().name.encode("ascii")
+
+@implementer(RIOffloaded)
+class Offloaded(Referenceable):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.maxRunning = 0
+        self.release = threading.Event()
+
+    @runInThread
+    def remote_where(self):
+        return _threadName()
+
+    @runInThread(maxConcurrent=2)
+    def remote_slow(self, n):
+        with self.lock:
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+        self.release.wait(10)
+        with self.lock:
+            self.running -= 1
+        return n
+
+    @runInThread
+    def remote_wrong(self):
+        return "not an int"
+
+    @staticmethod
+    @runInProcess
+    def remote_pid():
+        return os.getpid()
+
+    @staticmethod
+    @runInProcess(maxConcurrent=1)
+    def remote_explode():
+        raise ValueError("boom")
+
+class Executors(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+
+    def test_thread(self):
+        rr, target = self.setupTarget(Offloaded(), True)
+        d = rr.callRemote("where")
+        def _check(name):
+            self.assertNotEqual(name, _threadName())
+        d.addCallback(_check)
+        return d
+
+    def test_results_are_checked(self):
+        rr, target = self.setupTarget(Offloaded(), True)
+        return self.shouldFail(Violation, "wrong", "is not a number",
+                               rr.callRemote, "wrong")
+
+    def test_arguments_are_checked(self):
+        # the method must not be started at all
+        rr, target = self.setupTarget(Offloaded(), True)
+        d = self.shouldFail(Violation, "slow", "STRING token rejected",
+                            rr.callRemote, "slow", b"one",
+                            _useSchema=False)
+        d.addCallback(lambda res: self.assertEqual(target.maxRunning, 0))
+        return d
+
+    def test_max_concurrent(self):
+        rr, target = self.setupTarget(Offloaded(), True)
+        self.addCleanup(target.release.set)
+        dl = [rr.callRemote("slow", n) for n in range(5)]
+        d = self.poll(lambda: target.running == 2)
+        def _running(res):
+            # the other three are waiting for the semaphore
+            self.assertEqual(target.running, 2)
+            target.release.set()
+            return defer.gatherResults(dl)
+        d.addCallback(_running)
+        def _done(res):
+            self.assertEqual(res, list(range(5)))
+            self.assertEqual(target.maxRunning, 2)
+        d.addCallback(_done)
+        return d
+
+    def usePool(self):
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        executors.setProcessPool(pool)
+        self.addCleanup(executors.setProcessPool, None)
+        self.addCleanup(pool.shutdown)
+
+    def test_process(self):
+        self.usePool()
+        rr, target = self.setupTarget(Offloaded(), True)
+        d = rr.callRemote("pid")
+        d.addCallback(lambda pid: self.assertNotEqual(pid, os.getpid()))
+        return d
+
+    def test_process_failure(self):
+        self.usePool()
+        rr, target = self.setupTarget(Offloaded(), True)
+        return self.shouldFail(ValueError, "explode", "boom",
+                               rr.callRemote, "explode")
+
+    def test_not_marked(self):
+        self.assertEqual(executors.callRemoteMethod(len, ([1, 2],), {}), 2)
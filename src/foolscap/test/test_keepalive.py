@@ -134,3 +134,23 @@ class Keepalives(MakeTubsMixin, unittest.TestCase):
         return self.do_testNoDisconnect(0)
     def testNoDisconnect1(self):
         return self.do_testNoDisconnect(1)
+
+    def testPaused(self):
+        # while we have stopped reading, the PONGs wait in the socket, so
+        # we must not decide the connection is dead
+        self.services[1].setOption("keepaliveTimeout", 0.1)
+        self.services[1].setOption("disconnectTimeout", 0.5)
+        d = self.getRef()
+        def _pause(rref):
+            rref.tracker.broker.pauseReceiving()
+            return rref
+        d.addCallback(_pause)
+        d.addCallback(self.stall, 1.5)
+        def _resume(rref):
+            b = rref.tracker.broker
+            self.assertFalse(b.disconnected)
+            b.resumeReceiving()
+            return rref.callRemote("add", 1, 2)
+        d.addCallback(_resume)
+        d.addCallback(lambda res: self.assertEqual(res, 3))
+        return d
@@ -525,18 +525,18 @@ class Existing(CrossfireMixin, unittest.TestCase):
 # this test will have to change when the regular Negotiation starts using
 # different decision blocks. The version numbers must be updated each time
 # the negotiation version is changed.
-assert negotiate.Negotiation.maxVersion == 3
+assert negotiate.Negotiation.maxVersion == 8
 MAX_HANDLED_VERSION = negotiate.Negotiation.maxVersion
-UNHANDLED_VERSION = 4
+UNHANDLED_VERSION = 9
 class NegotiationVbig(negotiate.Negotiation):
     maxVersion = UNHANDLED_VERSION
     def __init__(self, logparent):
         negotiate.Negotiation.__init__(self, logparent)
         self.negotiationOffer["extra"] = "new value"
-    def evaluateNegotiationVersion4(self, offer):
+    def evaluateNegotiationVersion9(self, offer):
         # just like v1, but different
         return self.evaluateNegotiationVersion1(offer)
-    def acceptDecisionVersion4(self, decision):
+    def acceptDecisionVersion9(self, decision):
         return self.acceptDecisionVersion1(decision)
 
 class NegotiationVbigOnly(NegotiationVbig):
@@ -559,6 +559,16 @@ class Future(BaseMixin, unittest.TestCase):
         def _check_version(rref):
             ver = rref.tracker.broker._banana_decision_version
             self.assertEqual(ver, MAX_HANDLED_VERSION)
+            # version 4 enables the adaptive vocabulary
+            self.assertTrue(rref.tracker.broker.adaptiveVocabulary)
+            # and version 5 enables batches
+            self.assertTrue(rref.tracker.broker.acceptsBatches)
+            # and version 6 enables pipelining
+            self.assertTrue(rref.tracker.broker.acceptsPipelining)
+            # and version 7 enables streamed answers
+            self.assertTrue(rref.tracker.broker.acceptsStreams)
+            # and version 8 enables streamed arguments
+            self.assertTrue(rref.tracker.broker.acceptsByteStreams)
         d.addCallback(_check_version)
         return d
     testFuture1.timeout = 10
@@ -683,6 +693,59 @@ class Future(BaseMixin, unittest.TestCase):
         return d
     testTooFarInFuture4.timeout = 10
 
+class Compression(BaseMixin, unittest.TestCase):
+    @inlineCallbacks
+    def connect(self, serverCert, clientCert,
+                serverCompression, clientCompression):
+        url, portnum = self.makeSpecificServer(serverCert)
+        if serverCompression is not None:
+            self.tub.setOption("compression", serverCompression)
+        client = Tub(certData=clientCert)
+        if clientCompression is not None:
+            client.setOption("compression", clientCompression)
+        client.startService()
+        self.services.append(client)
+        rref = yield client.getReference(url)
+        # make sure the connection still works
+        res = yield rref.callRemote("add", a=1, b=2)
+        self.assertEqual(res, 3)
+        [serverBroker] = self.tub.brokers.values()
+        clientBroker = rref.tracker.broker
+        return serverBroker, clientBroker
+
+    @inlineCallbacks
+    def test_server_decides(self):
+        server, client = yield self.connect(certData_high, certData_low,
+                                            "zlib", ["zlib"])
+        self.assertEqual(server.streamCompression.name, "zlib")
+        self.assertEqual(client.streamCompression.name, "zlib")
+
+    @inlineCallbacks
+    def test_client_decides(self):
+        server, client = yield self.connect(certData_low, certData_high,
+                                            "zlib", "zlib")
+        self.assertEqual(server.streamCompression.name, "zlib")
+        self.assertEqual(client.streamCompression.name, "zlib")
+
+    @inlineCallbacks
+    def test_only_server_offers(self):
+        server, client = yield self.connect(certData_high, certData_low,
+                                            "zlib", None)
+        self.assertEqual(server.streamCompression, None)
+        self.assertEqual(client.streamCompression, None)
+
+    @inlineCallbacks
+    def test_only_client_offers(self):
+        server, client = yield self.connect(certData_high, certData_low,
+                                            None, "zlib")
+        self.assertEqual(server.streamCompression, None)
+        self.assertEqual(client.streamCompression, None)
+
+    def test_unknown_algorithm(self):
+        t = Tub()
+        self.assertRaises(ValueError, t.setOption, "compression", "zlib,lzma")
+        self.assertEqual(t.compressionAlgorithms, ())
+
 
 class Replacement(BaseMixin, unittest.TestCase):
     # in certain circumstances, a new connection is supposed to replace an
@@ -40,6 +40,8 @@ class TestRequest(call.PendingRequest):
 class NullTransport:
     def write(self, data):
         pass
+    def writeSequence(self, iovec):
+        pass
     def loseConnection(self, why=None):
         pass
 
@@ -0,0 +1,110 @@
+
+from twisted.trial import unittest
+from foolscap import receivebuffer
+from foolscap.receivebuffer import ReceiveBuffer
+
+class T(unittest.TestCase):
+    def test_append(self):
+        c = ReceiveBuffer()
+        c.append(b"ab")
+        self.assertEqual(len(c), 2)
+        c.append(b"")
+        self.assertEqual(len(c), 2)
+        c.append(b"c")
+        self.assertEqual(len(c), 3)
+        self.assertEqual(c.peek(10), b"abc")
+        self.assertEqual(len(c), 3)
+
+    def test_popleft(self):
+        c = ReceiveBuffer()
+        c.append(b"ab")
+        self.assertEqual(c.popleft(1), b"a")
+        self.assertEqual(c.peek(10), b"b")
+        self.assertEqual(c.popleft(1), b"b")
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.popleft(1), b"")
+
+        c.append(b"ab")
+        c.append(b"c")
+        s = c.popleft(2)
+        self.assertEqual(s, b"ab")
+        self.assertEqual(type(s), bytes)
+        self.assertEqual(c.popleft(4), b"c") # We just silently pop them all.
+        self.assertEqual(len(c), 0)
+
+    def test_skip_rewind(self):
+        c = ReceiveBuffer()
+        c.append(b"abcde")
+        c.skip(2)
+        self.assertEqual(c.peek(10), b"cde")
+        c.rewind(1)
+        self.assertEqual(c.peek(10), b"bcde")
+        c.skip(10)
+        self.assertEqual(len(c), 0)
+        c.append(b"f")
+        self.assertEqual(c.peek(10), b"f")
+
+    def test_clear(self):
+        c = ReceiveBuffer()
+        c.append(b"abc")
+        c.skip(1)
+        c.clear()
+        self.assertEqual(len(c), 0)
+        c.append(b"d")
+        self.assertEqual(c.popleft(1), b"d")
+
+    def test_find_high_bit(self):
+        c = ReceiveBuffer()
+        c.append(b"\x01\x02")
+        self.assertEqual(c.find_high_bit(65), -1)
+        c.append(b"\x82abc")
+        self.assertEqual(c.find_high_bit(65), 2)
+        self.assertEqual(c.find_high_bit(2), -1)
+        self.assertEqual(c.byte_at(2), b"\x82")
+        c.skip(1)
+        self.assertEqual(c.find_high_bit(65), 1)
+        c.skip(2)
+        self.assertEqual(c.find_high_bit(65), -1)
+
+    def test_header_value(self):
+        c = ReceiveBuffer()
+        c.append(b"\x82")
+        self.assertEqual(c.header_value(0), 0)
+        c.clear()
+        c.append(b"junk")
+        c.skip(4)
+        # little-endian base-128: 0x02 + 0x01*128
+        c.append(b"\x02\x01\x82")
+        self.assertEqual(c.header_value(2), 130)
+        self.assertEqual(c.header_value(1), 2)
+
+    def test_compact(self):
+        self.patch(receivebuffer, "COMPACT_THRESHOLD", 4)
+        c = ReceiveBuffer()
+        c.append(b"abcdef")
+        c.skip(4)
+        c.append(b"gh")
+        self.assertEqual(len(c), 4)
+        self.assertEqual(c.peek(10), b"efgh")
+        self.assertEqual(c.find_high_bit(10), -1)
+        self.assertEqual(c.popleft(4), b"efgh")
+
+    def test_large(self):
+        c = ReceiveBuffer()
+        body = b"x" * 100000
+        for i in range(0, len(body), 4096):
+            c.append(body[i:i+4096])
+        c.append(b"tail")
+        self.assertEqual(c.popleft(len(body)), body)
+        # the buffer is still resizable after a body has been copied out
+        c.append(b"more")
+        self.assertEqual(c.popleft(8), b"tailmore")
+
+    def test_raw_seek(self):
+        c = ReceiveBuffer()
+        c.append(b"abcdef")
+        c.skip(1)
+        data, pos = c.raw()
+        self.assertEqual(bytes(data[pos:]), b"bcdef")
+        c.seek(pos + 3)
+        self.assertEqual(c.peek(10), b"ef")
@@ -1,6 +1,6 @@
 import re
 from twisted.trial import unittest
-from foolscap import schema, copyable, broker
+from foolscap import schema, copyable, broker, tokens
 from foolscap.tokens import Violation, InvalidRemoteInterface
 from foolscap.constraint import IConstraint
 from foolscap.remoteinterface import RemoteMethodSchema, \
@@ -361,6 +361,64 @@ class Arguments(unittest.TestCase):
         self.assertRaises(schema.Violation,
                               r.checkResults, 12, False)
 
+    def test_received_arguments(self):
+        def foo(a=int, b=schema.ByteStringConstraint(minLength=2),
+                c=schema.Optional(bytes, None)): return None
+        r = RemoteMethodSchema(method=foo)
+        # 'a' and 'c' were enforced by the tokens, so they aren't checked
+        # again. 'b' could have been a short VOCAB string.
+        r.checkReceivedArgs(("not checked", b"ok"), {"c": 12})
+        self.assertRaises(schema.Violation, # b is too short
+                          r.checkReceivedArgs, (1, b"x"), {})
+        self.assertRaises(schema.Violation,
+                          r.checkReceivedArgs, (1,), {"b": b"x"})
+        self.assertRaises(schema.Violation, # missing required "b"
+                          r.checkReceivedArgs, (1,), {"c": b"c"})
+        self.assertRaises(schema.Violation, # still checked by checkAllArgs
+                          r.checkAllArgs, (1, b"ok"), {"c": 12}, True)
+
+    def test_unknown_arguments(self):
+        r = RemoteMethodSchema(a=int)
+        self.assertRaises(schema.Violation,
+                          r.checkAllArgs, (), {"a": 1, "b": 2}, False)
+        r = RemoteMethodSchema(a=int, __acceptUnknown__=True)
+        r.checkAllArgs((), {"a": 1, "b": "anything"}, False)
+        self.assertRaises(schema.Violation,
+                          r.checkAllArgs, (), {"a": "one"}, False)
+
+    def test_enforced_on_receive(self):
+        def enforced(c):
+            return IConstraint(c).enforcedOnReceive()
+        for c in [schema.Any(), bytes, str, int, float, bool, None,
+                  schema.IntegerConstraint(), schema.BooleanConstraint(True),
+                  schema.UnicodeConstraint(10, regexp="^[a-z]*$"),
+                  schema.ListOf(int, maxLength=3), (int, bytes),
+                  schema.DictOf(bytes, schema.ListOf(str)),
+                  schema.SetOf(int)]:
+            self.assertTrue(enforced(c), c)
+        for c in [schema.ByteStringConstraint(10),
+                  schema.ByteStringConstraint(minLength=1),
+                  schema.ListOf(int, minLength=1),
+                  schema.SetOf(int, mutable=True),
+                  (int, schema.ByteStringConstraint(10)),
+                  schema.DictOf(bytes, schema.ChoiceOf(int, bytes)),
+                  schema.ChoiceOf(int, bool),
+                  common.RIHelper, common.IFoo]:
+            self.assertFalse(enforced(c), c)
+
+    def test_integer_tokens(self):
+        # the header of an INT or NEG token is the value itself
+        c = schema.IntegerConstraint()
+        c.checkToken(tokens.INT, 2**31-1)
+        self.assertRaises(Violation, c.checkToken, tokens.INT, 2**31)
+        c.checkToken(tokens.NEG, 2**31)
+        self.assertRaises(Violation, c.checkToken, tokens.NEG, 2**31+1)
+        c = schema.IntegerConstraint(maxBytes=4)
+        c.checkToken(tokens.INT, 2**32-1)
+        self.assertRaises(Violation, c.checkToken, tokens.NEG, 2**32)
+        c = schema.IntegerConstraint(maxBytes=None)
+        c.checkToken(tokens.INT, 2**400)
+
     def test_bad_arguments(self):
         def foo(nodefault): return str
         self.assertRaises(InvalidRemoteInterface,
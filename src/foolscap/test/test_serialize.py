@@ -4,11 +4,15 @@ from twisted.trial import unittest
 from twisted.application import service
 from io import BytesIO
 import gc
+import threading
 
 from foolscap.api import Referenceable, Copyable, RemoteCopy, \
-     flushEventualQueue, serialize, unserialize, Tub
+     flushEventualQueue, serialize, unserialize, Tub, \
+     serializeSync, unserializeSync
 from foolscap.referenceable import RemoteReference
-from foolscap.tokens import Violation
+from foolscap.tokens import Violation, BananaError
+from foolscap.slicer import BaseSlicer
+from twisted.internet import defer
 from foolscap.util import allocate_tcp_port
 from foolscap.test.common import ShouldFailMixin
 
@@ -33,11 +37,11 @@ class Serialize(unittest.TestCase, ShouldFailMixin):
         return d
 
 
-    def NOT_test_data_synchronous(self):
+    def test_data_synchronous(self):
         obj = [b"look at the pretty graph", 3, True]
         obj.append(obj) # and look at the pretty cycle
-        data = serialize(obj)
-        obj2 = unserialize(data)
+        data = serializeSync(obj)
+        obj2 = unserializeSync(data)
         self.assertEqual(obj2[1], 3)
         self.failUnlessIdentical(obj2[3], obj2)
 
@@ -147,3 +151,76 @@ class Serialize(unittest.TestCase, ShouldFailMixin):
                                       t2.unserialize, data))
         return d
     test_referenceables_die.timeout = 5
+
+
+class Synchronous(unittest.TestCase):
+    # none of these touch the reactor
+
+    def test_same_bytes(self):
+        obj = {b"name": b"alice", b"tags": [b"a", b"b"], b"score": 1.5,
+               b"t": (1, 2**40, None)}
+        # including top-level primitives, which are sent as bare tokens
+        for obj in [obj, 5, -3, 2**40, 1.5, b"alice"]:
+            data = serializeSync(obj)
+            results = []
+            serialize(obj).addCallback(results.append)
+            self.assertEqual(results, [data])
+            self.assertEqual(unserializeSync(data), obj)
+
+    def test_tuple_cycle(self):
+        obj = [b"cycle"]
+        t = (obj,)
+        obj.append(t)
+        obj2 = unserializeSync(serializeSync(t))
+        self.failUnlessIdentical(obj2[0][1], obj2)
+
+    def test_copyable(self):
+        obj2 = unserializeSync(serializeSync([Bar()]))
+        self.assertTrue(isinstance(obj2[0], Bar))
+
+    def test_unhandled_objects(self):
+        e = self.assertRaises(Violation, serializeSync, [1, Foo()])
+        self.assertIn("cannot serialize", e.args[0])
+        e = self.assertRaises(Violation, serializeSync, [1, Referenceable()])
+        self.assertIn("can only be serialized by a broker", e.args[0])
+
+    def test_waiting_slicer(self):
+        d = defer.Deferred()
+        class Waiting(BaseSlicer):
+            opentype = ("list",)
+            def sliceBody(self, streamable, banana):
+                yield d
+        e = self.assertRaises(BananaError, serializeSync, [Waiting(None)])
+        self.assertIn("waiting for a Deferred", e.args[0])
+        # but one that has already fired is fine
+        d.callback(None)
+        self.assertEqual(unserializeSync(serializeSync(Waiting(None))), [])
+
+    def test_thread(self):
+        obj = [b"from a thread", {b"n": 1}]
+        results = []
+        def _work():
+            results.append(unserializeSync(serializeSync(obj)))
+        t = threading.Thread(target=_work)
+        t.start()
+        t.join()
+        self.assertEqual(results, [obj])
+
+    def test_incomplete(self):
+        data = serializeSync([1, 2, 3])
+        e = self.assertRaises(BananaError, unserializeSync, data[:-2])
+        self.assertIn("incomplete data", e.args[0])
+
+    def test_two_objects(self):
+        data = serializeSync([1, 2]) + serializeSync([3])
+        e = self.assertRaises(BananaError, unserializeSync, data)
+        self.assertIn("holds 2 objects", e.args[0])
+
+    def test_trailing_bytes(self):
+        # a partial token after the object
+        data = serializeSync([5]) + b"\x01"
+        e = self.assertRaises(BananaError, unserializeSync, data)
+        self.assertIn("incomplete data", e.args[0])
+
+    def test_corrupt(self):
+        self.assertRaises(BananaError, unserializeSync, b"\x01\x89")
@@ -0,0 +1,479 @@
+import io, mmap, os
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.main import CONNECTION_LOST
+from twisted.python.failure import Failure
+from twisted.internet.interfaces import IPullProducer
+from twisted.protocols.basic import FileSender
+from zope.interface import implementer
+from foolscap.api import Referenceable, RemoteInterface, StreamOf, \
+     ByteSource, ByteStreamConstraint, Violation, flushEventualQueue
+from foolscap.streaming import BYTE_STREAM_CHUNK_SIZE, \
+     INITIAL_BYTE_STREAM_CREDIT, OutboundStream
+from foolscap.test.common import TargetMixin, ShouldFailMixin
+
+class RIRows(RemoteInterface):
+    def count(n=int): return StreamOf(int)
+    def countAsync(n=int): return StreamOf(int)
+    def wrong(): return StreamOf(int)
+    def explode(n=int): return StreamOf(int)
+    def notAStream(): return int
+
+@implementer(RIRows)
+class Rows(Referenceable):
+    def __init__(self):
+        self.produced = 0
+        self.closed = False
+
+    def remote_count(self, n):
+        try:
+            for i in range(n):
+                self.produced += 1
+                yield i
+        except GeneratorExit:
+            self.closed = True
+            raise
+
+    async def _countAsync(self, n):
+        for i in range(n):
+            await defer.succeed(None)
+            yield i
+
+    def remote_countAsync(self, n):
+        return self._countAsync(n)
+
+    def remote_wrong(self):
+        yield 1
+        yield "two"
+
+    def remote_explode(self, n):
+        for i in range(n):
+            yield i
+        raise ValueError("ran out of rows")
+
+    def remote_notAStream(self):
+        return iter([1, 2])
+
+class Streaming(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        # these brokers did not negotiate a version
+        self.targetBroker.acceptsStreams = True
+
+    def collect(self, stream):
+        items = []
+        d = stream.consume(items.append)
+        d.addCallback(lambda res: items)
+        return d
+
+    def test_stream(self):
+        rr, target = self.setupTarget(Rows())
+        d = rr.callRemote("count", 1000)
+        d.addCallback(self.collect)
+        d.addCallback(lambda items: self.assertEqual(items, list(range(1000))))
+        d.addCallback(lambda res: self.assertEqual(
+            self.callingBroker.waitingForAnswers, {}))
+        d.addCallback(lambda res: self.assertEqual(
+            self.targetBroker.activeLocalCalls, {}))
+        return d
+
+    def test_empty(self):
+        rr, target = self.setupTarget(Rows())
+        d = rr.callRemote("count", 0)
+        d.addCallback(self.collect)
+        d.addCallback(lambda items: self.assertEqual(items, []))
+        return d
+
+    def test_async(self):
+        rr, target = self.setupTarget(Rows())
+        async def _read():
+            stream = await rr.callRemote("countAsync", 50)
+            items = []
+            async for item in stream:
+                items.append(item)
+            return items
+        d = defer.ensureDeferred(_read())
+        d.addCallback(lambda items: self.assertEqual(items, list(range(50))))
+        return d
+
+    def test_flow_control(self):
+        # the far end stops pulling items once the caller's window is full
+        self.callingBroker.streamWindow = 20
+        rr, target = self.setupTarget(Rows())
+        d = rr.callRemote("count", 1000)
+        def _started(stream):
+            self.stream = stream
+            return self.poll(lambda: target.produced == 20)
+        d.addCallback(_started)
+        d.addCallback(flushEventualQueue)
+        def _full(res):
+            self.assertEqual(target.produced, 20)
+            # reading half the window grants more credit
+            return defer.gatherResults([self.stream.next()
+                                        for i in range(10)])
+        d.addCallback(_full)
+        d.addCallback(lambda items: self.assertEqual(items, list(range(10))))
+        d.addCallback(lambda res: self.poll(lambda: target.produced == 30))
+        d.addCallback(flushEventualQueue)
+        d.addCallback(lambda res: self.assertEqual(target.produced, 30))
+        d.addCallback(lambda res: self.collect(self.stream))
+        d.addCallback(lambda items: self.assertEqual(items,
+                                                     list(range(10, 1000))))
+        return d
+
+    def test_fairness(self):
+        # two streams sending at once take turns on the connection, instead
+        # of one waiting for the other to finish
+        self.patch(OutboundStream, "chunkSize", 1)
+        self.targetBroker.rootSlicer.sendQueue.quantum = 50
+        rr, target = self.setupTarget(Rows())
+        sent = []
+        queue = self.targetBroker.rootSlicer.sendQueue
+        popleft = queue.popleft
+        def _popleft():
+            entry = popleft()
+            sent.append(entry[0].reqID)
+            return entry
+        queue.popleft = _popleft
+        # the first stream fills the queue before the second one starts
+        self.targetBroker.pauseProducing()
+        calls = []
+        calls.append(rr.callRemote("count", 16))
+        d = flushEventualQueue()
+        d.addCallback(lambda res: calls.append(rr.callRemote("count", 16)))
+        d.addCallback(flushEventualQueue)
+        def _resume(res):
+            d1, d2 = calls
+            # the start and 16 items each: that uses up the initial credit
+            self.assertEqual(len(queue), 2*17)
+            self.targetBroker.resumeProducing()
+            return defer.gatherResults([d1.addCallback(self.collect),
+                                        d2.addCallback(self.collect)])
+        d.addCallback(_resume)
+        def _check(res):
+            self.assertEqual(res, [list(range(16)), list(range(16))])
+            runs = [1]
+            for previous, reqID in zip(sent, sent[1:]):
+                if reqID == previous:
+                    runs[-1] += 1
+                else:
+                    runs.append(1)
+            self.assertTrue(max(runs) <= 3, runs)
+            stats = self.targetBroker.getSendQueueStats()["interactive"]
+            self.assertEqual(stats["objectsSent"], 36)
+            self.assertEqual(stats["flows"], {})
+        d.addCallback(_check)
+        return d
+
+    def test_cancel(self):
+        self.callingBroker.streamWindow = 20
+        rr, target = self.setupTarget(Rows())
+        d = rr.callRemote("count", 1000)
+        def _started(stream):
+            self.stream = stream
+            return self.poll(lambda: target.produced == 20)
+        d.addCallback(_started)
+        d.addCallback(lambda res: self.stream.cancel())
+        d.addCallback(lambda res: self.poll(lambda: target.closed))
+        def _check(res):
+            self.assertEqual(self.targetBroker.inboundCancels, 1)
+            self.assertEqual(self.targetBroker.activeLocalCalls, {})
+            return self.assertFailure(self.stream.next(),
+                                      defer.CancelledError)
+        d.addCallback(_check)
+        return d
+
+    def test_connection_lost(self):
+        # a stream waiting for credit is closed when the connection goes
+        self.callingBroker.streamWindow = 20
+        rr, target = self.setupTarget(Rows())
+        d = rr.callRemote("count", 1000)
+        d.addCallback(lambda res: self.poll(lambda: target.produced == 20))
+        def _lose(res):
+            self.assertFalse(target.closed)
+            self.targetBroker.transport.loseConnection(
+                Failure(CONNECTION_LOST))
+        d.addCallback(_lose)
+        d.addCallback(flushEventualQueue)
+        d.addCallback(lambda res: self.assertTrue(target.closed))
+        return d
+
+    def test_item_violation(self):
+        rr, target = self.setupTarget(Rows())
+        d = rr.callRemote("wrong")
+        def _started(stream):
+            items = []
+            d2 = self.shouldFail(Violation, "wrong", "is not a number",
+                                 stream.consume, items.append)
+            d2.addCallback(lambda res: self.assertEqual(items, [1]))
+            return d2
+        d.addCallback(_started)
+        return d
+
+    def test_failure(self):
+        rr, target = self.setupTarget(Rows())
+        d = rr.callRemote("explode", 3)
+        def _started(stream):
+            items = []
+            d2 = self.shouldFail(ValueError, "explode", "ran out of rows",
+                                 stream.consume, items.append)
+            d2.addCallback(lambda res: self.assertEqual(items, [0, 1, 2]))
+            return d2
+        d.addCallback(_started)
+        return d
+
+    def test_not_a_stream(self):
+        rr, target = self.setupTarget(Rows())
+        return self.shouldFail(Violation, "notAStream", "is not a StreamOf",
+                               rr.callRemote, "notAStream")
+
+    def test_fallback(self):
+        # peers which cannot receive streams get a list
+        self.targetBroker.acceptsStreams = False
+        rr, target = self.setupTarget(Rows())
+        d = rr.callRemote("count", 100)
+        d.addCallback(lambda res: self.assertEqual(res, list(range(100))))
+        d.addCallback(lambda res: rr.callRemote("countAsync", 5))
+        d.addCallback(lambda res: self.assertEqual(res, list(range(5))))
+        return d
+
+
+class RIStore(RemoteInterface):
+    def put(data=ByteSource): return bytes
+    def putSmall(data=ByteStreamConstraint(maxLength=1000)): return bytes
+    def hold(data=ByteSource): return None
+    def putCount(data=ByteSource, n=int): return bytes
+    def ignore(data=ByteSource): return None
+    def explode(data=ByteSource): return None
+
+@implementer(RIStore)
+class Store(Referenceable):
+    def __init__(self):
+        self.chunks = []
+        self.waiting = None
+
+    def remote_put(self, data):
+        d = data.consume(self.chunks.append)
+        d.addCallback(lambda res: b"".join(self.chunks))
+        return d
+
+    def remote_putSmall(self, data):
+        return data.readAll()
+
+    def remote_hold(self, data):
+        # read it later
+        self.stream = data
+
+    def remote_putCount(self, data, n):
+        return data.readAll()
+
+    def remote_ignore(self, data):
+        # never read it, and never answer
+        self.waiting = defer.Deferred()
+        return self.waiting
+
+    def remote_explode(self, data):
+        raise ValueError("boom")
+
+class Echo(Referenceable):
+    def remote_echo(self, data):
+        return data
+
+class BadFile(object):
+    def __init__(self):
+        self.reads = 0
+    def read(self, size):
+        self.reads += 1
+        if self.reads > 2:
+            raise ValueError("disk on fire")
+        return b"x" * size
+
+@implementer(IPullProducer)
+class Counter(object):
+    # writes a few bytes at a time, 'limit' times
+    def __init__(self, consumer, limit=10):
+        self.consumer = consumer
+        self.limit = limit
+        self.count = 0
+        self.stopped = False
+        consumer.registerProducer(self, False)
+    def resumeProducing(self):
+        self.count += 1
+        self.consumer.write(b"%d," % self.count)
+        if self.count == self.limit:
+            self.consumer.unregisterProducer()
+    def stopProducing(self):
+        self.stopped = True
+
+class ByteStreaming(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        # these brokers did not negotiate a version
+        self.callingBroker.acceptsByteStreams = True
+
+    def checkIdle(self, res=None):
+        self.assertEqual(self.callingBroker.outboundByteStreams, {})
+        self.assertEqual(self.targetBroker.inboundByteStreams, {})
+
+    def test_file(self):
+        data = os.urandom(1000*1000)
+        rr, target = self.setupTarget(Store())
+        d = rr.callRemote("put", ByteSource(io.BytesIO(data)))
+        def _check(res):
+            self.assertEqual(res, data)
+            self.assertTrue(len(target.chunks) > 1)
+            self.assertTrue(max(map(len, target.chunks))
+                            <= BYTE_STREAM_CHUNK_SIZE)
+        d.addCallback(_check)
+        d.addCallback(flushEventualQueue)
+        d.addCallback(self.checkIdle)
+        return d
+
+    def test_buffers(self):
+        data = os.urandom(100*1000)
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        f = open(fn, "rb")
+        self.addCleanup(f.close)
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(m.close)
+        rr, target = self.setupTarget(Store())
+        d = rr.callRemote("putSmall", ByteSource(b"small"))
+        d.addCallback(lambda res: self.assertEqual(res, b"small"))
+        d.addCallback(lambda res: rr.callRemote("put", ByteSource(m)))
+        d.addCallback(lambda res: self.assertEqual(res, data))
+        return d
+
+    def test_producer(self):
+        rr, target = self.setupTarget(Store())
+        source = ByteSource()
+        Counter(source)
+        d = rr.callRemote("put", source)
+        d.addCallback(lambda res: self.assertEqual(
+            res, b"".join([b"%d," % i for i in range(1, 11)])))
+        return d
+
+    def test_file_sender(self):
+        data = os.urandom(300*1000)
+        rr, target = self.setupTarget(Store())
+        source = ByteSource()
+        sent = FileSender().beginFileTransfer(io.BytesIO(data), source)
+        d = rr.callRemote("put", source)
+        d.addCallback(lambda res: self.assertEqual(res, data))
+        d.addCallback(lambda res: sent)
+        return d
+
+    def test_flow_control(self):
+        # the sender stops reading once the receiver's window is full
+        self.targetBroker.byteStreamWindow = INITIAL_BYTE_STREAM_CREDIT
+        data = os.urandom(1000*1000)
+        f = io.BytesIO(data)
+        rr, target = self.setupTarget(Store())
+        d = rr.callRemote("hold", ByteSource(f))
+        d.addCallback(lambda res: self.poll(
+            lambda: target.stream.received == INITIAL_BYTE_STREAM_CREDIT))
+        d.addCallback(flushEventualQueue)
+        def _full(res):
+            self.assertEqual(f.tell(), INITIAL_BYTE_STREAM_CREDIT)
+            # reading half the window grants more credit
+            return defer.gatherResults([target.stream.read()
+                                        for i in range(2)])
+        d.addCallback(_full)
+        d.addCallback(lambda res: self.poll(
+            lambda: target.stream.received > INITIAL_BYTE_STREAM_CREDIT))
+        d.addCallback(lambda res: target.stream.readAll())
+        d.addCallback(lambda rest: self.assertEqual(
+            rest, data[2*BYTE_STREAM_CHUNK_SIZE:]))
+        d.addCallback(flushEventualQueue)
+        d.addCallback(self.checkIdle)
+        return d
+
+    def test_cancel(self):
+        rr, target = self.setupTarget(Store())
+        source = ByteSource()
+        counter = Counter(source, limit=None)
+        d = rr.callRemote("hold", source)
+        d.addCallback(lambda res: target.stream.cancel())
+        d.addCallback(lambda res: self.poll(lambda: counter.stopped))
+        def _check(res):
+            self.checkIdle()
+            return self.assertFailure(target.stream.read(),
+                                      defer.CancelledError)
+        d.addCallback(_check)
+        return d
+
+    def test_too_long(self):
+        rr, target = self.setupTarget(Store())
+        d = self.shouldFail(Violation, "too_long", "byte stream too long",
+                            rr.callRemote, "putSmall",
+                            ByteSource(b"x" * 2000))
+        d.addCallback(lambda res: self.poll(lambda: not (
+            self.callingBroker.outboundByteStreams or
+            self.targetBroker.inboundByteStreams)))
+        return d
+
+    def waitForIdle(self, res=None):
+        return self.poll(lambda: not (self.callingBroker.outboundByteStreams
+                                      or self.targetBroker.inboundByteStreams))
+
+    def test_rejected(self):
+        # a stream whose call is rejected is cancelled, rather than being
+        # left to stall on credit
+        rr, target = self.setupTarget(Store())
+        data = ByteSource()
+        counter = Counter(data, limit=None) # it never ends by itself
+        d = self.shouldFail(Violation, "rejected", "rejected by IntegerConstraint",
+                            rr.callRemote, "putCount", data, "one")
+        d.addCallback(self.waitForIdle)
+        d.addCallback(self.checkIdle)
+        d.addCallback(lambda res: self.assertTrue(counter.stopped))
+        return d
+
+    def test_cancelled(self):
+        rr, target = self.setupTarget(Store())
+        data = ByteSource()
+        counter = Counter(data, limit=None) # it never ends by itself
+        d1 = rr.callRemote("ignore", data)
+        d = self.poll(lambda: target.waiting)
+        d.addCallback(lambda res: d1.cancel())
+        d.addCallback(lambda res: self.assertFailure(d1, defer.CancelledError))
+        d.addCallback(self.waitForIdle)
+        d.addCallback(self.checkIdle)
+        d.addCallback(lambda res: self.assertTrue(counter.stopped))
+        return d
+
+    def test_method_failed(self):
+        rr, target = self.setupTarget(Store())
+        data = ByteSource()
+        counter = Counter(data, limit=None) # it never ends by itself
+        d = self.shouldFail(ValueError, "method_failed", "boom",
+                            rr.callRemote, "explode", data)
+        d.addCallback(self.waitForIdle)
+        d.addCallback(self.checkIdle)
+        d.addCallback(lambda res: self.assertTrue(counter.stopped))
+        return d
+
+    def test_read_error(self):
+        rr, target = self.setupTarget(Store())
+        d = rr.callRemote("hold", ByteSource(BadFile()))
+        d.addCallback(lambda res: self.shouldFail(ValueError, "read_error",
+                                                  "disk on fire",
+                                                  target.stream.readAll))
+        d.addCallback(self.checkIdle)
+        return d
+
+    def test_fallback(self):
+        # peers which cannot receive byte streams get a bytestring
+        self.callingBroker.acceptsByteStreams = False
+        rr, target = self.setupTarget(Echo())
+        d = rr.callRemote("echo", ByteSource(io.BytesIO(b"data")))
+        d.addCallback(lambda res: self.assertEqual(res, b"data"))
+        source = ByteSource()
+        Counter(source)
+        d.addCallback(lambda res: self.shouldFail(
+            Violation, "fallback", "cannot receive a ByteSource",
+            rr.callRemote, "echo", source))
+        return d